@@ -2,10 +2,18 @@ import requests
 from sympy import symbols, simplify
 from sympy.core.symbol import Symbol
 import operator
+import re
 from functools import reduce
 
 import requests
 
+# Exact components are pre-filtered with a wildcard query per run of letters and digits in their terms. The standard
+# analyzer lowercases tokens and does not split such runs of the scripts below PREFILTER_MAX_CHARACTER, so a document
+# containing a term has a token containing each of its runs. Longer runs may be split at the maximum token length.
+PREFILTER_MAX_CHARACTER = '\u0e00'
+PREFILTER_MAX_RUN_LENGTH = 255
+word_run_pattern = re.compile(r'[^\W_]+')
+
 class ElasticGrammarQuery(object):
 
     def __init__(self, inclusive_grammar, exclusive_grammar):
@@ -106,6 +114,64 @@ class ElasticGrammarQuery(object):
                 nodes.extend(current_node['components'])
         return names
 
+def build_prefilter(grammar, prefilter_fields=None):
+    """Builds a conservative Elasticsearch query from the literal terms of the grammar: every document the grammar
+    matches is also matched by the query. Regex components and exact components on layers outside of prefilter_fields
+    (see get_prefilter_fields) do not constrain the query.
+
+    Returns None if the grammar can't be narrowed down.
+    """
+    operation = grammar.get('operation')
+
+    if operation == 'exact':
+        if prefilter_fields is not None and grammar['layer'] not in prefilter_fields:
+            return None
+        term_queries = [_build_term_prefilter(term, grammar['layer']) for term in grammar.get('terms') or []]
+        if None in term_queries:
+            return None
+        return _join_prefilters(term_queries, 'should')
+
+    sub_queries = [build_prefilter(component, prefilter_fields) for component in grammar.get('components') or []]
+    if operation in {'concat', 'gap', 'intersect'}:
+        return _join_prefilters([sub_query for sub_query in sub_queries if sub_query is not None], 'must')
+    if operation == 'union' and None not in sub_queries:
+        return _join_prefilters(sub_queries, 'should')
+    return None
+
+
+def get_prefilter_fields(mapping_schema):
+    """Returns the paths of the text fields analyzed with the standard analyzer in every index of ES_Manager.get_mapping_schema() output."""
+    field_analyzers = {}
+
+    def collect_fields(properties, root_path):
+        for field_name, field_mapping in properties.items():
+            path = root_path + field_name
+            if 'properties' in field_mapping:
+                collect_fields(field_mapping['properties'], path + '.')
+            else:
+                analyzer = field_mapping.get('analyzer', 'standard') if field_mapping.get('type') == 'text' else None
+                field_analyzers.setdefault(path, set()).add(analyzer)
+
+    for index_mapping in mapping_schema.values():
+        for type_mapping in index_mapping['mappings'].values():
+            collect_fields(type_mapping.get('properties', {}), '')
+
+    return {path for path, analyzers in field_analyzers.items() if analyzers == {'standard'}}
+
+
+def _build_term_prefilter(term, layer):
+    runs = [run for run in word_run_pattern.findall(term.lower())
+            if len(run) <= PREFILTER_MAX_RUN_LENGTH and max(run) < PREFILTER_MAX_CHARACTER]
+    return _join_prefilters([{'wildcard': {layer: '*{0}*'.format(run)}} for run in runs], 'must')
+
+
+def _join_prefilters(queries, occurrence):
+    if not queries:
+        return None
+    if len(queries) == 1:
+        return queries[0]
+    return {'bool': {occurrence: queries}}
+
 """
 query = {'op':'concat', 'components':[{'op':'match','terms':['tere','ilus'],'layer':'text','name':'asd','join_by':'union'}],'name':'asd2'}
 ElasticGrammarQuery(query, None, None, None, None)
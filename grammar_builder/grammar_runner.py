@@ -0,0 +1,209 @@
+import hashlib
+import json
+from contextlib import closing
+from multiprocessing import Pool
+
+from grammar_builder.models import GrammarPageMapping
+from texta.settings import GRAMMAR_MATCH_PROCESSES
+from . import multilayer_matcher as matcher
+
+# Documents are searched in a fixed order with search_after, so that a search can continue after any stored page.
+# _id is the only tiebreaker every index has, sorting on it loads _id fielddata of the searched indices to the heap.
+GRAMMAR_SORT = [{'_index': 'asc'}, {'_id': 'asc'}]
+GRAMMAR_SEARCH_BATCH = 1000
+# With GRAMMAR_MATCH_PROCESSES > 1 batches are matched in a process pool, GRAMMAR_MATCH_CHUNK documents per task.
+# Smaller batches are matched in place.
+GRAMMAR_MATCH_CHUNK = 50
+# Name of the pre-filter clause of negative searches, documents that miss it can't match the grammar.
+PREFILTER_QUERY_NAME = 'grammar_prefilter'
+
+
+def get_feature_dict(source):
+    """Flattens the object fields of the document source, {'comment': {'lemmas': ...}} becomes {'comment.lemmas': ...}."""
+    feature_dict = {}
+    for field_name, field_value in source.items():
+        if isinstance(field_value, dict):
+            for subfield_name, subfield_value in field_value.items():
+                feature_dict['{0}.{1}'.format(field_name, subfield_name)] = subfield_value
+        else:
+            feature_dict[field_name] = field_value
+    return feature_dict
+
+
+class GrammarRunner(object):
+    """
+    Streams the documents of a search that the grammar matches, or with negative polarity the documents it doesn't match.
+
+    Positive searches only fetch the documents matched by the grammar's pre-filter (see build_prefilter), negative
+    searches only match the documents that pass it. Documents are fetched in GRAMMAR_SORT order and matched in a
+    process pool.
+    """
+
+    def __init__(self, es_m, query, instructions, prefilter=None, positive=True, features=None, processes=GRAMMAR_MATCH_PROCESSES):
+        self._es_m = es_m
+        self._instructions = instructions
+        self._prefilter = prefilter
+        self._features = features
+        self._processes = processes
+        self.positive = positive
+        self.query = self._build_query(query.get('query', {'match_all': {}}))
+
+    def _build_query(self, base_query):
+        if self._prefilter is None:
+            return {'query': base_query}
+        if self.positive:
+            return {'query': {'bool': {'must': [base_query], 'filter': [self._prefilter]}}}
+        named_prefilter = {'bool': {'filter': [self._prefilter], '_name': PREFILTER_QUERY_NAME}}
+        return {'query': {'bool': {'must': [base_query], 'should': [named_prefilter]}}}
+
+    def get_total(self):
+        """Returns the number of searched documents, an upper bound of the number of documents iter_documents yields."""
+        return self._es_m.perform_query(dict(self.query, size=0))['hits']['total']
+
+    def get_query_hash(self, *args):
+        """Identifies the search on the active datasets together with any other JSON serializable arguments."""
+        key = [self._es_m.stringify_datasets(), self.query, self.positive, self._features] + list(args)
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf8')).hexdigest()
+
+    def iter_documents(self, search_after=None):
+        """Yields the hits of the documents in sort order, after the document with the search_after sort key if given."""
+        query = dict(self.query, size=GRAMMAR_SEARCH_BATCH, sort=GRAMMAR_SORT)
+        if self._features is not None:
+            query['_source'] = self._features
+
+        pool = None
+        try:
+            while True:
+                if search_after is not None:
+                    query['search_after'] = search_after
+                hits = self._es_m.perform_query(query)['hits']['hits']
+                if not hits:
+                    return
+
+                candidate_hits = [hit for hit in hits if self._is_candidate(hit)]
+                if len(candidate_hits) > GRAMMAR_MATCH_CHUNK and self._processes > 1:
+                    if pool is None:
+                        pool = Pool(self._processes, initializer=_init_match_worker, initargs=(self._instructions,))
+                    chunks = [[hit['_source'] for hit in candidate_hits[start:start + GRAMMAR_MATCH_CHUNK]]
+                              for start in range(0, len(candidate_hits), GRAMMAR_MATCH_CHUNK)]
+                    matched = [is_matched for chunk_matched in pool.map(_match_chunk, chunks) for is_matched in chunk_matched]
+                else:
+                    matched = _match_sources(self._instructions, [hit['_source'] for hit in candidate_hits])
+
+                matched_ids = {id(hit) for hit, is_matched in zip(candidate_hits, matched) if is_matched}
+                for hit in hits:
+                    if (id(hit) in matched_ids) == self.positive:
+                        yield hit
+
+                search_after = hits[-1]['sort']
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def get_documents(self, document_ids):
+        """Fetches the documents by their [index, type, id] in the given order."""
+        if not document_ids:
+            return []
+
+        docs = []
+        for index, doc_type, doc_id in document_ids:
+            doc = {'_index': index, '_type': doc_type, '_id': doc_id}
+            if self._features is not None:
+                doc['_source'] = self._features
+            docs.append(doc)
+
+        response = self._es_m.plain_post('{0}/_mget'.format(self._es_m.es_url), json.dumps({'docs': docs}))
+        return [doc for doc in response['docs'] if doc.get('found')]
+
+    def _is_candidate(self, hit):
+        return self.positive or self._prefilter is None or PREFILTER_QUERY_NAME in hit.get('matched_queries', [])
+
+
+class GrammarPageIndex(object):
+    """
+    Dense index of the pages of a GrammarRunner search, stored as GrammarPageMapping rows.
+
+    Stored pages are fetched by their document ids. Requesting a page past the last stored one continues the search
+    from the sort key of the last stored page and stores every page on the way.
+    """
+
+    def __init__(self, runner, grammar, page_length, **mapping_fields):
+        self._runner = runner
+        self._page_length = page_length
+        self._mapping_fields = dict(mapping_fields, query_hash=runner.get_query_hash(grammar, page_length))
+
+    def reset(self):
+        self._get_mappings().delete()
+
+    def get_page_hits(self, page):
+        mapping = self._get_page_mapping(page)
+        if mapping is None:
+            return []
+        return self._runner.get_documents(json.loads(mapping.document_ids))
+
+    def get_total(self):
+        """Returns the number of documents once the search has finished, the runner's upper bound before that."""
+        last_mapping = self._get_mappings().filter(search_after=None).first()
+        if last_mapping is not None:
+            return last_mapping.elastic_end
+        return self._runner.get_total()
+
+    def _get_mappings(self):
+        return GrammarPageMapping.objects.filter(**self._mapping_fields)
+
+    def _get_page_mapping(self, page):
+        mapping = self._get_mappings().filter(page=page).first()
+        if mapping is not None:
+            return mapping
+
+        last_mapping = self._get_mappings().order_by('-page').first()
+        if last_mapping is None:
+            next_page, position, search_after = 1, 0, None
+        elif last_mapping.search_after is None or last_mapping.page > page:
+            return None
+        else:
+            next_page, position, search_after = last_mapping.page + 1, last_mapping.elastic_end, json.loads(last_mapping.search_after)
+
+        document_ids = []
+        with closing(self._runner.iter_documents(search_after)) as documents:
+            for hit in documents:
+                document_ids.append([hit['_index'], hit['_type'], hit['_id']])
+                if len(document_ids) == self._page_length:
+                    mapping = self._save_mapping(next_page, position, document_ids, hit['sort'])
+                    if next_page == page:
+                        return mapping
+                    next_page, position, document_ids = next_page + 1, position + len(document_ids), []
+
+        mapping = self._save_mapping(next_page, position, document_ids, None)
+        return mapping if next_page == page else None
+
+    def _save_mapping(self, page, position, document_ids, search_after):
+        mapping = GrammarPageMapping(page=page, elastic_start=position, elastic_end=position + len(document_ids),
+                                     document_ids=json.dumps(document_ids),
+                                     search_after=json.dumps(search_after) if search_after is not None else None,
+                                     **self._mapping_fields)
+        mapping.save()
+        return mapping
+
+
+_worker_instructions = None
+
+
+def _init_match_worker(instructions):
+    global _worker_instructions
+    _worker_instructions = instructions
+
+
+def _match_chunk(sources):
+    return _match_sources(_worker_instructions, sources)
+
+
+def _match_sources(instructions, sources):
+    matched = []
+    for source in sources:
+        try:
+            matched.append(bool(instructions.match(matcher.LayerDict(get_feature_dict(source)))))
+        except KeyError:
+            # Documents without some grammar layer are not matched.
+            matched.append(False)
+    return matched
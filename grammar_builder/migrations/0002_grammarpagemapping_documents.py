@@ -0,0 +1,28 @@
+# Generated by Django 2.1.8 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grammar_builder', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='grammarpagemapping',
+            name='query_hash',
+            field=models.CharField(db_index=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='grammarpagemapping',
+            name='document_ids',
+            field=models.TextField(default='[]'),
+        ),
+        migrations.AddField(
+            model_name='grammarpagemapping',
+            name='search_after',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
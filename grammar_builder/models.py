@@ -18,7 +18,9 @@ class GrammarComponent(models.Model):
 
 
 # Maps grammar tool's session data (search_id, inclusive_grammar, exclusive_grammar) and pagination step to
-# specific cursor location ('from') in Elastic Search.
+# the documents of the page. Pages of a grammar search are stored densely under the same query_hash, elastic_start
+# and elastic_end are the positions of the page in the matched documents and search_after is the sort key of its
+# last document, from which the next page is searched. The last page of a finished search has no search_after.
 class GrammarPageMapping(models.Model):
     search_id = models.IntegerField()
     inclusive_grammar = models.IntegerField()
@@ -27,6 +29,9 @@ class GrammarPageMapping(models.Model):
     page = models.IntegerField()
     elastic_start = models.IntegerField()
     elastic_end = models.IntegerField()
+    query_hash = models.CharField(max_length=40, default='', db_index=True)
+    document_ids = models.TextField(default='[]')
+    search_after = models.TextField(null=True, blank=True)
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     
 class Grammar(models.Model):
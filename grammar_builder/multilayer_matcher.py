@@ -6,9 +6,11 @@
 #Regex
 
 import re
+import bisect
 import itertools
 
 delimiter = r'\s+'
+token_pattern = re.compile('([^'+delimiter+']+)')
 
 class Match(object):
     def __init__(self, token_idxs, features, texts=None):
@@ -40,51 +42,36 @@ class LayerDict(dict):
             if layer_name not in self[feature_name]:
                 self[feature_name][layer_name] = {}
             self[feature_name][layer_name]['text'] = layers_dict[layer_path]
-            self[feature_name][layer_name]['map'] = None
             self[feature_name][layer_name]['starts'] = None
+            self[feature_name][layer_name]['ends'] = None
 
     def get_token_index(self, feature_name, layer_name, match_location):
-        if not self[feature_name][layer_name]['map']:
-            self[feature_name][layer_name]['map'] = self._get_char_to_token_mapping(feature_name, layer_name)
-        return self[feature_name][layer_name]['map'][match_location]
+        """Returns the index of the token at the character location, None for delimiters."""
+        layer = self._get_tokenized_layer(feature_name, layer_name)
+        if match_location < 0:
+            match_location += len(layer['text'])
+        if not 0 <= match_location < len(layer['text']):
+            raise IndexError('match location out of range')
+
+        token_idx = bisect.bisect_right(layer['starts'], match_location) - 1
+        if token_idx >= 0 and match_location < layer['ends'][token_idx]:
+            return token_idx
+        return None
 
     def get_token_by_index(self, token_idx, feature_name, layer_name):
         if feature_name not in self or layer_name not in self[feature_name]:
             return None
-        mapping = self[feature_name][layer_name]['map']
-        if not self[feature_name][layer_name]['starts']:
-            self[feature_name][layer_name]['starts'] = self._get_index_to_char_start_mapping(feature_name, layer_name)
-
-        start_idx = self[feature_name][layer_name]['starts'][token_idx]
-        end_idx = start_idx + 1
-        while end_idx < len(mapping):
-            if mapping[end_idx] != token_idx:
-                break
-            end_idx += 1
-        end_idx = end_idx + 1 if end_idx == (len(mapping) - 1) else end_idx
-
-        return self[feature_name][layer_name]['text'][start_idx:end_idx]
-
-    def _get_char_to_token_mapping(self, feature_name, layer_name):
-        pattern = re.compile('([^'+delimiter+']+)')
-        encoded_layer = [None]*len(self[feature_name][layer_name]['text'])
-        spans = [(match.start(),match.end()) for match in pattern.finditer(self[feature_name][layer_name]['text'])]
-        for span_idx, span in enumerate(spans):
-            for position in range(span[0],span[1]):
-                encoded_layer[position] = span_idx
-        return encoded_layer
-
-    def _get_index_to_char_start_mapping(self, feature_name, layer_name):
-        index_to_char_start = []
-        last_token_idx = -1
-        mapping = self[feature_name][layer_name]['map']
-        for idx in range(len(self[feature_name][layer_name]['map'])):
-            token_idx = mapping[idx]
-            if token_idx != last_token_idx:
-                index_to_char_start.append(idx)
-            last_token_idx = token_idx
-
-        return index_to_char_start
+        layer = self._get_tokenized_layer(feature_name, layer_name)
+        return layer['text'][layer['starts'][token_idx]:layer['ends'][token_idx]]
+
+    def _get_tokenized_layer(self, feature_name, layer_name):
+        # Token boundaries are found once per layer, locations are mapped to tokens with bisect.
+        layer = self[feature_name][layer_name]
+        if layer['starts'] is None:
+            spans = [match.span() for match in token_pattern.finditer(layer['text'])]
+            layer['starts'] = [span[0] for span in spans]
+            layer['ends'] = [span[1] for span in spans]
+        return layer
 
 class Exact(object):
     def __init__(self, tokens, layer_path, case_sensitive=False):
@@ -263,6 +250,151 @@ class LayerMatch(object):
 
         return Match(token_idxs, features, texts)
 
+def compile_plan(instruction):
+    """
+    Compiles a tree of Exact, Regex, Intersection, Union, Concatenation and Gap instructions into a match plan
+    with the same match(layer_dict) results.
+
+    Leaves with the same pattern and layer are matched once per layer_dict. Operations stop as soon as a component
+    has no matches. Concatenation and Gap join the component matches on their boundary tokens with bisect over
+    matches sorted by first token, instead of filtering their cartesian product.
+    """
+    leaves = {}
+
+    def compile_node(node):
+        if isinstance(node, (Exact, Regex)):
+            key = (type(node), node._pattern.pattern, node._pattern.flags, node._feature_name, node._layer_name)
+            if key not in leaves:
+                leaves[key] = _LeafPlan(node, len(leaves))
+            return leaves[key]
+        if isinstance(node, Union):
+            return _UnionPlan([compile_node(component) for component in node._components])
+        if isinstance(node, Concatenation):
+            return _ChainPlan([compile_node(component) for component in node._components], 1, 1)
+        if isinstance(node, Gap) and not node._match_first:
+            return _ChainPlan([compile_node(component) for component in node._components], 1, node._slop)
+        if isinstance(node, Intersection) and not node._match_first:
+            return _ProductPlan([compile_node(component) for component in node._components])
+        return _InstructionPlan(node)
+
+    return MatchPlan(compile_node(instruction))
+
+class MatchPlan(object):
+    def __init__(self, root):
+        self._root = root
+
+    def match(self, layer_dict):
+        return self._root.match(layer_dict, {})
+
+class _LeafPlan(object):
+    def __init__(self, instruction, leaf_idx):
+        self._instruction = instruction
+        self._leaf_idx = leaf_idx
+
+    def match(self, layer_dict, leaf_matches):
+        if self._leaf_idx not in leaf_matches:
+            leaf_matches[self._leaf_idx] = self._instruction.match(layer_dict)
+        return leaf_matches[self._leaf_idx]
+
+class _InstructionPlan(object):
+    """Instructions without a compiled form, like match_first intersections and gaps."""
+    def __init__(self, instruction):
+        self._instruction = instruction
+
+    def match(self, layer_dict, leaf_matches):
+        return self._instruction.match(layer_dict)
+
+class _UnionPlan(object):
+    def __init__(self, components):
+        self._components = components
+
+    def match(self, layer_dict, leaf_matches):
+        return list(set([component_match for component in self._components for component_match in component.match(layer_dict, leaf_matches)]))
+
+class _ProductPlan(object):
+    def __init__(self, components):
+        self._components = components
+
+    def match(self, layer_dict, leaf_matches):
+        component_matches = _match_components(self._components, layer_dict, leaf_matches)
+        if component_matches is None:
+            return []
+        return list(set(_merge_matches(match_combination) for match_combination in itertools.product(*component_matches)))
+
+class _ChainPlan(object):
+    """Components whose consecutive tokens, also across component boundaries, are min_gap to max_gap tokens apart."""
+    def __init__(self, components, min_gap, max_gap):
+        self._components = components
+        self._min_gap = min_gap
+        self._max_gap = max_gap
+
+    def match(self, layer_dict, leaf_matches):
+        component_matches = _match_components(self._components, layer_dict, leaf_matches)
+        if component_matches is None:
+            return []
+
+        if not component_matches or any(not match.token_idxs for matches in component_matches for match in matches):
+            # Tokenless matches join their neighbours' tokens, check the merged combinations like Gap does.
+            merged_matches = set(_merge_matches(match_combination) for match_combination in itertools.product(*component_matches))
+            return [match for match in merged_matches if len(match.token_idxs) < 2 or self._is_chained(match.token_idxs)]
+
+        component_matches = [[match for match in matches if self._is_chained(match.token_idxs)] for matches in component_matches]
+
+        # Keep only the matches that can be continued up to the last component, walking from the end.
+        for component_idx in range(len(component_matches) - 2, -1, -1):
+            next_firsts = sorted(match.token_idxs[0] for match in component_matches[component_idx + 1])
+            component_matches[component_idx] = [match for match in component_matches[component_idx] if self._has_continuation(next_firsts, match.token_idxs[-1])]
+
+        if not all(component_matches):
+            return []
+
+        partial_matches = [(match.token_idxs, match.features, match.texts) for match in component_matches[0]]
+        for matches in component_matches[1:]:
+            matches = sorted(matches, key=lambda match: match.token_idxs[0])
+            firsts = [match.token_idxs[0] for match in matches]
+
+            next_partial_matches = []
+            for token_idxs, features, texts in partial_matches:
+                start, end = self._continuations(firsts, token_idxs[-1])
+                for match in matches[start:end]:
+                    next_partial_matches.append((token_idxs + match.token_idxs, features + match.features, texts + match.texts))
+            partial_matches = next_partial_matches
+
+        return list(set(Match(token_idxs, features, texts) for token_idxs, features, texts in partial_matches))
+
+    def _has_continuation(self, firsts, last_token_idx):
+        start, end = self._continuations(firsts, last_token_idx)
+        return start < end
+
+    def _continuations(self, firsts, last_token_idx):
+        return (bisect.bisect_left(firsts, last_token_idx + self._min_gap),
+                bisect.bisect_right(firsts, last_token_idx + self._max_gap))
+
+    def _is_chained(self, token_idxs):
+        return all(self._min_gap <= next_token_idx - prev_token_idx <= self._max_gap for prev_token_idx, next_token_idx in zip(token_idxs, token_idxs[1:]))
+
+def _match_components(components, layer_dict, leaf_matches):
+    """Returns the matches of every component, or None as soon as a component has none."""
+    component_matches = []
+    for component in components:
+        matches = component.match(layer_dict, leaf_matches)
+        if not matches:
+            return None
+        component_matches.append(matches)
+    return component_matches
+
+def _merge_matches(matches):
+    token_idxs = []
+    features = []
+    texts = []
+
+    for match in matches:
+        token_idxs.extend(match.token_idxs)
+        features.extend(match.features)
+        texts.extend(match.texts)
+
+    return Match(token_idxs, features, texts)
+
 def filter_matches_for_highlight(matches):
     pass
 
@@ -1,3 +1,210 @@
-from django.test import TestCase
+import fnmatch
+import json
+import random
+import re
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from . import multilayer_matcher as matcher
+from .elastic_grammar_query import build_prefilter, get_prefilter_fields
+from .grammar_runner import GrammarPageIndex, GrammarRunner, get_feature_dict
+from .views import generate_instructions
+
+
+def _random_instruction(rng, depth=0):
+    if depth >= 2 or rng.random() < 0.4:
+        layer = rng.choice(['text', 'text.lemmas'])
+        if rng.random() < 0.5:
+            return matcher.Exact(rng.sample(['tere', 'pere', 'kere', 'ohsa', 'mis'], rng.randint(1, 3)), layer)
+        return matcher.Regex(rng.choice(['.ere', r'o\w+', r'[mk]\w*']), layer)
+
+    components = [_random_instruction(rng, depth + 1) for _ in range(rng.randint(1, 3))]
+    operation = rng.choice(['gap', 'concat', 'intersect', 'union'])
+    if operation == 'gap':
+        return matcher.Gap(components, slop=rng.choice([None, 1, 2, 3]))
+    return {'concat': matcher.Concatenation, 'intersect': matcher.Intersection, 'union': matcher.Union}[operation](components)
+
+
+class MatchPlanTest(SimpleTestCase):
+
+    def test_plan_matches_equal_instruction_matches(self):
+        rng = random.Random(0)
+        words = ['tere', 'pere', 'kere', 'ohsa', 'mis', 'sa', 'ikka']
+
+        for _ in range(500):
+            text = ' '.join(rng.choice(words) for _ in range(rng.randint(0, 12)))
+            lemmas = ' '.join(rng.choice(words) for _ in text.split())
+            instruction = _random_instruction(rng)
+
+            layer_dict = matcher.LayerDict({'text': text, 'text.lemmas': lemmas})
+            expected = set(instruction.match(layer_dict))
+            result = matcher.compile_plan(instruction).match(matcher.LayerDict({'text': text, 'text.lemmas': lemmas}))
+
+            self.assertEqual(len(set(result)), len(result))
+            self.assertEqual(expected, set(result))
+
+    def test_token_texts(self):
+        layer_dict = matcher.LayerDict({'text': 'tere  ohsa tere pere '})
+        matches = matcher.compile_plan(matcher.Gap([matcher.Exact(['ohsa'], 'text'), matcher.Exact(['pere'], 'text')], slop=2)).match(layer_dict)
+        self.assertEqual([((1, 3), ('ohsa', 'pere'))], [(match.token_idxs, match.texts) for match in matches])
+
+
+def _random_metaquery(rng, depth=0):
+    if depth >= 2 or rng.random() < 0.4:
+        layer = rng.choice(['comment.text', 'comment.lemmas'])
+        if rng.random() < 0.7:
+            terms = rng.sample(['tere', 'Pere', 'ere', 'tere pere', 'ohsa-mis', 'sa', '-'], rng.randint(1, 2))
+            return {'operation': 'exact', 'layer': layer, 'terms': terms, 'sensitive': rng.random() < 0.5}
+        return {'operation': 'regex', 'layer': layer, 'expression': rng.choice(['.ere', r'o\w+']), 'sensitive': False}
+
+    operation = rng.choice(['gap', 'concat', 'intersect', 'union'])
+    metaquery = {'operation': operation, 'components': [_random_metaquery(rng, depth + 1) for _ in range(rng.randint(1, 3))]}
+    if operation == 'gap':
+        metaquery.update(slop=rng.choice([1, 2, 3]), matchFirst=False)
+    return metaquery
+
+
+def _random_documents(rng, count):
+    words = ['tere', 'Tere', 'pere', 'kere', 'ohsa-mis', 'mis', 'sa', 'ikka', 'peretere']
+    documents = []
+    for doc_idx in range(count):
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 8)))
+        lemmas = ' '.join(rng.choice(words) for _ in text.split())
+        documents.append({'_index': rng.choice(['texts_a', 'texts_b']), '_type': 'texts', '_id': '{0:05d}'.format(doc_idx),
+                          '_source': {'comment': {'text': text, 'lemmas': lemmas}}})
+    return documents
+
+
+def _evaluate(query, source, matched_names):
+    """Evaluates the queries used by GrammarRunner, fields are tokenized to lowercase runs of word characters."""
+    if 'match_all' in query:
+        return True
+
+    if 'wildcard' in query:
+        (path, pattern), = query['wildcard'].items()
+        value = source
+        for path_component in path.split('.'):
+            value = value.get(path_component, '') if isinstance(value, dict) else ''
+        return any(fnmatch.fnmatchcase(token, pattern) for token in re.findall(r'\w+', value.lower()))
+
+    bool_query = query['bool']
+    required = [_evaluate(sub_query, source, matched_names) for sub_query in bool_query.get('must', []) + bool_query.get('filter', [])]
+    optional = [_evaluate(sub_query, source, matched_names) for sub_query in bool_query.get('should', [])]
+    matched = all(required) and (any(optional) or bool(required) or not optional)
+    if matched and '_name' in bool_query:
+        matched_names.add(bool_query['_name'])
+    return matched
+
+
+class _FakeElastic(object):
+    es_url = 'http://localhost:9200'
+
+    def __init__(self, documents):
+        self.documents = sorted(documents, key=lambda document: (document['_index'], document['_id']))
+        self.fetched = 0
+
+    def stringify_datasets(self):
+        return 'texts_a,texts_b'
+
+    def perform_query(self, query):
+        hits = []
+        for document in self.documents:
+            matched_names = set()
+            if _evaluate(query['query'], document['_source'], matched_names):
+                hits.append(dict(document, sort=[document['_index'], document['_id']], matched_queries=sorted(matched_names)))
+
+        total = len(hits)
+        if 'search_after' in query:
+            hits = [hit for hit in hits if hit['sort'] > query['search_after']]
+        hits = hits[:query.get('size', 10)]
+        self.fetched += len(hits)
+        return {'hits': {'total': total, 'hits': hits}}
+
+    def plain_post(self, url, data):
+        documents = {(document['_index'], document['_type'], document['_id']): document for document in self.documents}
+        return {'docs': [dict(documents[(doc['_index'], doc['_type'], doc['_id'])], found=True) for doc in json.loads(data)['docs']]}
+
+
+def _is_matched(instructions, document):
+    return bool(instructions.match(matcher.LayerDict(get_feature_dict(document['_source']))))
+
+
+class PrefilterTest(SimpleTestCase):
+
+    def test_prefilter_keeps_matched_documents(self):
+        rng = random.Random(0)
+        documents = _random_documents(rng, 40)
+        filtered_out = 0
+
+        for _ in range(300):
+            metaquery = _random_metaquery(rng)
+            instructions = generate_instructions(metaquery)
+            prefilter = build_prefilter(metaquery)
+
+            for document in documents:
+                passes_prefilter = prefilter is None or _evaluate(prefilter, document['_source'], set())
+                if _is_matched(instructions, document):
+                    self.assertTrue(passes_prefilter, msg=(metaquery, document))
+                filtered_out += not passes_prefilter
+
+        self.assertGreater(filtered_out, 0)
+
+    def test_prefilter_fields(self):
+        mapping_schema = {
+            'texts_a': {'mappings': {'texts': {'properties': {
+                'comment': {'properties': {'text': {'type': 'text'}, 'lemmas': {'type': 'text', 'analyzer': 'whitespace'}}},
+                'title': {'type': 'text'}, 'tag': {'type': 'keyword'}}}}},
+            'texts_b': {'mappings': {'texts': {'properties': {'title': {'type': 'keyword'}}}}},
+        }
+        self.assertEqual({'comment.text'}, get_prefilter_fields(mapping_schema))
+
+        metaquery = {'operation': 'union', 'components': [{'operation': 'exact', 'layer': 'comment.text', 'terms': ['tere'], 'sensitive': False},
+                                                          {'operation': 'exact', 'layer': 'comment.lemmas', 'terms': ['pere'], 'sensitive': False}]}
+        self.assertIsNone(build_prefilter(metaquery, {'comment.text'}))
+        metaquery['operation'] = 'intersect'
+        self.assertEqual({'wildcard': {'comment.text': '*tere*'}}, build_prefilter(metaquery, {'comment.text'}))
+
+
+class GrammarRunnerTest(TestCase):
+
+    def setUp(self):
+        rng = random.Random(1)
+        self.documents = _random_documents(rng, 150)
+        self.metaquery = {'operation': 'concat', 'components': [{'operation': 'exact', 'layer': 'comment.text', 'terms': ['tere'], 'sensitive': False},
+                                                                {'operation': 'regex', 'layer': 'comment.text', 'expression': '.ere', 'sensitive': False}]}
+        self.instructions = generate_instructions(self.metaquery)
+        self.author = User.objects.create(username='grammar_runner')
+
+    def _get_runner(self, es_m, positive, processes=1):
+        return GrammarRunner(es_m, {'query': {'match_all': {}}}, self.instructions, build_prefilter(self.metaquery), positive=positive, processes=processes)
+
+    def test_documents_equal_matched_documents(self):
+        for positive in [True, False]:
+            expected = [document['_id'] for document in _FakeElastic(self.documents).documents if _is_matched(self.instructions, document) == positive]
+            self.assertTrue(expected)
+
+            for processes in [1, 2]:
+                runner = self._get_runner(_FakeElastic(self.documents), positive, processes)
+                self.assertEqual(expected, [hit['_id'] for hit in runner.iter_documents()])
+
+    def test_page_index(self):
+        es_m = _FakeElastic(self.documents)
+        expected = [document['_id'] for document in es_m.documents if _is_matched(self.instructions, document)]
+        page_length = 7
+        page_count = (len(expected) + page_length - 1) // page_length
+
+        page_index = GrammarPageIndex(self._get_runner(es_m, True), self.metaquery, page_length, search_id=-1,
+                                      inclusive_grammar=-1, exclusive_grammar=-1, polarity='positive', author=self.author)
+        self.assertEqual(expected[2 * page_length:3 * page_length], [hit['_id'] for hit in page_index.get_page_hits(3)])
+        self.assertGreater(page_index.get_total(), len(expected))
+
+        # Pages before the furthest one are fetched from the index without searching.
+        fetched = es_m.fetched
+        for page in [1, 2, 3]:
+            self.assertEqual(expected[(page - 1) * page_length:page * page_length], [hit['_id'] for hit in page_index.get_page_hits(page)])
+        self.assertEqual(fetched, es_m.fetched)
+
+        self.assertEqual(expected[(page_count - 1) * page_length:], [hit['_id'] for hit in page_index.get_page_hits(page_count)])
+        self.assertEqual([], page_index.get_page_hits(page_count + 1))
+        self.assertEqual(len(expected), page_index.get_total())
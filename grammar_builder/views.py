@@ -5,33 +5,29 @@ import pprint
 from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.template import loader, Context
 from django.contrib.auth.decorators import login_required
-import requests
 
 from searcher.views import Search
 from utils.datasets import Datasets
 from utils.es_manager import ES_Manager
 
-from texta.settings import STATIC_URL, URL_PREFIX, es_url
+from texta.settings import STATIC_URL, URL_PREFIX
 
 from task_manager.models import Task
 from task_manager.tasks.task_types import TaskTypes
 from permission_admin.models import Dataset
 from conceptualiser.models import Term, TermConcept, Concept
-from grammar_builder.models import GrammarComponent, GrammarPageMapping, Grammar
+from grammar_builder.models import GrammarComponent, Grammar
 from . import multilayer_matcher as matcher
 
-from .elastic_grammar_query import ElasticGrammarQuery
+from .elastic_grammar_query import build_prefilter, get_prefilter_fields
+from .grammar_runner import GrammarPageIndex, GrammarRunner, get_feature_dict
 
 from collections import defaultdict
+from contextlib import closing
 
 import csv
 
-import sys, os
-
-try:
-    from io import BytesIO
-except:
-    from io import StringIO
+from io import StringIO
 
 ES_SCROLL_BATCH = 100
 
@@ -171,7 +167,7 @@ def generate_instructions(metaquery_dict):
 
             return operation_to_class[component_dict['operation']](sub_instructions)
 
-    return generation_helper(metaquery_dict)
+    return matcher.compile_plan(generation_helper(metaquery_dict))
 
 @login_required
 def get_table(request):
@@ -269,85 +265,63 @@ def export_matched_data(request):
 
     inclusive_metaquery = json.loads(request.GET['inclusive_grammar'])
 
-    ds = Datasets().activate_dataset(request.session)
-
-    component_query = ElasticGrammarQuery(inclusive_metaquery, None).generate()
-
+    ds = Datasets().activate_datasets(request.session)
     es_m = ds.build_manager(ES_Manager)
 
     if search_id == '-1': # Full search
-        es_m.combined_query = component_query
+        query = {'query': {'match_all': {}}}
     else:
-        saved_query = json.loads(Search.objects.get(pk=search_id).query)
-        es_m.load_combined_query(saved_query)
-        es_m.merge_combined_query_with_query_dict(component_query)
+        query = json.loads(Search.objects.get(pk=search_id).query)['main']
 
-    inclusive_instructions = generate_instructions(inclusive_metaquery)
+    features = sorted([json.loads(field_mapping)['path'] for field_mapping in es_m.get_mapped_fields()])
 
-    response = StreamingHttpResponse(get_all_matched_rows(es_m.combined_query['main'], request, inclusive_instructions), content_type='text/csv')
+    runner = get_grammar_runner(es_m, query, inclusive_metaquery, positive=True)
+
+    response = StreamingHttpResponse(get_all_matched_rows(runner, features), content_type='text/csv')
 
     response['Content-Disposition'] = 'attachment; filename="%s"' % ('extracted.csv')
 
     return response
 
-def get_all_matched_rows(query, request, inclusive_instructions):
+def get_grammar_runner(es_m, query, inclusive_metaquery, positive, features=None):
+    """Builds a GrammarRunner for the search, pre-filtered by the literal terms of the grammar."""
+    prefilter = build_prefilter(inclusive_metaquery, get_prefilter_fields(es_m.get_mapping_schema()))
+    return GrammarRunner(es_m, query, generate_instructions(inclusive_metaquery), prefilter, positive=positive, features=features)
+
+def get_all_matched_rows(runner, features):
     buffer_ = StringIO()
     writer = csv.writer(buffer_)
 
-    ds = Datasets().activate_dataset(request.session)
-    es_m = ds.build_manager(ES_Manager)
-
-    features = sorted([field['path'] for field in es_m.get_mapped_fields()])
-
-    query['size'] = ES_SCROLL_BATCH
-
     writer.writerow(features)
 
-    ds.get_index()
-    ds.get_mapping()
-    es_url
-
-    request_url = os.path.join(es_url, ds.get_index(), ds.get_mapping(), '_search?scroll=1m')
-    response = requests.get(request_url, data=json.dumps(query)).json()
-
-    scroll_id = response['_scroll_id']
-    hits = response['hits']['hits']
-
-    scroll_payload = json.dumps({'scroll':'1m', 'scroll_id':scroll_id})
-    while hits:
-        for hit in hits:
-            feature_dict = {feature_name:hit['_source'][feature_name] for feature_name in hit['_source']}
-
-            feature_dict = {}
-
+    with closing(runner.iter_documents()) as documents:
+        for hit_idx, hit in enumerate(documents, 1):
             row = []
             for feature_name in features:
                 feature_path = feature_name.split('.')
                 parent_source = hit['_source']
                 for path_component in feature_path:
-                    if path_component in parent_source:
+                    if isinstance(parent_source, dict) and path_component in parent_source:
                         parent_source = parent_source[path_component]
                     else:
                         parent_source = ""
                         break
 
-                content = parent_source
-                row.append(content)
-                feature_dict[feature_name] = content
+                row.append(parent_source)
+
+            writer.writerow(row)
 
-            layer_dict = matcher.LayerDict(feature_dict)
-            if inclusive_instructions.match(layer_dict):
-                writer.writerow([element.encode('utf-8') if isinstance(element,unicode) else element for element in row])
+            if hit_idx % ES_SCROLL_BATCH == 0:
+                yield _get_buffer_data(buffer_)
 
-        buffer_.seek(0)
-        data = buffer_.read()
-        buffer_.seek(0)
-        buffer_.truncate()
-        yield data
+    yield _get_buffer_data(buffer_)
 
-        response = requests.get(os.path.join(es_url,'_search','scroll'), data=scroll_payload).json()
-        hits = response['hits']['hits']
-        scroll_id = response['_scroll_id']
+def _get_buffer_data(buffer_):
+    buffer_.seek(0)
+    data = buffer_.read()
+    buffer_.seek(0)
+    buffer_.truncate()
+    return data
 
 @login_required
 def get_table_data(request):
@@ -355,7 +329,7 @@ def get_table_data(request):
 
     query_data['search_id'] = request.GET['search_id']
     query_data['polarity'] = request.GET['polarity']
-    query_data['requested_page'] = int(request.GET['iDisplayStart'])/int(request.GET['iDisplayLength'])+1
+    query_data['requested_page'] = int(request.GET['iDisplayStart'])//int(request.GET['iDisplayLength'])+1
     query_data['page_length'] = int(request.GET['iDisplayLength'])
 
     if request.GET['is_test'] == 'true':
@@ -375,177 +349,52 @@ def get_table_data(request):
 
         query_data['features'] = sorted(extract_layers(query_data['inclusive_metaquery']) | extract_layers(query_data['exclusive_metaquery']))
 
-
-    GrammarPageMapping.objects.filter(search_id=query_data['search_id'],
-                                    inclusive_grammar=query_data['inclusive_grammar_id'],
-                                    exclusive_grammar=query_data['exclusive_grammar_id'],
-                                    polarity=query_data['polarity'], author=request.user).delete()
-
-
-    ds = Datasets().activate_dataset(request.session)
-
-    query_data['dataset'] = ds.get_index()
-    query_data['mapping'] = ds.get_mapping()
-
-    component_query = ElasticGrammarQuery(query_data['inclusive_metaquery'], None).generate()
-
+    ds = Datasets().activate_datasets(request.session)
     es_m = ds.build_manager(ES_Manager)
-    if query_data['search_id'] != '-1':
-        saved_query = json.loads(Search.objects.get(pk=query_data['search_id']).query)
-        es_m.load_combined_query(saved_query)
 
-        if query_data['polarity'] == 'positive':
-            es_m.merge_combined_query_with_query_dict(component_query)
+    if query_data['search_id'] != '-1':
+        query = json.loads(Search.objects.get(pk=query_data['search_id']).query)['main']
     else:
-        #es_m.combined_query = {"main": {"query": {"bool": {"should": [{"match_all":{}}], "must": [], "must_not": []}}},
-                                #"facts": {"include": [], 'total_include': 0,
-                                     #"exclude": [], 'total_exclude': 0}}
-        es_m.combined_query = {"main": {"query":{"match_all":{}}}}
-        if query_data['polarity'] == 'positive':
-            es_m.combined_query = component_query
-
-    # Add paging data to the query
-    #es_m.set_query_parameter('from', request.session['grammar_'+polarity+'_cursor'])
-    es_m.set_query_parameter('size', request.GET['iDisplayLength'])
-    es_m.set_query_parameter('_source', query_data['features'])
-
-    query_data['inclusive_instructions'] = generate_instructions(query_data['inclusive_metaquery'])
-    query_data['exclusive_instructions'] = {} #generate_instructions(query_data['exclusive_metaquery'])
-
-    data = scroll_data(es_m.combined_query['main'], request, query_data)
-    data['sEcho'] = request.GET['sEcho']
-
-    return HttpResponse(json.dumps(data,ensure_ascii=False))
-
-
-def scroll_data(query,request, query_data):
-    out = {'aaData':[],'iTotalRecords':0,'iTotalDisplayRecords':0}
+        query = {'query': {'match_all': {}}}
 
     positive_polarity = query_data['polarity'] == 'positive'
+    runner = get_grammar_runner(es_m, query, query_data['inclusive_metaquery'], positive_polarity, features=query_data['features'])
 
-    rows = out['aaData']
-    target_row_no = query_data['page_length']
-
-    grammar_page_mapping = GrammarPageMapping.objects.filter(search_id=query_data['search_id'],
-                                                             inclusive_grammar=query_data['inclusive_grammar_id'],
-                                                            exclusive_grammar=query_data['exclusive_grammar_id'],
-                                                            page=query_data['requested_page'], polarity=query_data['polarity'],
-                                                            author=request.user)
-
-    if grammar_page_mapping:
-        es_from = grammar_page_mapping[0].elastic_start
-    else:
-        ordered_pages = GrammarPageMapping.objects.filter(search_id=query_data['search_id'],
-                                                          inclusive_grammar=query_data['inclusive_grammar_id'],
-                                                            exclusive_grammar=query_data['exclusive_grammar_id'],
-                                                            polarity=query_data['polarity'], author=request.user).order_by('-page')
-        if ordered_pages:
-            max_stored_page, es_from = ordered_pages[0].page, ordered_pages[0].elastic_end
-        else:
-            max_stored_page, es_from = 0, 0
-
-        es_from = get_es_from(max_stored_page, es_from, request, query, query_data)
-
-    page_data = get_next_page_data(query, es_from, 0, query_data, request)
-    rows.extend(page_data['rows'])
-
-    out['iTotalRecords'] = page_data['total']
-    out['iTotalDisplayRecords'] = page_data['total']
-    return out
-
-def get_es_from(max_stored_page, es_from, request, query, query_data):
-    current_page = max_stored_page
-    requested_page = query_data['requested_page']
-    es_from = es_from
-    last_end = es_from
-
-    while current_page < requested_page and es_from != None:
-        page_data = get_next_page_data(query, last_end, current_page, query_data, request)
-        es_from = page_data['from']
-        last_end = page_data['end']
-        current_page = page_data['page']
-
-    return es_from
-
+    page_index = GrammarPageIndex(runner, query_data['inclusive_metaquery'], query_data['page_length'],
+                                  search_id=int(query_data['search_id']), inclusive_grammar=int(query_data['inclusive_grammar_id']),
+                                  exclusive_grammar=int(query_data['exclusive_grammar_id']), polarity=query_data['polarity'],
+                                  author=request.user)
+    if request.GET['sEcho'] == '1':
+        # A newly drawn table searches the documents again, later draws page through the stored pages.
+        page_index.reset()
 
-def get_next_page_data(query, es_from, last_page, query_data, request):
-    start_from = None
-    end = None
-    rows = []
-    page_length = query_data['page_length']
+    # Only the rows of matched documents have something to highlight.
+    inclusive_instructions = generate_instructions(query_data['inclusive_metaquery']) if positive_polarity else None
+    rows = [get_row(hit, inclusive_instructions) for hit in page_index.get_page_hits(query_data['requested_page'])]
 
-    if es_from == None:
-        return {'rows':rows,'from':start_from,'page':last_page,'end':None, 'total':None}
+    total = page_index.get_total()
+    data = {'aaData': rows, 'iTotalRecords': total, 'iTotalDisplayRecords': total, 'sEcho': request.GET['sEcho']}
 
-    dataset = query_data['dataset']
-    mapping = query_data['mapping']
-    polarity = query_data['polarity']
-
-    inclusive_instructions = query_data['inclusive_instructions']
-    exclusive_instructions = query_data['exclusive_instructions']
-
-    query['from'] = es_from
-    response = ES_Manager.plain_search(es_url, dataset, mapping, query)
-
-    try:
-        hit = response['hits']['hits'][0]
-        feature_dict = {feature_name:hit['_source'][feature_name][0] for feature_name in hit['_source']}
-        sorted_feature_names = sorted(feature_dict)
-        feature_to_idx_map = {feature: (feature_idx+1) for feature_idx, feature in enumerate(sorted_feature_names)}
-    except:
-        pass
-
-    hit_idx = page_length-1
-
-    while len(rows) < page_length and 'hits' in response and 'hits' in response['hits'] and response['hits']['hits'] and hit_idx+1 == page_length:
-        for hit_idx, hit in enumerate(response['hits']['hits']):
-            if len(rows) >= page_length:
-                break
-
-            feature_dict = {}
-
-            for field_name in hit['_source']:
-                field_value = hit['_source'][field_name]
-                if isinstance(field_value, dict):
-                    for subfield_name, subfield_value in field_value.items():
-                        combined_field_name = '{0}.{1}'.format(field_name, subfield_name)
-                        feature_dict[combined_field_name] = subfield_value
-                else:
-                    feature_dict[field_name] = field_value
-
-            sorted_feature_names = sorted(feature_dict)
-
-            feature_to_idx_map = defaultdict(list)
-            for feature_idx, feature in enumerate(sorted_feature_names):
-                feature_to_idx_map[feature.split('.')[0]].append(feature_idx+1)
-
-            row = [hit['_id']]
-            row.extend([feature_dict[feature_name] for feature_name in sorted_feature_names])
-            layer_dict = matcher.LayerDict(feature_dict)
-
-            inclusive_matches = inclusive_instructions.match(layer_dict)
-
-            if (polarity == 'positive') == bool(inclusive_matches): # add row if polarity is positive and we have a match or negative and dont
-                if len(rows) == 0:
-                    start_from = query['from'] + hit_idx
-                end = query['from'] + hit_idx
+    return HttpResponse(json.dumps(data,ensure_ascii=False))
 
-                if inclusive_matches:
-                    row = highlight(row, feature_to_idx_map, inclusive_matches)
+def get_row(hit, inclusive_instructions=None):
+    """Returns the document id and its features in sorted order, features highlighted with the grammar matches."""
+    feature_dict = get_feature_dict(hit['_source'])
+    sorted_feature_names = sorted(feature_dict)
 
-                rows.append(row)
+    feature_to_idx_map = defaultdict(list)
+    for feature_idx, feature in enumerate(sorted_feature_names):
+        feature_to_idx_map[feature.split('.')[0]].append(feature_idx+1)
 
-        query['from'] = query['from'] + hit_idx + 1
+    row = [hit['_id']]
+    row.extend([feature_dict[feature_name] for feature_name in sorted_feature_names])
 
-        if len(rows) >= page_length:
-            break
-        response = ES_Manager.plain_search(es_url, dataset, mapping,query)
-    if end:
-        GrammarPageMapping(search_id=query_data['search_id'], inclusive_grammar=query_data['inclusive_grammar_id'],
-                        exclusive_grammar=query_data['exclusive_grammar_id'], page=query_data['requested_page'], polarity=query_data['polarity'],
-                        elastic_start=start_from, elastic_end=end+1, author=request.user).save()
+    if inclusive_instructions is not None:
+        inclusive_matches = inclusive_instructions.match(matcher.LayerDict(feature_dict))
+        if inclusive_matches:
+            row = highlight(row, feature_to_idx_map, inclusive_matches)
 
-    return {'rows':rows,'from':start_from,'page':last_page+1,'end':(end+(0 if last_page == 0 else 1)) if end else end, 'total':response['hits']['total']}
+    return row
 
 def highlight(row, feature_to_idx_map, inclusive_matches):
     colours = defaultdict(lambda: defaultdict(list))
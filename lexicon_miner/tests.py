@@ -5,7 +5,24 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import time
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+import psutil
+from scipy.stats import beta
+from django.test import SimpleTestCase, TestCase
+
+from utils import model_manager
+from utils.gensim_wrapper.ann_index import HnswIndex, IvfIndex, hnswlib
+from utils.gensim_wrapper.masked_word2vec import MaskedWord2Vec, top_k
+from utils.precluster import PreclusterMaker
+from utils.robust_rank_aggregation import aggregate_ranks, rank_matrix
 
 
 class SimpleTest(TestCase):
@@ -15,6 +32,194 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+def _clustered_word2vec(vocabulary_size, dim=50, clusters=500, seed=0):
+    """Fake word2vec model with normalized vectors scattered around random cluster centers."""
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(clusters, dim)
+    vectors = centers[rng.randint(clusters, size=vocabulary_size)] + 0.5 * rng.randn(vocabulary_size, dim)
+    vectors = (vectors / np.linalg.norm(vectors, axis=1)[:, np.newaxis]).astype(np.float32)
+
+    index2word = ['word_{0}'.format(idx) for idx in range(vocabulary_size)]
+    wv = types.SimpleNamespace(vocab={word: types.SimpleNamespace(index=idx) for idx, word in enumerate(index2word)},
+                               syn0norm=vectors, index2word=index2word)
+    return types.SimpleNamespace(wv=wv, init_sims=lambda: None)
+
+
+def _ann_recall(exact_model, ann_model, queries, method, topn=40, ignored_idxes=()):
+    found = 0
+    for query in queries:
+        expected = {word for word, _ in getattr(exact_model, method)(positive=query, topn=topn, ignored_idxes=list(ignored_idxes))}
+        found += len(expected & {word for word, _ in getattr(ann_model, method)(positive=query, topn=topn, ignored_idxes=list(ignored_idxes))})
+    return found / (len(queries) * topn)
+
+
+class AnnIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self.model = _clustered_word2vec(20000)
+        self.exact = MaskedWord2Vec(self.model)
+        self.ivf = MaskedWord2Vec(self.model, IvfIndex.build(self.model.wv.syn0norm))
+        rng = np.random.RandomState(1)
+        self.queries = [['word_{0}'.format(idx) for idx in rng.randint(20000, size=rng.randint(1, 4))] for _ in range(20)]
+
+    def test_ivf_recall(self):
+        self.assertGreater(_ann_recall(self.exact, self.ivf, self.queries, 'most_similar'), 0.9)
+        self.assertGreater(_ann_recall(self.exact, self.ivf, self.queries, 'most_similar_cosmul'), 0.9)
+
+    def test_ignored_idxes_are_not_returned(self):
+        ignored_idxes = [self.model.wv.vocab[word].index for word, _ in self.exact.most_similar(positive=['word_0'], topn=20)]
+        result = self.ivf.most_similar(positive=['word_0'], topn=40, ignored_idxes=ignored_idxes)
+
+        self.assertEqual(len(result), 40)
+        self.assertFalse({self.model.wv.index2word[idx] for idx in ignored_idxes} & {word for word, _ in result})
+        self.assertNotIn('word_0', {word for word, _ in result})
+
+    @unittest.skipUnless(os.getenv('TEXTA_RUN_BENCHMARKS'), 'Set TEXTA_RUN_BENCHMARKS to run benchmarks.')
+    def test_benchmark_recall_and_latency(self):
+        model = _clustered_word2vec(1000000, dim=100, clusters=5000)
+        exact = MaskedWord2Vec(model)
+        rng = np.random.RandomState(1)
+        queries = [['word_{0}'.format(idx)] for idx in rng.randint(len(model.wv.index2word), size=50)]
+
+        index_classes = [IvfIndex] + ([HnswIndex] if hnswlib is not None else [])
+        for index_class in index_classes:
+            start_time = time.time()
+            ann = MaskedWord2Vec(model, index_class.build(model.wv.syn0norm))
+            build_time = time.time() - start_time
+
+            latencies = []
+            for searcher in (exact, ann):
+                start_time = time.time()
+                for query in queries:
+                    searcher.most_similar(positive=query, topn=40)
+                latencies.append((time.time() - start_time) / len(queries))
+
+            print('{0}: build {1:.1f}s, recall@40 {2:.3f}, exact {3:.2f}ms, approximate {4:.2f}ms per query'.format(
+                index_class.__name__, build_time, _ann_recall(exact, ann, queries, 'most_similar'), latencies[0] * 1000, latencies[1] * 1000))
+
+
+class MaskedWord2VecTest(SimpleTestCase):
+
+    def setUp(self):
+        self.model = MaskedWord2Vec(_clustered_word2vec(5000))
+        rng = np.random.RandomState(1)
+        self.positives = [['word_{0}'.format(idx) for idx in rng.randint(5000, size=rng.randint(1, 4))] for _ in range(40)]
+        self.negatives = [['word_{0}'.format(idx) for idx in rng.randint(5000, size=rng.randint(0, 2))] for _ in range(40)]
+        self.ignored_idxes = list(rng.randint(5000, size=100))
+
+    def test_top_k_equals_argsort(self):
+        dists = np.random.RandomState(0).rand(10000).astype(np.float32)
+        for k in [1, 40, 10000, 20000]:
+            self.assertEqual(list(np.argsort(dists)[::-1][:k]), list(top_k(dists, k)))
+
+    def test_batch_equals_single_queries(self):
+        for method in ['most_similar', 'most_similar_cosmul']:
+            batch_results = getattr(self.model, method + '_batch')(self.positives, self.negatives, topn=40, ignored_idxes=self.ignored_idxes)
+            for positive, negative, batch_result in zip(self.positives, self.negatives, batch_results):
+                result = getattr(self.model, method)(positive=positive, negative=negative, topn=40, ignored_idxes=self.ignored_idxes)
+                self.assertEqual({word for word, _ in result}, {word for word, _ in batch_result})
+                np.testing.assert_allclose([dist for _, dist in result], [dist for _, dist in batch_result], rtol=1e-5)
+
+    @unittest.skipUnless(os.getenv('TEXTA_RUN_BENCHMARKS'), 'Set TEXTA_RUN_BENCHMARKS to run benchmarks.')
+    def test_benchmark_million_word_vocabulary(self):
+        model = MaskedWord2Vec(_clustered_word2vec(1000000, dim=100, clusters=5000))
+        rng = np.random.RandomState(1)
+        positives = [['word_{0}'.format(idx)] for idx in rng.randint(1000000, size=50)]
+        dists = model.most_similar(positive=positives[0], topn=0)
+
+        start_time = time.time()
+        for _ in range(10):
+            np.argsort(dists)[::-1][:40]
+        argsort_time = (time.time() - start_time) / 10
+
+        start_time = time.time()
+        for _ in range(10):
+            top_k(dists, 40)
+        top_k_time = (time.time() - start_time) / 10
+
+        start_time = time.time()
+        for positive in positives:
+            model.most_similar(positive=positive, topn=40)
+        single_time = time.time() - start_time
+
+        start_time = time.time()
+        model.most_similar_batch(positives, topn=40)
+        batch_time = time.time() - start_time
+
+        print('1M words: argsort {0:.1f}ms, top_k {1:.1f}ms, {2} queries one by one {3:.2f}s, batched {4:.2f}s'.format(
+            argsort_time * 1000, top_k_time * 1000, len(positives), single_time, batch_time))
+
+
+def _loop_aggregate_ranks(glist):
+    """Reference implementation the vectorised rank aggregation replaced."""
+    names = sorted(set(element for l in glist for element in l))
+    rmat = np.ones(shape=(len(names), len(glist)))
+    for col in range(len(glist)):
+        rows = [names.index(i) for i in glist[col]]
+        for ind, row in enumerate(rows):
+            rmat[row, col] = (1.0 + ind) / len(names)
+
+    scores = []
+    for row in rmat:
+        x = np.sort(row)
+        p = beta.cdf(x=x, a=np.arange(1, x.size + 1), b=np.arange(x.size, 0, -1))
+        scores.append(min(p.min() * x.size, 1))
+    return rmat, names, sorted(zip(names, scores), key=lambda x: x[1])
+
+
+class RobustRankAggregationTest(SimpleTestCase):
+
+    def test_equals_loop_implementation(self):
+        rng = np.random.RandomState(0)
+        vocabulary = ['term_{0}'.format(idx) for idx in range(3000)]
+
+        for _ in range(5):
+            glist = [list(rng.choice(vocabulary, size=rng.randint(1, 200), replace=False)) for _ in range(rng.randint(1, 10))]
+            expected_rmat, expected_names, expected_ranks = _loop_aggregate_ranks(glist)
+
+            rmat, names = rank_matrix(glist)
+            self.assertEqual(expected_names, names)
+            np.testing.assert_array_equal(expected_rmat, rmat)
+
+            ranks = aggregate_ranks(glist)
+            self.assertEqual(dict(expected_ranks).keys(), dict(ranks).keys())
+            for name, score in ranks:
+                self.assertAlmostEqual(dict(expected_ranks)[name], score)
+
+    def test_empty_lists(self):
+        self.assertEqual([], aggregate_ranks([[], []]))
+
+
+def _clustered_vectors(words, clusters, dim=50, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(clusters, dim)
+    return [centers[idx % clusters] + 0.1 * rng.randn(dim) for idx in range(words)]
+
+
+class PreclusterMakerTest(SimpleTestCase):
+
+    def test_reused_distances_give_same_clusters(self):
+        words = ['word_{0}'.format(idx) for idx in range(300)]
+        vectors = _clustered_vectors(len(words), 7)
+
+        expected = PreclusterMaker(list(words), list(vectors), reuse_distances=False)()
+        result = PreclusterMaker(list(words), list(vectors))()
+        self.assertEqual(len(expected), 7)
+        self.assertEqual(sorted(sorted(label for label, _ in cluster) for cluster in expected),
+                         sorted(sorted(label for label, _ in cluster) for cluster in result))
+
+    @unittest.skipUnless(os.getenv('TEXTA_RUN_BENCHMARKS'), 'Set TEXTA_RUN_BENCHMARKS to run benchmarks.')
+    def test_benchmark_large_lexicon(self):
+        words = ['word_{0}'.format(idx) for idx in range(3000)]
+        vectors = _clustered_vectors(len(words), 30, dim=100)
+
+        for reuse_distances in (True, False):
+            precluster_maker = PreclusterMaker(list(words), list(vectors), reuse_distances=reuse_distances)
+            start_time = time.time()
+            precluster_maker()
+            print('reuse_distances={0}: {1:.2f}s {2}'.format(reuse_distances, time.time() - start_time, precluster_maker.timings))
+
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
@@ -22,3 +227,52 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+
+class ModelMemoryUsageTest(SimpleTestCase):
+
+    def setUp(self):
+        self.models_dir = tempfile.mkdtemp()
+        self.manager = model_manager.ModelManager(300, 60, mmap_vectors=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.models_dir)
+
+    def _model(self, model_uuid, vocabulary_size):
+        """Fake word2vec model with private syn0 and memory-mapped syn0norm, its pages read into memory."""
+        model_path = os.path.join(self.models_dir, 'model_{0}'.format(model_uuid))
+        np.save(model_path + model_manager.NORMALIZED_VECTORS_SUFFIX, np.ones((vocabulary_size, 50), dtype=np.float32))
+        syn0norm = np.load(model_path + model_manager.NORMALIZED_VECTORS_SUFFIX, mmap_mode='r')
+        syn0norm.sum()
+        wv = types.SimpleNamespace(syn0=np.ones((vocabulary_size, 50), dtype=np.float32), syn0norm=syn0norm)
+        return model_path, types.SimpleNamespace(model=types.SimpleNamespace(wv=wv))
+
+    def test_usage_counts_exact_model_files(self):
+        # model_1 is a prefix of the path of model_10, whose pages must not be counted for model_1.
+        for model_uuid, vocabulary_size in [('1', 1000), ('10', 20000)]:
+            model_path, model = self._model(model_uuid, vocabulary_size)
+            self.manager._models[model_uuid] = model_manager.ModelEntry(model, model_path)
+
+        usage = self.manager.get_memory_usage()
+        for model_uuid in ['1', '10']:
+            entry = self.manager._models[model_uuid]
+            mapped_path = os.path.realpath(entry.model_path + model_manager.NORMALIZED_VECTORS_SUFFIX)
+            mapped_rss = sum(memory_map.rss for memory_map in psutil.Process().memory_maps(grouped=True) if os.path.realpath(memory_map.path) == mapped_path)
+            self.assertGreater(mapped_rss, 0)
+            self.assertEqual(mapped_rss + entry.model.model.wv.syn0.nbytes, usage[model_uuid]['resident'])
+            self.assertEqual(mapped_rss, usage[model_uuid]['shared'] + usage[model_uuid]['private'] - entry.model.model.wv.syn0.nbytes)
+
+    def test_usage_is_logged_after_load(self):
+        model_path, model = self._model('1', 1000)
+        with mock.patch.object(model_manager, 'MODELS_DIR', self.models_dir), \
+             mock.patch.object(model_manager, 'TaskTypes', types.SimpleNamespace(TRAIN_MODEL='')), \
+             mock.patch.object(model_manager.ModelManager, '_load_word2vec', return_value=types.SimpleNamespace(vector_size=50)), \
+             mock.patch.object(model_manager, 'load_ann_index'), \
+             mock.patch.object(model_manager, 'MaskedWord2Vec', return_value=model), \
+             mock.patch.object(model_manager.logging, 'getLogger') as get_logger:
+            open(model_path, 'w').close()
+            self.assertIs(model, self.manager.get_model('1'))
+
+        log_dict = get_logger.return_value.info.call_args[1]['extra']
+        self.assertEqual('model_loaded', log_dict['event'])
+        self.assertEqual(self.manager.get_memory_usage('1')['1']['resident'], log_dict['data']['memory_usage']['resident'])
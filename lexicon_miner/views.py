@@ -1,7 +1,9 @@
 # -*- coding: utf8 -*-
+import heapq
 import random
 import json
 import logging
+import time
 
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
@@ -25,6 +27,12 @@ from task_manager.tasks.task_types import TaskTypes
 
 
 model_manager = get_model_manager(expiration_time=300,refresh_time=30)
+
+# Example texts of suggested words are cached per model and datasets for this long.
+EXAMPLE_TEXT_CACHE_SECONDS = 300
+EXAMPLE_TEXT_CACHE_SIZE = 10000
+EXAMPLE_TEXT_FRAGMENT_SIZE = 100
+_example_text_cache = {}
 punct_to_name = {'!': '___exclamation___', ' ': '______', '"': '___quot___', "'": '___apo___', ')': '___r_para___', '(': '___l_para___', '-': '___hyphen___', ',': '___comma___', '/': '___slash___', '.': '___period___', '\\': '___backslash___', ';': '___semicolon___', ':': '___colon___', ']': '___r_bracket___', '[': '___l_bracket___', '?': '___question___', '&':'___and___', '%':'___percentage___'}
 
 
@@ -204,20 +212,67 @@ def selectLexicon(request):
         return HttpResponseRedirect(URL_PREFIX + '/lexicon_miner')
 
 
-def get_example_texts(request, field, value):
+def get_example_texts(request, field, values):
+    """
+    Returns the highlighted example texts of every value, fetched with a single multi-search.
+    Texts are cached per model and active datasets for EXAMPLE_TEXT_CACHE_SECONDS.
+    """
     ds = Datasets().activate_datasets(request.session)
     es_m = ds.build_manager(ES_Manager)
-    query = { "size":10, "highlight": {"fields": {field: {}}}, "query": {"match": {field: value}}}
-    response = es_m.perform_query(query)
-    matched_sentences = []
-    for hit in response['hits']['hits']:
-        for match in hit['highlight'].values():
-            matched_sentences.append(match[0])
-    return matched_sentences
+    datasets = es_m.stringify_datasets()
+    cache_prefix = (request.session['model']['unique_id'], datasets, field)
+    now = time.time()
+
+    example_texts = {}
+    missing_values = []
+    for value in values:
+        cached = _example_text_cache.get(cache_prefix + (value,))
+        if cached and now - cached[0] < EXAMPLE_TEXT_CACHE_SECONDS:
+            example_texts[value] = cached[1]
+        elif value not in missing_values:
+            missing_values.append(value)
+
+    queries = []
+    for value in missing_values:
+        query = {"size": 10, "_source": False, "query": {"match": {field: value}},
+                 "highlight": {"fields": {field: {"fragment_size": EXAMPLE_TEXT_FRAGMENT_SIZE, "number_of_fragments": 1}}}}
+        queries.append(json.dumps({"index": datasets}))
+        queries.append(json.dumps(query))
+
+    if queries:
+        _evict_example_texts(now, EXAMPLE_TEXT_CACHE_SIZE - len(missing_values))
+
+        for value, response in zip(missing_values, es_m.perform_queries(queries)):
+            matched_sentences = []
+            for hit in response.get('hits', {}).get('hits', []):
+                for match in hit.get('highlight', {}).values():
+                    matched_sentences.append(match[0])
+
+            example_texts[value] = matched_sentences
+            _example_text_cache[cache_prefix + (value,)] = (now, matched_sentences)
+
+    return example_texts
+
+
+def _evict_example_texts(now, max_size):
+    """Drops the expired example texts once the cache is over max_size, and the oldest ones if it still is."""
+    if len(_example_text_cache) <= max_size:
+        return
+    for key in [key for key, (cached_at, _) in list(_example_text_cache.items()) if now - cached_at >= EXAMPLE_TEXT_CACHE_SECONDS]:
+        _example_text_cache.pop(key, None)
+
+    overflow = len(_example_text_cache) - max(0, max_size)
+    if overflow > 0:
+        for key, _ in heapq.nsmallest(overflow, list(_example_text_cache.items()), key=lambda item: item[1][0]):
+            _example_text_cache.pop(key, None)
+
+
+def prepare_suggestions(request, suggestions, tooltip_feature):
+    example_texts = get_example_texts(request, tooltip_feature, suggestions)
+    return [prepare_suggestion(suggestion, example_texts.get(suggestion, [])) for suggestion in suggestions]
 
 
-def prepare_suggestion(request, suggestion, tooltip_feature):
-    matched_sentences = get_example_texts(request, tooltip_feature, suggestion)
+def prepare_suggestion(suggestion, matched_sentences):
     matched_sentences = '\n'.join(matched_sentences).replace('"','')
     suggestion = suggestion.replace('_', ' ')
     suggestion = '<div class=\'list_item\' id=\'suggestion_{0}\'>&bull; <a role="button" title="{1}" onclick="javascript:addWord(this,\'{0}\');">{0}</a></div>'.format(suggestion, matched_sentences)
@@ -254,9 +309,7 @@ def query(request):
         tooltip_feature = json.loads(model_run_obj.parameters)['field']
 
         if request.POST['method'][:12] == 'most_similar':
-            for a in getattr(model,request.POST['method'])(positive=positives, topn=40, ignored_idxes=ignored_idxes):
-                suggestion = prepare_suggestion(request, a[0], tooltip_feature)
-                suggestions.append(suggestion)
+            suggestions = prepare_suggestions(request, [a[0] for a in getattr(model,request.POST['method'])(positive=positives, topn=40, ignored_idxes=ignored_idxes)], tooltip_feature)
 
         elif request.POST['method'][:17] == 'simple_precluster':
             method = request.POST['method'][18:]
@@ -266,9 +319,7 @@ def query(request):
             new_positives = labels[selected_cluster]
             label_idxes = [[model.vocab[label].index for label in labels[cluster_idx]] for cluster_idx in range(len(labels))]
             ignored_idxes.extend([label_idxes[cluster_idx][inner_cluster_idx] for cluster_idx in range(len(label_idxes)) if cluster_idx != selected_cluster for inner_cluster_idx in range(len(label_idxes[cluster_idx]))])
-            for a in getattr(model,method)(positive=new_positives,topn=40,ignored_idxes = ignored_idxes):
-                suggestion = prepare_suggestion(request, a[0], tooltip_feature)
-                suggestions.append(suggestion)
+            suggestions = prepare_suggestions(request, [a[0] for a in getattr(model,method)(positive=new_positives,topn=40,ignored_idxes = ignored_idxes)], tooltip_feature)
                 
         elif request.POST['method'][:10] == 'precluster':
             method = request.POST['method'][11:]
@@ -284,7 +335,7 @@ def query(request):
         else:
             #RobustRankAggreg
             _, local_method = request.POST['method'].split()
-            local_suggestions = [[similar[0] for similar in getattr(model,local_method)(positive=[positive],topn=50,ignored_idxes=ignored_idxes) if similar[0] not in positives ] for positive in positives]
+            local_suggestions = [[similar[0] for similar in similars if similar[0] not in positives] for similars in getattr(model,local_method + '_batch')(positives=[[positive] for positive in positives],topn=50,ignored_idxes=ignored_idxes)]
             suggestions_list = local_suggestions
             suggestions = RRA_suggestions(suggestions_list, tooltip_feature, request)
 
@@ -304,11 +355,7 @@ def query(request):
 def RRA_suggestions(suggestions_list, tooltip_feature, request):
     ranks = aggregate_ranks(suggestions_list)
     encoded_suggestions = [name for (name, score) in ranks[:40]]
-    suggestions = []
-    for name in encoded_suggestions:
-        suggestion = prepare_suggestion(request, name, tooltip_feature)
-        suggestions.append(suggestion)
-    return suggestions
+    return prepare_suggestions(request, encoded_suggestions, tooltip_feature)
 
 
 @login_required
@@ -1,6 +1,99 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import json
+import types
+from unittest import mock
+
+from django.contrib.auth.models import User
 from django.test import TestCase
+from elasticsearch.serializer import JSONSerializer
+from rest_framework.test import APIRequestFactory
+
+from search_api.update_endpoint import update_views
+from search_api.update_endpoint.update_views import BulkUpdateView
+
+
+class FakeBulkClient:
+    """Answers _bulk requests like Elasticsearch, failing the updates of failing_ids as missing documents."""
+
+    def __init__(self, failing_ids=()):
+        self.transport = types.SimpleNamespace(serializer=JSONSerializer())
+        self.failing_ids = set(failing_ids)
+        self.chunks = []
+
+    def bulk(self, body, *args, **kwargs):
+        lines = [json.loads(line) for line in body.splitlines()]
+        actions = [line['update'] for line in lines[0::2]]
+        self.chunks.append([action['_id'] for action in actions])
+
+        items = []
+        for action in actions:
+            if action['_id'] in self.failing_ids:
+                items.append({'update': {'_index': action['_index'], '_id': action['_id'], 'status': 404,
+                                         'error': {'type': 'document_missing_exception', 'reason': 'document missing'}}})
+            else:
+                items.append({'update': {'_index': action['_index'], '_id': action['_id'], 'status': 200, 'result': 'updated'}})
+        return {'errors': bool(self.failing_ids), 'items': items}
+
+
+class BulkUpdateViewTest(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('bulk_updater', password='secret')
+        user.profile.auth_token = 'bulk_token'
+        user.profile.save()
+
+    def _post(self, client, payload):
+        request = APIRequestFactory().post('/search_api/update/bulk', payload, format='json')
+        with mock.patch.object(update_views, 'get_elastic_client', return_value=client):
+            return BulkUpdateView.as_view()(request)
+
+    def _get_items(self, count, text_size=10):
+        return [{'id': str(i), 'index': 'test_index', 'changes': {'text': 'x' * text_size}} for i in range(count)]
+
+    def test_invalid_payload_is_rejected_before_elasticsearch(self):
+        client = FakeBulkClient()
+        payloads = [
+            {'auth_token': 'wrong_token', 'items': self._get_items(1)},
+            {'auth_token': 'bulk_token', 'items': []},
+            {'auth_token': 'bulk_token', 'items': [{'id': '1', 'index': 'test_index'}]},
+            {'auth_token': 'bulk_token', 'items': self._get_items(1), 'chunk_size': 0},
+            {'auth_token': 'bulk_token', 'items': self._get_items(1), 'max_chunk_bytes': 10},
+        ]
+
+        for payload in payloads:
+            self.assertEqual(self._post(client, payload).status_code, 400)
+        self.assertEqual(client.chunks, [])
+
+    def test_items_are_sent_in_chunks_of_chunk_size(self):
+        client = FakeBulkClient()
+        response = self._post(client, {'auth_token': 'bulk_token', 'items': self._get_items(5), 'chunk_size': 2})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.chunks, [['0', '1'], ['2', '3'], ['4']])
+        self.assertEqual(response.data['updated'], 5)
+        self.assertFalse(response.data['errors'])
+
+    def test_items_are_sent_in_chunks_under_max_chunk_bytes(self):
+        client = FakeBulkClient()
+        # Every action takes a bit over 600 bytes, so only one fits under the 1024 byte limit.
+        response = self._post(client, {'auth_token': 'bulk_token', 'items': self._get_items(3, text_size=600), 'max_chunk_bytes': 1024})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.chunks, [['0'], ['1'], ['2']])
+        self.assertEqual(response.data['updated'], 3)
+
+    def test_failed_items_get_their_own_results(self):
+        client = FakeBulkClient(failing_ids={'1', '3'})
+        response = self._post(client, {'auth_token': 'bulk_token', 'items': self._get_items(4), 'chunk_size': 3})
 
-# Create your tests here.
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['errors'])
+        self.assertEqual((response.data['updated'], response.data['failed']), (2, 2))
+        self.assertEqual([item['id'] for item in response.data['items']], ['0', '1', '2', '3'])
+        self.assertEqual([item['success'] for item in response.data['items']], [True, False, True, False])
+        self.assertEqual(response.data['items'][0]['result'], 'updated')
+        self.assertIsNone(response.data['items'][0]['error'])
+        self.assertEqual(response.data['items'][1]['status'], 404)
+        self.assertEqual(response.data['items'][1]['error']['type'], 'document_missing_exception')
@@ -12,3 +12,8 @@ class UpdateItem(serializers.Serializer):
 class UpdateRequestSerializer(serializers.Serializer):
     auth_token = serializers.CharField(validators=[validate_auth_token], required=True, min_length=0, allow_blank=False)
     items = serializers.ListField(child=UpdateItem(), required=True, allow_empty=False)
+
+
+class BulkUpdateRequestSerializer(UpdateRequestSerializer):
+    chunk_size = serializers.IntegerField(default=500, required=False, min_value=1, max_value=10000)
+    max_chunk_bytes = serializers.IntegerField(default=10 * 1024 * 1024, required=False, min_value=1024, max_value=100 * 1024 * 1024)
@@ -1,15 +1,30 @@
 import logging
 
 import elasticsearch
+from elasticsearch.helpers import streaming_bulk
 from rest_framework.exceptions import APIException
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from search_api.update_endpoint.update_serializers import UpdateRequestSerializer
+from search_api.update_endpoint.update_serializers import UpdateRequestSerializer, BulkUpdateRequestSerializer
 from search_api.validator_serializers.common_exceptions import ElasticTransportError
 from texta.settings import es_url, ERROR_LOGGER
 
 
+_elastic_client = None
+
+
+def get_elastic_client() -> elasticsearch.Elasticsearch:
+    """
+    Returns a process wide Elasticsearch client so that consecutive requests
+    reuse the same connection pool instead of opening a new one per item.
+    """
+    global _elastic_client
+    if _elastic_client is None:
+        _elastic_client = elasticsearch.Elasticsearch(es_url)
+    return _elastic_client
+
+
 class UpdateView(APIView):
     serializer_class = UpdateRequestSerializer
 
@@ -31,7 +46,7 @@ class UpdateView(APIView):
     @staticmethod
     def elastic_update_request(item: dict) -> dict:
         try:
-            elastic = elasticsearch.Elasticsearch(es_url)
+            elastic = get_elastic_client()
             response = elastic.update(
                 index=item["index"],
                 doc_type=item["doc_type"] if "doc_type" in item else item["index"],
@@ -48,3 +63,79 @@ class UpdateView(APIView):
         except Exception as e:
             logging.getLogger(ERROR_LOGGER).exception(e)
             raise APIException("There has been an unidentified error in the backend, please contact the developers about this issue.")
+
+
+class BulkUpdateView(APIView):
+    """
+    Same payload as UpdateView, but the whole item list is validated up front and
+    sent to Elasticsearch as chunked _bulk update actions. Every item gets its own
+    result in the response, in the same order as in the request.
+    """
+    serializer_class = BulkUpdateRequestSerializer
+
+    def get(self, request):
+        return Response()
+
+
+    def post(self, request):
+        serializer = BulkUpdateRequestSerializer(data=request.data)
+
+        # Will return an error message if not valid.
+        if serializer.is_valid(raise_exception=True):
+            validated_data = serializer.validated_data
+            items = BulkUpdateView.elastic_bulk_update_request(
+                validated_data["items"],
+                chunk_size=validated_data["chunk_size"],
+                max_chunk_bytes=validated_data["max_chunk_bytes"]
+            )
+
+            failed = [item for item in items if not item["success"]]
+            return Response({"errors": bool(failed), "updated": len(items) - len(failed), "failed": len(failed), "items": items})
+
+    @staticmethod
+    def get_update_actions(items: list):
+        for item in items:
+            yield {
+                "_op_type": "update",
+                "_index": item["index"],
+                "_type": item["doc_type"] if "doc_type" in item else item["index"],
+                "_id": item["id"],
+                "doc": item["changes"]
+            }
+
+    @staticmethod
+    def elastic_bulk_update_request(items: list, chunk_size: int, max_chunk_bytes: int) -> list:
+        try:
+            results = []
+            elastic = get_elastic_client()
+            bulk_responses = streaming_bulk(
+                client=elastic,
+                actions=BulkUpdateView.get_update_actions(items),
+                chunk_size=chunk_size,
+                max_chunk_bytes=max_chunk_bytes,
+                raise_on_error=False,
+                raise_on_exception=False
+            )
+
+            # streaming_bulk yields the results in the same order as the actions.
+            for item, (success, response) in zip(items, bulk_responses):
+                result = response.get("update", {})
+                results.append({
+                    "id": item["id"],
+                    "index": item["index"],
+                    "success": success,
+                    "status": result.get("status"),
+                    "result": result.get("result"),
+                    "error": result.get("error") if not success else None
+                })
+
+            return results
+
+        except elasticsearch.TransportError as e:
+            # Will return the appropriate error message along with the status code.
+            logging.getLogger(ERROR_LOGGER).exception(e)
+            raise ElasticTransportError(e.error)
+
+        except Exception as e:
+            logging.getLogger(ERROR_LOGGER).exception(e)
+            raise APIException("There has been an unidentified error in the backend, please contact the developers about this issue.")
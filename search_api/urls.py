@@ -11,5 +11,6 @@ urlpatterns = [
     url(r'^list/datasets', views.list_datasets, name='list_datasets'),
     url(r'^list/dataset', views.list_fields, name='list_fields'),
     url(r'^more_like_this', views.more_like_this, name='more_like_this'),
+    url(r'^update/bulk', update_views.BulkUpdateView.as_view(), name="update_bulk"),
     url(r'^update', update_views.UpdateView.as_view(), name="update")
 ]
@@ -15,16 +15,19 @@ class MultiSearcherDashboard:
         self.query_body = query_body
         self.elasticsearch = elasticsearch.Elasticsearch(self.es_url, timeout=120, )
         self.field_counts = {}
+        self.round_trips = 0
 
     def conduct_query(self):
         conductor = MultiSearchConductor()
         result = conductor.query_conductor(self.indices, query_body=self.query_body, es=self.elasticsearch, es_url=self.es_url, excluded_fields=self.excluded_fields)
         self.field_counts = conductor.field_counts
+        self.round_trips = conductor.round_trips
         return result
 
     def format_result(self, response):
         formater = MultiSearchFormater()
         result = formater.format_result(response=response, field_counts=self.field_counts)
+        result['es_round_trips'] = self.round_trips
         return result
 
 
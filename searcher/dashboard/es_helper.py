@@ -1,12 +1,23 @@
+import copy
+import time
+
 import requests
 from typing import *
 
+# Field data of the indices is reused for this many seconds before the mappings are fetched again.
+FIELD_DATA_CACHE_SECONDS = 300
+
+# (es_url, indices) -> (timestamp, (normal_fields, nested_fields))
+_field_data_cache = {}
+
 
 class DashboardEsHelper:
 
     def __init__(self, es_url, indices):
         self.es_url = es_url
         self.indices = indices
+        # Number of requests sent to Elasticsearch by this helper.
+        self.round_trips = 0
 
     def get_mapping_schema(self) -> dict:
         """
@@ -16,6 +27,7 @@ class DashboardEsHelper:
         """
         endpoint_url = '{0}/{1}/_mapping'.format(self.es_url, self.indices)
         response = requests.get(endpoint_url)
+        self.round_trips += 1
         return response.json()
 
     def get_field_mappings(self) -> dict:
@@ -26,6 +38,7 @@ class DashboardEsHelper:
         """
         url_endpoint = "{0}/{1}/_mapping/*/field/*".format(self.es_url, self.indices)
         response = requests.get(url_endpoint).json()
+        self.round_trips += 1
 
         return response
 
@@ -121,8 +134,19 @@ class DashboardEsHelper:
         """
         Implements the helper functions to give the necessary data
         about fields which is needed for the aggregations.
+        Results are cached for FIELD_DATA_CACHE_SECONDS.
         :return:
         """
+        cache_key = (self.es_url, self.indices)
+        cached = _field_data_cache.get(cache_key, None)
+        if cached and time.time() - cached[0] < FIELD_DATA_CACHE_SECONDS:
+            return copy.deepcopy(cached[1])
+
+        field_data = self._get_aggregation_field_data()
+        _field_data_cache[cache_key] = (time.time(), copy.deepcopy(field_data))
+        return field_data
+
+    def _get_aggregation_field_data(self):
         names_of_nested_fields = self.get_nested_field_names()
 
         field_mappings = self.get_field_mappings()
@@ -11,7 +11,7 @@ class MultiSearchFormater(BaseDashboardFormater):
         """
         Main function to format the response of aggregations.
         Takes input in the form of {<index_name>: ES_agg_query_result}
-        :param field_counts:
+        :param field_counts: Document counts of the fields in the form of {<index_name>: {<field_name>: count}}
         :param response:
         :return:
         """
@@ -31,7 +31,7 @@ class MultiSearchFormater(BaseDashboardFormater):
 
             # Manually insert percentages into the value_counts aggregation.
             grouped_aggregations = reformated_agg_dict['aggregations']
-            self._add_value_count_percentages(grouped_aggregations, total_documents, field_counts)
+            self._add_value_count_percentages(grouped_aggregations, total_documents, field_counts.get(index_name, {}))
 
             final_result['indices'].append(reformated_agg_dict)
 
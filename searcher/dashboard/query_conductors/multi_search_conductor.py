@@ -1,4 +1,6 @@
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import elasticsearch_dsl
 import elasticsearch
@@ -7,90 +9,133 @@ from elasticsearch_dsl import MultiSearch
 from searcher.dashboard.es_helper import DashboardEsHelper
 from texta.settings import ERROR_LOGGER
 
+# Maximum number of indices queried at the same time.
+DASHBOARD_MAX_WORKERS = 4
+
 
 class MultiSearchConductor:
-    def __init__(self):
+    """
+    Builds one multi-search per index which contains the field counts and all the aggregations,
+    so an index costs a single Elasticsearch round trip once its field mappings are cached.
+    Indices are queried concurrently.
+    """
+
+    def __init__(self, max_workers=DASHBOARD_MAX_WORKERS):
         self.field_counts = {}
-        self.multi_search = MultiSearch()
+        self.round_trips = 0
+        self.max_workers = max_workers
 
     def query_conductor(self, indices, query_body, es, es_url, excluded_fields):
         result = {}
 
         list_of_indices = indices.split(',')
 
-        for index in list_of_indices:
-            # Fetch all the fields and their types, then filter the ones we don't want like _texta_id.
-            normal_fields, nested_fields = DashboardEsHelper(es_url=es_url, indices=index).get_aggregation_field_data()
-            normal_fields, nested_fields = self._filter_excluded_fields(excluded_fields, normal_fields, nested_fields, )
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(list_of_indices))) as executor:
+            futures = [(index, executor.submit(self._query_index, index, query_body, es, es_url, excluded_fields)) for index in list_of_indices]
 
-            # Attach all the aggregations to Elasticsearch, depending on the fields.
-            # Text, keywords get term aggs etc.
-            self._normal_fields_handler(normal_fields, index=index, query_body=query_body, es=es)
-            self._texta_facts_agg_handler(index=index, query_body=query_body, es=es)
+            # Save the results into the result dict under their index's name.
+            for index, future in futures:
+                result[index], self.field_counts[index], round_trips = future.result()
+                self.round_trips += round_trips
 
-            # Send the query towards Elasticsearch and then save it into the result
-            # dict under its index's name.
-            try:
-                responses = self.multi_search.using(es).execute()
-                result[index] = [response.to_dict() for response in responses]
+        return result
 
-            except elasticsearch.exceptions.TransportError as e:
-                logging.getLogger(ERROR_LOGGER).exception(e.info)
-                raise elasticsearch.exceptions.TransportError
+    def _query_index(self, index, query_body, es, es_url, excluded_fields):
+        # Fetch all the fields and their types, then filter the ones we don't want like _texta_id.
+        es_helper = DashboardEsHelper(es_url=es_url, indices=index)
+        normal_fields, nested_fields = es_helper.get_aggregation_field_data()
+        normal_fields, nested_fields = self._filter_excluded_fields(excluded_fields, normal_fields, nested_fields, )
 
-        return result
+        # Field counts go into the same multi-search as the aggregations.
+        multi_search = MultiSearch()
+        count_fields = self._get_count_fields(normal_fields)
+        if count_fields:
+            multi_search = multi_search.add(self._create_field_counts_search(count_fields, index=index))
+
+        # Attach all the aggregations to Elasticsearch, depending on the fields.
+        # Text, keywords get term aggs etc.
+        multi_search = self._normal_fields_handler(multi_search, normal_fields, index=index, query_body=query_body, es=es)
+        multi_search = self._texta_facts_agg_handler(multi_search, index=index, query_body=query_body, es=es)
+
+        # Send the query towards Elasticsearch.
+        try:
+            responses = list(multi_search.using(es).execute())
+
+        except elasticsearch.exceptions.TransportError as e:
+            logging.getLogger(ERROR_LOGGER).exception(e.info)
+            raise elasticsearch.exceptions.TransportError
+
+        field_counts = {}
+        if count_fields:
+            count_buckets = responses.pop(0).aggregations.field_counts.buckets
+            field_counts = {field_name: count_buckets[field_name].doc_count for field_name in count_fields}
 
-    def _normal_fields_handler(self, list_of_normal_fields, query_body, index, es):
+        return [response.to_dict() for response in responses], field_counts, es_helper.round_trips + 1
+
+    def _get_count_fields(self, list_of_normal_fields):
+        # Fields like article_lead and article_lead.keyword share the same count.
+        return list(OrderedDict.fromkeys(self._remove_dot_notation(field_dict['full_path']) for field_dict in list_of_normal_fields))
+
+    def _create_field_counts_search(self, count_fields, index):
+        """
+        Counts the documents that contain each of the fields with a single filters aggregation,
+        instead of sending a separate count request per field.
+        """
+        search_dsl = elasticsearch_dsl.Search().index(index).extra(size=0).source(False)
+        filters = {field_name: elasticsearch_dsl.Q("exists", field=field_name) for field_name in count_fields}
+        search_dsl.aggs.bucket("field_counts", "filters", filters=filters)
+        return search_dsl
+
+    def _normal_fields_handler(self, multi_search, list_of_normal_fields, query_body, index, es):
         for field_dict in list_of_normal_fields:
             field_type = field_dict['type']
             field_name = field_dict['full_path']
             clean_field_name = self._remove_dot_notation(field_name)
 
-            search_gateway = elasticsearch_dsl.Search(index=index).using(es)
-            self.field_counts[clean_field_name] = search_gateway.query("exists", field=clean_field_name).count()
-
             # Do not play around with the #, they exist to avoid naming conflicts as awkward as they may be.
             # TODO Find a better solution for this.
             if field_type == "text":
                 if query_body is not None:
                     search_dsl = self._create_search_object(query_body=query_body, index=index, es=es)
                     search_dsl.aggs.bucket("sigsterms#{0}#text_sigterms".format(clean_field_name), 'significant_text', field=field_name, filter_duplicate_text=True)
-                    self.multi_search = self.multi_search.add(search_dsl)
+                    multi_search = multi_search.add(search_dsl)
 
             elif field_type == "keyword":
                 search_dsl = self._create_search_object(query_body=query_body, index=index, es=es)
                 search_dsl.aggs.bucket("sterms#{0}#keyword_terms".format(clean_field_name), 'terms', field=field_name)
-                self.multi_search = self.multi_search.add(search_dsl)
+                multi_search = multi_search.add(search_dsl)
 
             elif field_type == "date":
                 search_dsl = self._create_search_object(query_body=query_body, index=index, es=es)
                 search_dsl.aggs.bucket("date_histogram#{0}_month#date_month".format(clean_field_name), 'date_histogram', field=field_name, interval='month')
                 search_dsl.aggs.bucket("date_histogram#{0}_year#date_year".format(clean_field_name), 'date_histogram', field=field_name, interval='year')
-                self.multi_search = self.multi_search.add(search_dsl)
+                multi_search = multi_search.add(search_dsl)
 
             elif field_type == "integer":
                 search_dsl = self._create_search_object(query_body=query_body, index=index, es=es)
                 search_dsl.aggs.bucket("extended_stats#{0}#int_stats".format(clean_field_name), 'extended_stats', field=field_name)
-                self.multi_search = self.multi_search.add(search_dsl)
+                multi_search = multi_search.add(search_dsl)
 
             elif field_type == "long":
                 search_dsl = self._create_search_object(query_body=query_body, index=index, es=es)
                 search_dsl.aggs.bucket('extended_stats#{0}#long_stats'.format(clean_field_name), 'extended_stats', field=field_name)
-                self.multi_search = self.multi_search.add(search_dsl)
+                multi_search = multi_search.add(search_dsl)
 
             elif field_type == "float":
                 search_dsl = self._create_search_object(query_body=query_body, index=index, es=es)
                 search_dsl.aggs.bucket("extended_stats#{0}#float_stats".format(clean_field_name), 'extended_stats', field=field_name)
-                self.multi_search = self.multi_search.add(search_dsl)
+                multi_search = multi_search.add(search_dsl)
+
+        return multi_search
 
-    def _texta_facts_agg_handler(self, query_body, index, es):
+    def _texta_facts_agg_handler(self, multi_search, query_body, index, es):
         search_dsl = self._create_search_object(query_body=query_body, index=index, es=es)
 
         search_dsl.aggs.bucket("nested#texta_facts", 'nested', path='texta_facts') \
             .bucket('sterms#fact_category', 'terms', field='texta_facts.fact', collect_mode="breadth_first") \
             .bucket("sigsterms#significant_facts", 'significant_terms', field='texta_facts.str_val')
 
-        self.multi_search = self.multi_search.add(search_dsl)
+        return multi_search.add(search_dsl)
 
     def _filter_excluded_fields(self, excluded_fields, normal_fields, nested_fields):
         normal_fields = list(filter(lambda x: x['full_path'] not in excluded_fields, normal_fields))
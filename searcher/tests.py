@@ -4,8 +4,25 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import copy
+import csv
+import io
+import json
+import os
+import random
+import threading
+import time
+import unittest
+import zlib
+from unittest import mock
 
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.test import RequestFactory, SimpleTestCase, TestCase
+
+from lexicon_miner.models import Lexicon
+from utils.autocomplete import PrefixIndex, PrefixIndexCache, build_lexicon_index, get_lexicon_version
+from searcher.view_functions.general import columnar_export, export_pages
+from utils.highlighter import Highlighter, IntervalHighlighter
 
 
 class SimpleTest(TestCase):
@@ -14,3 +31,229 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def _random_highlight_case(rng):
+    text = ''.join(rng.choice('ab c.') for _ in range(rng.randint(0, 60)))
+
+    highlight_data = []
+    for data_idx in range(rng.randint(0, 8)):
+        spans = []
+        for _ in range(rng.randint(1, 3)):
+            start = rng.randint(0, len(text) + 3)
+            spans.append([start, rng.randint(start, len(text) + 5)])
+
+        datum = {'spans': spans, 'name': rng.choice(['LOC', 'PER', '']), 'category': rng.choice(['[fact]', '[fact_val]', '[HL]'])}
+        if rng.random() < 0.7:
+            datum['color'] = rng.choice(['#ff0000', '#00ff00', '#0000ff'])
+        if rng.random() < 0.5:
+            datum['value'] = str(data_idx)
+        if rng.random() < 0.2:
+            datum['description'] = 'description {0}'.format(data_idx)
+        highlight_data.append(datum)
+
+    tagged_text = None
+    if text and rng.random() < 0.6:
+        tagged_text = ''.join('<span class="[ES]" style="background-color: #FFD119">{0}</span>'.format(char) if rng.random() < 0.2 else char for char in text)
+        if rng.random() < 0.2:
+            # Tagged text that does not match the original text falls back to per-character alignment.
+            tagged_text = 'x' + tagged_text[1:] if not tagged_text.startswith('<') else tagged_text + 'x'
+
+    return text, highlight_data, tagged_text
+
+
+class IntervalHighlighterTest(SimpleTestCase):
+
+    def test_output_equals_highlighter(self):
+        rng = random.Random(0)
+
+        for _ in range(2000):
+            text, highlight_data, tagged_text = _random_highlight_case(rng)
+            params = {'average_colors': rng.random() < 0.5, 'derive_spans': rng.random() < 0.5, 'additional_style_string': 'font-weight: bold;'}
+
+            expected = Highlighter(**params).highlight(text, copy.deepcopy(highlight_data), tagged_text)
+            result = IntervalHighlighter(**params).highlight(text, copy.deepcopy(highlight_data), tagged_text)
+            self.assertEqual(expected, result, msg=(text, highlight_data, tagged_text, params))
+
+    @unittest.skipUnless(os.getenv('TEXTA_RUN_BENCHMARKS'), 'Set TEXTA_RUN_BENCHMARKS to run benchmarks.')
+    def test_benchmark_large_document(self):
+        rng = random.Random(0)
+        text = ''.join(rng.choice('abcde fghij.') for _ in range(1024 * 1024))
+
+        highlight_data = []
+        for data_idx in range(5000):
+            start = rng.randrange(len(text) - 50)
+            highlight_data.append({'spans': [[start, start + rng.randint(1, 40)]], 'name': 'FACT_{0}'.format(data_idx % 50),
+                                   'value': str(data_idx), 'category': '[fact_val]', 'color': '#E69F00'})
+
+        for highlighter_class in (IntervalHighlighter, Highlighter):
+            start_time = time.time()
+            highlighter_class(average_colors=True).highlight(text, copy.deepcopy(highlight_data))
+            print('{0}: {1:.3f}s for 1MB document with {2} facts'.format(highlighter_class.__name__, time.time() - start_time, len(highlight_data)))
+
+
+class PrefixIndexTest(SimpleTestCase):
+
+    def test_search_equals_linear_scan(self):
+        rng = random.Random(0)
+        entries = [(''.join(rng.choice('abc') for _ in range(rng.randint(0, 5))), rng.randint(0, 5), data_idx) for data_idx in range(500)]
+        index = PrefixIndex(entries)
+
+        for prefix in ['', 'a', 'ab', 'abc', 'cab', 'cc', 'd', 'abcab']:
+            for limit in [1, 10, 100]:
+                matches = sorted((entry for entry in entries if entry[0].startswith(prefix)), key=lambda entry: (-entry[1], entry[0]))
+                result = index.search(prefix, limit)
+                self.assertEqual([entry[:2] for entry in matches[:limit]], [entry[:2] for entry in result])
+
+
+class PrefixIndexCacheTest(SimpleTestCase):
+
+    def test_concurrent_lookups_build_once(self):
+        build_started, release_build = threading.Event(), threading.Event()
+        builds = []
+
+        def build_index(value):
+            builds.append(value)
+            build_started.set()
+            release_build.wait(5)
+            return value
+
+        cache = PrefixIndexCache(build_index)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('scope', 'index'))) for _ in range(5)]
+        threads[0].start()
+        build_started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release_build.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(['index'], builds)
+        self.assertEqual(['index'] * 5, results)
+
+    def test_builds_started_before_invalidation_are_dropped(self):
+        builds = []
+
+        def build_index():
+            builds.append(len(builds))
+            if len(builds) in (1, 3):
+                # The data changes while the index is being built.
+                cache.invalidate('scope')
+            return len(builds)
+
+        cache = PrefixIndexCache(build_index)
+        self.assertEqual(1, cache.get('scope'))
+        self.assertEqual(2, cache.get('scope'))
+        self.assertEqual(2, cache.get('scope'))
+
+        cache._refresh('scope')
+        self.assertNotIn('scope', cache.indices)
+        self.assertEqual(4, cache.get('scope'))
+
+
+class LexiconIndexVersionTest(TestCase):
+
+    def test_changes_made_elsewhere_are_seen(self):
+        user = User.objects.create(username='autocomplete')
+        Lexicon.objects.create(name='linnad', description='', author=user)
+        cache = PrefixIndexCache(build_lexicon_index, get_version=get_lexicon_version)
+        self.assertEqual(['linnad'], [entry[0] for entry in cache.get(user.pk, user).search('', 10)])
+
+        # bulk_create sends no post_save signal, like a change made by another process.
+        Lexicon.objects.bulk_create([Lexicon(name='linnaosad', description='', author=user)])
+        self.assertEqual(['linnad', 'linnaosad'], sorted(entry[0] for entry in cache.get(user.pk, user).search('linna', 10)))
+
+
+@unittest.skipIf(columnar_export.pyarrow is None, 'Columnar export requires pyarrow.')
+class ColumnarExporterTest(SimpleTestCase):
+
+    def test_export_without_features_is_rejected(self):
+        with self.assertRaises(ValueError):
+            columnar_export.ColumnarExporter([], [], 'parquet')
+
+
+class FakeSlicedScrollManager:
+    """Serves the scroll and sliced scroll searches of export_pages from a list of documents."""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.combined_query = {'main': {'query': {'match_all': {}}}}
+        self.es_url = 'http://localhost:9200'
+        self.slices = []
+        self.scrolls = {}
+        self.lock = threading.Lock()
+
+    def build(self, es_params):
+        pass
+
+    def stringify_datasets(self):
+        return 'test_index'
+
+    def plain_post(self, url, data):
+        query = json.loads(data)
+        hits = [{'_source': document} for document in self.documents]
+        if '?scroll=' not in url:
+            return {'hits': {'total': len(hits), 'hits': hits[:query['size']]}}
+
+        if 'slice' in query:
+            hits = hits[query['slice']['id']::query['slice']['max']]
+        with self.lock:
+            self.slices.append(query.get('slice'))
+            scroll_id = str(len(self.scrolls))
+            self.scrolls[scroll_id] = (hits, query['size'])
+        return self.scroll(scroll_id)
+
+    def scroll(self, scroll_id=None, time_out=None):
+        with self.lock:
+            hits, size = self.scrolls[scroll_id]
+            self.scrolls[scroll_id] = (hits[size:], size)
+        return {'_scroll_id': scroll_id, 'hits': {'hits': hits[:size]}}
+
+    def clear_scroll(self, scroll_id):
+        with self.lock:
+            del self.scrolls[scroll_id]
+
+
+class ExportPagesTest(SimpleTestCase):
+
+    def setUp(self):
+        documents = [{'id': i, 'text': 'line {0}, "quoted"\nnext'.format(i), 'mlp': {'lemmas': 'lemma {0}'.format(i)}} for i in range(95)]
+        self.es_m = FakeSlicedScrollManager(documents)
+        self.es_params = {'features': ['id', 'text', 'mlp.lemmas'], 'num_examples': '*', 'filename': 'export.csv'}
+
+        datasets = mock.patch.object(export_pages, 'Datasets')
+        datasets.start().return_value.activate_datasets.return_value.build_manager.return_value = self.es_m
+        self.addCleanup(datasets.stop)
+        # Ten documents per scroll batch.
+        for name, value in [('EXPORT_MIN_BATCH', 10), ('EXPORT_BATCH_BYTES', 1), ('EXPORT_FLUSH_BYTES', 512)]:
+            patcher = mock.patch.object(export_pages, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _export(self, max_slices):
+        with mock.patch.object(export_pages, 'EXPORT_MAX_SLICES', max_slices):
+            return ''.join(export_pages.get_all_rows(self.es_params, mock.Mock(session={})))
+
+    def test_sliced_export_equals_single_scroll(self):
+        single_rows = list(csv.reader(io.StringIO(self._export(1))))
+        self.assertEqual([None], self.es_m.slices)
+        sliced_rows = list(csv.reader(io.StringIO(self._export(4))))
+
+        self.assertEqual([{'id': i, 'max': 4} for i in range(4)], sorted(self.es_m.slices[1:], key=lambda slice_: slice_['id']))
+        self.assertEqual({}, self.es_m.scrolls)
+        self.assertEqual(96, len(single_rows))
+        self.assertEqual(single_rows[0], sliced_rows[0])
+        self.assertEqual(sorted(single_rows[1:]), sorted(sliced_rows[1:]))
+
+    def test_gzip_export_decompresses_to_csv(self):
+        request = RequestFactory().get('/export_pages')
+        request.user = mock.Mock(is_authenticated=True)
+        request.session = {'export_args': dict(self.es_params, compression='gzip')}
+
+        with mock.patch.object(export_pages, 'EXPORT_MAX_SLICES', 1):
+            response = export_pages.export_pages(request)
+            compressed = b''.join(response.streaming_content)
+
+        self.assertEqual('attachment; filename="export.csv.gz"', response['Content-Disposition'])
+        self.assertEqual(self._export(1), zlib.decompress(compressed, 16 + zlib.MAX_WBITS).decode('utf8'))
@@ -1,23 +1,23 @@
 import json
+import re
 import time
 import warnings
 from collections import OrderedDict, defaultdict
 
-import dictor
 from bs4 import BeautifulSoup
 
 from searcher.view_functions.build_search.translit_highlighting import hl_transliterately
 from searcher.view_functions.general.searcher_utils import additional_option_cut_text, improve_facts_readability
 from texta.settings import FACT_FIELD
 from utils.generic_helpers import extract_element_from_json
-from utils.highlighter import ColorPicker, Highlighter
+from utils.highlighter import ColorPicker, IntervalHighlighter
 
 warnings.filterwarnings("ignore", category=UserWarning, module='bs4')
 
 
 def execute_search(es_m, es_params):
     start_time = time.time()
-    out = {'column_names': [], 'aaData': [], 'iTotalRecords': 0, 'iTotalDisplayRecords': 0, 'lag': 0}
+    out = {'column_names': [], 'aaData': [], 'iTotalRecords': 0, 'iTotalDisplayRecords': 0, 'lag': 0, 'stage_timings': {}}
     # DEFINING THE EXAMPLE SIZE
     es_m.set_query_parameter('from', es_params['examples_start'])
     es_m.set_query_parameter('size', es_params['num_examples'])
@@ -32,80 +32,129 @@ def execute_search(es_m, es_params):
     if int(out['iTotalDisplayRecords']) > 10000:  # Allow less pages if over page limit
         out['iTotalDisplayRecords'] = '10000'
     out['column_names'] = es_m.get_column_names(facts=True)  # get columns names from ES mapping
+    search_time = time.time() - start_time
 
-    strip_html = True
-    if 'html_stripping' in es_params:
-        strip_html = False
-
+    renderer = HitRenderer(out['column_names'], hl_config, es_params)
     hits = response['hits']['hits']
-    # hits = es_m.remove_html_from_hits(hits)
-    counter = 0
-    for hit in hits:
-        hit_id = str(hit['_id'])
-        hit['_source']['_es_id'] = hit_id
-        row = OrderedDict([(x, '') for x in out['column_names']])  # OrderedDict to remember column names with their content
+    for counter, hit in enumerate(hits):
+        out['aaData'].append(renderer.render(hit, counter))
+        out['lag'] = time.time() - start_time
+
+    out['stage_timings'] = dict(renderer.stage_timings, search=search_time)
+    return out
+
+
+class HitRenderer:
+    """
+    Turns search hits into searcher table rows.
+
+    Everything that only depends on the request (column paths, highlighted fields, display options)
+    is resolved once in the constructor, so rendering a hit only does the per-hit work.
+    Time spent in every stage is summed up in stage_timings.
+    """
+
+    # BeautifulSoup output only differs from the input text if it contains one of these characters.
+    MARKUP_PATTERN = re.compile('[<&\r\x00\ufeff]')
 
-        inner_hits = hit['inner_hits'] if 'inner_hits' in hit else {}
-        name_to_inner_hits = _derive_name_to_inner_hits(inner_hits)
+    def __init__(self, column_names, hl_config, es_params):
+        self.column_names = column_names
+        self.columns = [(col, col.split('.'), col in hl_config['fields']) for col in column_names]
+        self.strip_html = 'html_stripping' not in es_params
+        self.short_version_n_char = es_params['short_version_n_char'] if 'show_short_version' in es_params else None
+        self.stage_timings = {'extract': 0.0, 'strip_html': 0.0, 'highlight': 0.0, 'transliterate': 0.0, 'cut_text': 0.0}
 
-        # Fill the row content respecting the order of the columns
+    def render(self, hit, counter):
+        hit_id = str(hit['_id'])
+        source = hit['_source']
+        source['_es_id'] = hit_id
+        es_highlight = hit.get('highlight', None)
+        name_to_inner_hits = _derive_name_to_inner_hits(hit.get('inner_hits', {}))
+
+        # OrderedDict to remember column names with their content
+        row = OrderedDict.fromkeys(self.column_names, '')
         cols_data = {}
-        for col in out['column_names']:
-            # If the content is nested, need to break the flat name in a path list
-
-            field_path = col.split('.')
-
-            # Get content for the fields and make facts human readable
-            # Possible outcomes for a field:
-            #   Normal field value - covered by dictor.
-            #   Object field value - covered by dictor
-            #   List of normal values - check for list and element type
-            #   List of objects - check for list and dict element, get the key values.
-
-            content = hit['_source']
-            if col == FACT_FIELD and col in hit['_source']:
-                content = improve_facts_readability(hit['_source'][col])
-            else:
-
-                # When the value of the field is a normal field or object field.
-                if dictor.dictor(content, col, default=""):
-                    content = dictor.dictor(content, col, default="")
-                else:
-                    content = extract_element_from_json(content, field_path)
-                    content = [str(value) for value in content if value is not None]
-                    content = "\n".join(content) if content else None
+        for col, field_path, is_highlighted in self.columns:
+            stage_start = time.time()
+            content = self._get_content(source, col, field_path)
 
-            content = str(content) if content else ""
+            stage_end = time.time()
+            self.stage_timings['extract'] += stage_end - stage_start
+            stage_start = stage_end
 
-            if strip_html:
-                soup = BeautifulSoup(content, "lxml")
-                content = soup.get_text()
+            if self.strip_html and self.MARKUP_PATTERN.search(content):
+                content = BeautifulSoup(content, "lxml").get_text()
             # To strip fields with whitespace in front
             old_content = content.strip()
 
+            stage_end = time.time()
+            self.stage_timings['strip_html'] += stage_end - stage_start
+            stage_start = stage_end
+
             # Substitute feature value with value highlighted by Elasticsearch
-            if col in hl_config['fields'] and 'highlight' in hit:
-                content = hit['highlight'][col][0] if col in hit['highlight'] else ''
+            if is_highlighted and es_highlight is not None:
+                content = es_highlight[col][0] if col in es_highlight else ''
 
             # Prettify and standardize highlights
             content, hl_data = _prettify_standardize_hls(name_to_inner_hits, col, content, old_content)
-            # Append the final content of this col to the row
-            if (row[col] == ''):
+            if row[col] == '':
                 row[col] = content
             cols_data[col] = {'highlight_data': hl_data, 'content': content, 'old_content': old_content}
 
+            self.stage_timings['highlight'] += time.time() - stage_start
+
         # Transliterate between cols
         # TODO In the future possibly better for translit_cols params to be passed data from given request
+        stage_start = time.time()
         _transliterate(cols_data, row)
+        self.stage_timings['transliterate'] += time.time() - stage_start
 
         # Checks if user wants to see full text or short version
-        if 'show_short_version' in es_params.keys():
+        if self.short_version_n_char is not None:
+            stage_start = time.time()
             for col in row:
-                row[col] = additional_option_cut_text(row[col], es_params['short_version_n_char'], count=counter)
-        out['aaData'].append([hit_id] + list(row.values()))
-        out['lag'] = time.time() - start_time
-        counter += 1
-    return out
+                row[col] = additional_option_cut_text(row[col], self.short_version_n_char, count=counter)
+            self.stage_timings['cut_text'] += time.time() - stage_start
+
+        return [hit_id] + list(row.values())
+
+    @staticmethod
+    def _get_content(source, col, field_path):
+        # Possible outcomes for a field:
+        #   Normal field value - covered by the path lookup.
+        #   Object field value - covered by the path lookup.
+        #   List of normal values - check for list and element type
+        #   List of objects - check for list and dict element, get the key values.
+        if col == FACT_FIELD and col in source:
+            content = improve_facts_readability(source[col])
+        else:
+            content = _get_path_value(source, field_path)
+            if not content:
+                content = extract_element_from_json(source, field_path)
+                content = [str(value) for value in content if value is not None]
+                content = "\n".join(content) if content else None
+
+        return str(content) if content else ""
+
+
+def _get_path_value(data, field_path):
+    '''Same lookup as dictor.dictor(data, '.'.join(field_path), default=""), without re-parsing the path'''
+    value = ""
+    for key in field_path:
+        if isinstance(data, (list, tuple)):
+            try:
+                value = data[int(key)]
+            except (IndexError, ValueError):
+                value = ""
+        else:
+            try:
+                if data and key in data:
+                    value = data[key]
+                else:
+                    return ""
+            except TypeError:
+                return ""
+        data = value
+    return value
 
 
 def _prettify_standardize_hls(name_to_inner_hits, col, content, old_content):
@@ -129,7 +178,7 @@ def _prettify_standardize_hls(name_to_inner_hits, col, content, old_content):
 
         hl_data.append(datum)
 
-    content = Highlighter(average_colors=True, derive_spans=True,
+    content = IntervalHighlighter(average_colors=True, derive_spans=True,
                           additional_style_string='font-weight: bold;').highlight(
         str(old_content),
         hl_data,
@@ -1,22 +1,8 @@
-from utils.highlighter import Highlighter
-import copy
-from functools import wraps
+from utils.highlighter import IntervalHighlighter
 
-def pass_by_value(func):
-    '''deepcopy value decorator'''
-    @wraps(func)
-    def decorator(*args, **kwargs):
-        args = [copy.deepcopy(arg) for arg in args]
-        kwargs = {key: copy.deepcopy(value) for key, value in kwargs.items()}
-
-        return func(*args, **kwargs)
-
-    return decorator
-
-@pass_by_value
 def transliterate_hl_spans(hl_data, source_text, target_text):
     """Transliterates the spans from source > target
-        wrapped by pass by value to dereference the variables.
+        the hl_data dicts are copied, so the given hl_data is left untouched.
     Arguments:
         hl_data {list of dict} -- The highlight data passed into the highlighter
         source_text {string} -- The source text from which the s,pans come from
@@ -26,6 +12,7 @@ def transliterate_hl_spans(hl_data, source_text, target_text):
         list of dict -- hl_data but with corrected spans.
     """
 
+    hl_data = [dict(dict_val) for dict_val in hl_data]
     for dict_val in hl_data:
         # such as {'category': u'[HL]" style="background-color:#FFD119', 'color': u'#FFD119', 'spans': [[40, 42]]}
         #such as [[39, 41]]
@@ -79,7 +66,7 @@ def hl_transliterately(cols_data, row, hl_cols=['text.text', 'text.translit', 't
         for i, hl_col in enumerate([x for x in hl_cols if x != col]):
             new_hl_data = transliterate_hl_spans(hl_data[i], cols_data_joined[col]['old_content'], cols_data_joined[hl_col]['old_content'])
             hl_data.insert(0, new_hl_data) # Insert to index 0
-            content_hl_trans = Highlighter(average_colors=True, derive_spans=True,
+            content_hl_trans = IntervalHighlighter(average_colors=True, derive_spans=True,
                                     additional_style_string='font-weight: bold;').highlight(
                                         str(cols_data_joined[hl_col]['old_content']),
                                         new_hl_data,
@@ -3,7 +3,7 @@ from sklearn.cluster import AgglomerativeClustering,KMeans
 from sklearn.metrics.pairwise import cosine_similarity
 from itertools import combinations
 from time import time
-from utils.highlighter import Highlighter
+from utils.highlighter import IntervalHighlighter
 from utils.stop_words import StopWords
 from bs4 import BeautifulSoup
 import numpy as np
@@ -160,7 +160,7 @@ class ClusterManager:
                     to_highlighter.append(new_match)
 
             if to_highlighter:
-                hl = Highlighter(default_category='[HL]')
+                hl = IntervalHighlighter(default_category='[HL]')
                 document = hl.highlight(document,to_highlighter)
                 if 'show_short_version_cluster' in self.params.keys():
                     document = additional_option_cut_text(document, self.params['short_version_n_char_cluster'])
@@ -0,0 +1,208 @@
+import json
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from texta.settings import FACT_FIELD
+
+# export_format: (file extension, content type)
+COLUMNAR_FORMATS = {
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'arrow': ('.arrows', 'application/vnd.apache.arrow.stream'),
+}
+
+# Rows gathered before they are written out as one Parquet row group / Arrow record batch.
+COLUMNAR_ROW_GROUP_SIZE = 50000
+
+INTEGER_TYPES = {'long', 'integer', 'short', 'byte'}
+FLOAT_TYPES = {'double', 'float', 'half_float', 'scaled_float'}
+# Fields with few distinct values, stored dictionary encoded.
+DICTIONARY_TYPES = {'keyword'}
+
+
+class ColumnarExporter:
+    """
+    Converts search hits into Parquet or Arrow IPC stream data.
+
+    The schema is derived from the Elasticsearch mapping of the exported features. Keyword fields and the
+    fact names, values and paths are dictionary encoded. Hits are buffered until COLUMNAR_ROW_GROUP_SIZE rows
+    have gathered, write_hits and close return the bytes written out so far.
+    """
+
+    def __init__(self, features, mapped_fields, export_format, row_group_size=COLUMNAR_ROW_GROUP_SIZE):
+        if pyarrow is None:
+            raise ImportError('Columnar export requires the pyarrow package.')
+        if not features:
+            raise ValueError('Columnar export requires at least one feature.')
+
+        self.features = features
+        self.row_group_size = row_group_size
+        self.schema = get_export_schema(features, mapped_fields)
+        self.converters = [_get_converter(field.type) for field in self.schema]
+        self.columns = [[] for _ in features]
+
+        self.sink = _ChunkSink()
+        if export_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(self.sink, mode='w'), self.schema, compression='snappy')
+        else:
+            self.writer = pyarrow.ipc.new_stream(pyarrow.PythonFile(self.sink, mode='w'), self.schema)
+
+    def write_hits(self, hits):
+        for hit in hits:
+            for feature_name, column, converter in zip(self.features, self.columns, self.converters):
+                column.append(converter(_get_feature_value(hit['_source'], feature_name)))
+
+        if len(self.columns[0]) >= self.row_group_size:
+            self._write_row_group()
+        return self.sink.pop_data()
+
+    def close(self):
+        if self.columns[0]:
+            self._write_row_group()
+        self.writer.close()
+        return self.sink.pop_data()
+
+    def _write_row_group(self):
+        arrays = [pyarrow.array(column, type=field.type) for column, field in zip(self.columns, self.schema)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.columns = [[] for _ in self.features]
+
+
+def get_export_schema(features, mapped_fields):
+    """
+    Builds the pyarrow schema of the exported features from ES_Manager.get_mapped_fields() output.
+    Fields mapped with conflicting types in different indices are exported as strings.
+    """
+    path_to_types = {}
+    for field_mapping_json in mapped_fields:
+        field_mapping = json.loads(field_mapping_json)
+        path_to_types.setdefault(field_mapping['path'], set()).add(field_mapping['type'])
+
+    dictionary_string = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    fields = []
+    for feature_name in features:
+        es_types = path_to_types.get(feature_name, set())
+
+        if feature_name == FACT_FIELD:
+            arrow_type = pyarrow.list_(pyarrow.struct([
+                ('fact', dictionary_string),
+                ('str_val', dictionary_string),
+                ('num_val', pyarrow.int64()),
+                ('doc_path', dictionary_string),
+                ('spans', pyarrow.string()),
+            ]))
+        elif es_types and es_types <= INTEGER_TYPES:
+            arrow_type = pyarrow.int64()
+        elif es_types and es_types <= INTEGER_TYPES | FLOAT_TYPES:
+            arrow_type = pyarrow.float64()
+        elif es_types == {'boolean'}:
+            arrow_type = pyarrow.bool_()
+        elif es_types and es_types <= DICTIONARY_TYPES:
+            arrow_type = dictionary_string
+        else:
+            arrow_type = pyarrow.string()
+
+        fields.append(pyarrow.field(feature_name, arrow_type))
+
+    return pyarrow.schema(fields)
+
+
+def _get_feature_value(document_content, feature_name):
+    # Some features like mlp.lemmas are dot, separated.
+    for sub_field in feature_name.split('.'):
+        if isinstance(document_content, dict) and sub_field in document_content:
+            document_content = document_content[sub_field]
+        else:
+            return None
+    return document_content
+
+
+def _get_converter(arrow_type):
+    if pyarrow.types.is_list(arrow_type):
+        return _to_facts
+    if pyarrow.types.is_integer(arrow_type):
+        return _to_integer
+    if pyarrow.types.is_floating(arrow_type):
+        return _to_float
+    if pyarrow.types.is_boolean(arrow_type):
+        return _to_boolean
+    return _to_string
+
+
+def _to_facts(value):
+    if not isinstance(value, list):
+        return None
+
+    facts = []
+    for fact in value:
+        facts.append({
+            'fact': fact.get('fact'),
+            'str_val': _to_string(fact.get('str_val')),
+            'num_val': _to_integer(fact.get('num_val')),
+            'doc_path': fact.get('doc_path'),
+            'spans': _to_string(fact.get('spans')),
+        })
+    return facts
+
+
+def _to_integer(value):
+    if isinstance(value, bool):
+        return int(value)
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    if isinstance(value, bool):
+        return float(value)
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_boolean(value):
+    if isinstance(value, str):
+        return value.lower() == 'true'
+    return bool(value) if value is not None else None
+
+
+def _to_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+class _ChunkSink:
+    """Write-only file object that keeps the written bytes until they are handed to the response."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def pop_data(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
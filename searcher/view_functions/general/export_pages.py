@@ -1,11 +1,16 @@
 import json
 import csv
+import queue
+import threading
+import zlib
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from django.http import HttpResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from utils.datasets import Datasets
 from utils.es_manager import ES_Manager
 from utils.log_manager import LogManager
+from searcher.view_functions.general.columnar_export import COLUMNAR_FORMATS, ColumnarExporter
 from searcher.view_functions.general.searcher_utils import improve_facts_readability
 
 try:
@@ -15,18 +20,48 @@ except:
 
 ES_SCROLL_BATCH = 100
 
+# Exporting all pages uses sliced scrolls, one worker thread per slice.
+EXPORT_MAX_SLICES = 4
+EXPORT_SCROLL_TIME_OUT = '5m'
+# Scroll batch size is picked from the average size of a sampled document, so that
+# a single scroll response is roughly EXPORT_BATCH_BYTES.
+EXPORT_SAMPLE_SIZE = 20
+EXPORT_BATCH_BYTES = 10 * 1024 * 1024
+EXPORT_MIN_BATCH = 100
+EXPORT_MAX_BATCH = 5000
+# CSV data is handed to the response once the buffer grows over this size.
+EXPORT_FLUSH_BYTES = 1024 * 1024
+# Number of scrolled batches that may wait for the CSV writer.
+EXPORT_QUEUE_SIZE = 8
+
 
 @login_required
 def export_pages(request):
 
     es_params = request.session.get('export_args')
     if es_params is not None:
-        if es_params['num_examples'] == '*':
-            response = StreamingHttpResponse(get_all_rows(es_params, request), content_type='text/csv')
+        filename = es_params['filename']
+        export_format = es_params.get('export_format', 'csv')
+
+        if export_format in COLUMNAR_FORMATS and not es_params['features']:
+            return HttpResponse('Select at least one feature to export.', status=400)
+        if export_format in COLUMNAR_FORMATS:
+            extension, content_type = COLUMNAR_FORMATS[export_format]
+            response = StreamingHttpResponse(get_columnar_rows(es_params, request, export_format), content_type=content_type)
+            filename = (filename[:-len('.csv')] if filename.endswith('.csv') else filename) + extension
         else:
-            response = StreamingHttpResponse(get_rows(es_params, request), content_type='text/csv')
+            if es_params['num_examples'] == '*':
+                rows = get_all_rows(es_params, request)
+            else:
+                rows = get_rows(es_params, request)
 
-        response['Content-Disposition'] = 'attachment; filename="%s"' % (es_params['filename'])
+            if es_params.get('compression') == 'gzip':
+                response = StreamingHttpResponse(_gzip_stream(rows), content_type='application/gzip')
+                filename += '.gz'
+            else:
+                response = StreamingHttpResponse(rows, content_type='text/csv')
+
+        response['Content-Disposition'] = 'attachment; filename="%s"' % (filename)
 
         return response
 
@@ -50,6 +85,63 @@ def get_rows(es_params, request):
     es_m = ds.build_manager(ES_Manager)
     es_m.build(es_params)
 
+    for hits in iter_page_hits(es_m, es_params):
+        process_hits(hits, features, write=True, writer=writer)
+        yield _get_buffer_data(buffer_)
+
+
+def get_all_rows(es_params, request):
+    """
+    Exports every matching document with parallel sliced scrolls.
+    Rows are written in the order the slices return them, not in the scroll order of a single search.
+    """
+    features = es_params['features']
+
+    # Prepare in-memory csv writer.
+    buffer_ = StringIO()
+    writer = csv.writer(buffer_)
+
+    # Write the first headers.
+    writer.writerow(features)
+
+    ds = Datasets().activate_datasets(request.session)
+    es_m = ds.build_manager(ES_Manager)
+    es_m.build(es_params)
+
+    for hits in iter_all_hits(es_m, features):
+        process_hits(hits, features, write=True, writer=writer)
+        # Return some data with the StreamingResponce once enough of it has gathered.
+        if buffer_.tell() >= EXPORT_FLUSH_BYTES:
+            yield _get_buffer_data(buffer_)
+
+    yield _get_buffer_data(buffer_)
+
+
+def get_columnar_rows(es_params, request, export_format):
+    """Streams the exported documents as Parquet or Arrow IPC, one row group at a time."""
+    features = es_params['features']
+
+    ds = Datasets().activate_datasets(request.session)
+    es_m = ds.build_manager(ES_Manager)
+    es_m.build(es_params)
+
+    exporter = ColumnarExporter(features, es_m.get_mapped_fields(), export_format)
+
+    if es_params['num_examples'] == '*':
+        hit_batches = iter_all_hits(es_m, features)
+    else:
+        hit_batches = iter_page_hits(es_m, es_params)
+
+    for hits in hit_batches:
+        data = exporter.write_hits(hits)
+        if data:
+            yield data
+
+    yield exporter.close()
+
+
+def iter_page_hits(es_m, es_params):
+    """Yields hit batches of the requested page range, at most es_params['num_examples'] hits in total."""
     es_m.set_query_parameter('from', es_params['examples_start'])
     q_size = es_params['num_examples'] if es_params['num_examples'] <= ES_SCROLL_BATCH else ES_SCROLL_BATCH
     es_m.set_query_parameter('size', q_size)
@@ -60,59 +152,111 @@ def get_rows(es_params, request):
     hits = response['hits']['hits']
 
     while hits and left:
-        rows = process_hits(hits, features, write=False)
+        if left > len(hits):
+            yield hits
 
-        if left > len(rows):
-            for row in rows:
-                writer.writerow(row)
-            yield _get_buffer_data(buffer_)
-
-            left -= len(rows)
+            left -= len(hits)
             response = es_m.scroll(scroll_id=scroll_id)
             hits = response['hits']['hits']
             scroll_id = response['_scroll_id']
 
-        elif left == len(rows):
-            for row in rows:
-                writer.writerow(row)
-            yield _get_buffer_data(buffer_)
-            break
         else:
-            for row in rows[:left]:
-                writer.writerow(row)
-            yield _get_buffer_data(buffer_)
+            yield hits[:left]
             break
 
 
-def get_all_rows(es_params, request):
-    features = es_params['features']
+def iter_all_hits(es_m, features):
+    """Yields hit batches of every matching document, scrolled in parallel slices."""
+    # Only the exported features are needed from the documents.
+    query = dict(es_m.combined_query['main'], _source=features)
+    batch_size, total = _get_export_batch_size(es_m, query)
+    slices = max(1, min(EXPORT_MAX_SLICES, total // batch_size))
 
-    # Prepare in-memory csv writer.
-    buffer_ = StringIO()
-    writer = csv.writer(buffer_)
+    hit_queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+    stop_event = threading.Event()
 
-    # Write the first headers.
-    writer.writerow(features)
+    with ThreadPoolExecutor(max_workers=slices) as executor:
+        for slice_id in range(slices):
+            executor.submit(_scroll_slice, es_m, query, slice_id, slices, batch_size, hit_queue, stop_event)
 
-    ds = Datasets().activate_datasets(request.session)
-    es_m = ds.build_manager(ES_Manager)
-    es_m.build(es_params)
-    es_m.set_query_parameter('size', ES_SCROLL_BATCH)
+        try:
+            finished_slices = 0
+            while finished_slices < slices:
+                hits = hit_queue.get()
+                if hits is None:
+                    finished_slices += 1
+                    continue
+                if isinstance(hits, Exception):
+                    raise hits
 
-    # Fetch the initial scroll results.
-    response = es_m.scroll()
-    scroll_id = response['_scroll_id']
+                yield hits
+
+        finally:
+            # Also stops the workers when the client closes the download.
+            stop_event.set()
+
+
+def _get_export_batch_size(es_m, query):
+    """Returns the scroll batch size derived from the average size of a sampled document and the total hit count."""
+    sample_url = '{0}/{1}/_search'.format(es_m.es_url, es_m.stringify_datasets())
+    response = es_m.plain_post(sample_url, json.dumps(dict(query, size=EXPORT_SAMPLE_SIZE)))
     hits = response['hits']['hits']
 
-    while hits:
-        process_hits(hits, features, write=True, writer=writer)
-        # Return some data with the StreamingResponce
-        yield _get_buffer_data(buffer_)
+    if not hits:
+        return EXPORT_MIN_BATCH, 0
 
-        # Continue with the scroll.
-        response = es_m.scroll(scroll_id=scroll_id)
-        hits = response['hits']['hits']
+    average_hit_bytes = max(1, len(json.dumps(hits)) // len(hits))
+    batch_size = min(EXPORT_MAX_BATCH, max(EXPORT_MIN_BATCH, EXPORT_BATCH_BYTES // average_hit_bytes))
+    return batch_size, response['hits']['total']
+
+
+def _scroll_slice(es_m, query, slice_id, slices, batch_size, hit_queue, stop_event):
+    """Scrolls one slice of the query and puts the hit batches into hit_queue, None marks the end of the slice."""
+    scroll_id = None
+    try:
+        query = dict(query, size=batch_size)
+        if slices > 1:
+            query['slice'] = {'id': slice_id, 'max': slices}
+
+        search_url = '{0}/{1}/_search?scroll={2}'.format(es_m.es_url, es_m.stringify_datasets(), EXPORT_SCROLL_TIME_OUT)
+        response = es_m.plain_post(search_url, json.dumps(query))
         scroll_id = response['_scroll_id']
+        hits = response['hits']['hits']
+
+        while hits and _put_until_stopped(hit_queue, hits, stop_event):
+            response = es_m.scroll(scroll_id=scroll_id, time_out=EXPORT_SCROLL_TIME_OUT)
+            scroll_id = response['_scroll_id']
+            hits = response['hits']['hits']
+
+    except Exception as e:
+        logger = LogManager(__name__, 'EXPORT PAGES')
+        logger.set_context('slice_id', slice_id)
+        logger.exception('export slice failed')
+        _put_until_stopped(hit_queue, e, stop_event)
+
+    finally:
+        if scroll_id:
+            es_m.clear_scroll(scroll_id)
+        _put_until_stopped(hit_queue, None, stop_event)
+
+
+def _put_until_stopped(hit_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            hit_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf8'))
+        if data:
+            yield data
+    yield compressor.flush()
 
 
 def process_hits(hits, features, write=True, writer=None):
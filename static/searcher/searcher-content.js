@@ -109,6 +109,18 @@ function exportData (exportType) {
             name: 'features',
             value: features
         })
+
+        queryArgs.push({
+            name: 'export_format',
+            value: $('input[name=export-format]:checked').val()
+        })
+
+        if ($('#export-compression').is(':checked')) {
+            queryArgs.push({
+                name: 'compression',
+                value: 'gzip'
+            })
+        }
     }
 
     /* global PREFIX */
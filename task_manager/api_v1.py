@@ -1,5 +1,6 @@
 import json
 import uuid
+from datetime import datetime
 from task_manager.models import Task, TagFeedback
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
@@ -14,8 +15,10 @@ from utils.es_manager import ES_Manager
 from task_manager.task_manager import create_task
 from task_manager.task_manager import get_fields
 from task_manager.tasks.workers.text_tagger_worker import TagModelWorker
+from task_manager.tasks.workers.text_tagger_worker import tagger_cache
 from task_manager.tools import MassHelper
 from task_manager.tools import get_pipeline_builder
+from task_manager.tools import get_field_records
 from task_manager.models import TagFeedback
 
 from task_manager.document_preprocessor import preprocessor_map
@@ -23,6 +26,8 @@ from task_manager.document_preprocessor import PREPROCESSOR_INSTANCES
 from task_manager.tasks.task_types import TaskTypes
 
 API_VERSION = "1.0"
+# Maximum number of texts tagged in one tag_text_batch request
+MAX_TAG_TEXT_BATCH_SIZE = 10000
 
 
 def api_info(request):
@@ -612,6 +617,107 @@ def api_tag_text(request, user, params):
     return HttpResponse(data_json, status=200, content_type='application/json')
 
 
+@csrf_exempt
+@api_auth
+def api_tag_text_batch(request, user, params):
+    """ Apply tags to a batch of texts (via auth_token)
+        Every selected tagger scores all the texts at once. Fields missing from a text are tagged as empty.
+        Decision ids of the feedback items are returned if the database returns ids of bulk inserts.
+    """
+    texts = params.get('texts', [])
+    taggers = params.get('taggers', None)
+    store_feedback = params.get('feedback', True)
+
+    # Check if texts input is valid
+    if not texts or not isinstance(texts, list):
+        error = {'error': 'texts parameter must be a non-empty list'}
+        data_json = json.dumps(error)
+        return HttpResponse(data_json, status=400, content_type='application/json')
+
+    if len(texts) > MAX_TAG_TEXT_BATCH_SIZE:
+        error = {'error': 'at most {} texts can be tagged at once'.format(MAX_TAG_TEXT_BATCH_SIZE)}
+        data_json = json.dumps(error)
+        return HttpResponse(data_json, status=400, content_type='application/json')
+
+    # preprocess if necessary
+    preprocessor = params.get('preprocessor', None)
+    if preprocessor:
+        preprocessor_params = {}
+        preprocessor = PREPROCESSOR_INSTANCES[preprocessor]
+
+        try:
+            result_map = preprocessor.transform(texts, **preprocessor_params)
+        except Exception as e:
+            result_map = {"error": "preprocessor internal error: {}".format(repr(e))}
+            data_json = json.dumps(result_map)
+            return HttpResponse(data_json, status=400, content_type='application/json')
+
+        texts = result_map['documents']
+
+    # Select taggers
+    tagger_ids_list = Task.objects.filter(task_type=TaskTypes.TRAIN_TAGGER.value).filter(status=Task.STATUS_COMPLETED).values_list('id', flat=True)
+    if taggers is not None:
+        tagger_ids_list = tagger_ids_list.filter(id__in=taggers)
+    data = [{'tags': [], 'explain': []} for _ in texts]
+    feedback_items = []
+    time_updated = datetime.now()
+
+    # Apply
+    for tagger_id in tagger_ids_list:
+        tagger = tagger_cache.get(tagger_id)
+        if tagger is None:
+            for text_data in data:
+                text_data['explain'].append({'tagger_id': tagger_id, 'error': 'tagger model could not be loaded', 'prediction': 0, 'confidence': None})
+            continue
+
+        try:
+            fields = tagger.get_fields()
+            text_map = {field: [_get_sub_field_content(text_dict, field) for text_dict in texts] for field in fields}
+            records = get_field_records(text_map, fields)
+            # tag
+            predictions = tagger.model.predict(records)
+            # get confidence
+            confidences = tagger.model.decision_function(records)
+        except Exception as e:
+            for text_data in data:
+                text_data['explain'].append({'tag': tagger.description, 'tagger_id': tagger_id, 'error': str(e), 'prediction': 0, 'confidence': None})
+            continue
+
+        for text_dict, text_data, p, c in zip(texts, data, predictions, confidences):
+            explain = {'tag': tagger.description,
+                       'tagger_id': tagger_id,
+                       'prediction': int(p),
+                       'confidence': float(c)}
+            text_data['explain'].append(explain)
+
+            if store_feedback:
+                # create (empty) feedback item
+                feedback_obj = TagFeedback(user=user, document=json.dumps(text_dict), tagger_id=tagger_id, prediction=int(p), time_updated=time_updated)
+                feedback_items.append((explain, feedback_obj))
+
+            # Add prediction as tag
+            if p == 1:
+                text_data['tags'].append(tagger.description)
+
+    if feedback_items:
+        TagFeedback.objects.bulk_create([feedback_obj for _, feedback_obj in feedback_items])
+        for explain, feedback_obj in feedback_items:
+            explain['decision_id'] = feedback_obj.pk
+
+    # Prepare response
+    data_json = json.dumps(data)
+    return HttpResponse(data_json, status=200, content_type='application/json')
+
+
+def _get_sub_field_content(text_dict, field):
+    sub_field_content = text_dict
+    for sub_field in field.split('.'):
+        if not isinstance(sub_field_content, dict) or sub_field not in sub_field_content:
+            return ''
+        sub_field_content = sub_field_content[sub_field]
+    return sub_field_content or ''
+
+
 @csrf_exempt
 @api_auth
 def api_tag_feedback(request, user, params):
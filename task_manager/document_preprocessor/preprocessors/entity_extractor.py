@@ -1,4 +1,4 @@
-from task_manager.tasks.workers.entity_extractor_worker import EntityExtractorWorker
+from task_manager.tasks.workers.entity_extractor_worker import crf_tagger_cache
 
 import logging
 from texta.settings import ERROR_LOGGER, FACT_FIELD
@@ -17,17 +17,11 @@ class EntityExtractorPreprocessor(object):
         try:
             input_features = json.loads(kwargs['entity_extractor_feature_names'])
             model_ids_to_apply = [int(_id) for _id in json.loads(kwargs['entity_extractor_preprocessor_models'])]
-            models_to_apply = []
             facts_added = 0
 
             if not input_features or not model_ids_to_apply:
                 return {"documents":documents, "meta": {'facts_added': facts_added}}
 
-            # Load tagger models
-            for _id in model_ids_to_apply:
-                ent_ext = EntityExtractorWorker()
-                models_to_apply.append(ent_ext)
-
             # Starts text map
             text_map = {}
             for field in input_features:
@@ -48,23 +42,19 @@ class EntityExtractorPreprocessor(object):
             # Apply tags to every input feature
             for field in input_features:
                 field_docs = text_map[field]
-                results = []
-                model_descriptions = []
 
-                for i, model in enumerate(models_to_apply):
-                    model_descriptions.append(model.description)
-                    result_vector = model.convert_and_predict(field_docs, model_ids_to_apply[i])
-                    results.extend(result_vector)
+                # Taggers stay open in crf_tagger_cache between batches
+                for model_id in model_ids_to_apply:
+                    results = crf_tagger_cache.tag(model_id, field_docs)
 
-                new_facts = []
-                for i, (doc, result_doc) in enumerate(zip(field_docs, results)):
-                    new_facts, doc_num_facts = self._preds_to_doc(str(doc), result_doc, field)
-                    facts_added += doc_num_facts
+                    for i, (doc, result_doc) in enumerate(zip(field_docs, results)):
+                        new_facts, doc_num_facts = self._preds_to_doc(str(doc), result_doc, field)
+                        facts_added += doc_num_facts
 
-                    if FACT_FIELD not in documents[i]:
-                        documents[i][FACT_FIELD] = new_facts
-                    else:
-                        documents[i][FACT_FIELD].extend(new_facts)
+                        if FACT_FIELD not in documents[i]:
+                            documents[i][FACT_FIELD] = new_facts
+                        else:
+                            documents[i][FACT_FIELD].extend(new_facts)
 
         except Exception as e:
             log_dict = {'task': 'APPLY PREPROCESSOR',
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.8 on 2019-05-20 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0004_merge_20190424_1230'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tagfeedback',
+            name='user_confirmed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -108,6 +108,8 @@ class TagFeedback(models.Model):
     tagger = models.ForeignKey(Task,on_delete=models.CASCADE)
     prediction = models.IntegerField(default=None)
     in_dataset = models.IntegerField(default=0)
+    # Set once a user has confirmed or corrected the prediction, only such feedback is used to update the tagger.
+    user_confirmed = models.BooleanField(default=False)
     time_updated = models.DateTimeField(null=True, blank=True, default=None)
 
     @staticmethod
@@ -126,6 +128,7 @@ class TagFeedback(models.Model):
         feedback_log = TagFeedback.objects.get(pk = int(decision_id))
         feedback_log.user = user
         feedback_log.prediction = int(prediction)
+        feedback_log.user_confirmed = True
         feedback_log.time_updated = datetime.now()
         feedback_log.save()
         return feedback_log
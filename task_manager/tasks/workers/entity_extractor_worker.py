@@ -2,17 +2,24 @@ import os
 import sys
 import json
 import logging
+import random
+import time
 import numpy as np
 import pickle as pkl
 import psutil
+import threading
+from collections import OrderedDict
 from itertools import chain, product
+from multiprocessing import Pool
+
+from django.db import connection
 
 from task_manager.models import Task
 from searcher.models import Search
 from utils.es_manager import ES_Manager
 from utils.datasets import Datasets
 
-from texta.settings import ERROR_LOGGER, INFO_LOGGER, MODELS_DIR, URL_PREFIX, MEDIA_URL, PROTECTED_MEDIA, FACT_FIELD
+from texta.settings import ERROR_LOGGER, INFO_LOGGER, MODELS_DIR, URL_PREFIX, MEDIA_URL, PROTECTED_MEDIA, FACT_FIELD, CRF_INFERENCE_PROCESSES
 from utils.helper_functions import plot_confusion_matrix, create_file_path
 import pandas as pd
 
@@ -26,9 +33,172 @@ from task_manager.tools import TaskCanceledException
 from task_manager.tools import get_pipeline_builder
 from .base_worker import BaseWorker
 
-from lexicon_miner.models import Lexicon
 from lexicon_miner.models import Word
 
+# Streaming training reads the search in scroll batches of CRF_STREAM_BATCH_SIZE documents and appends their sequences
+# straight into the trainer, without keeping the documents in memory.
+CRF_STREAM_BATCH_SIZE = 500
+# Share of the streamed sequences held out for validation, at most CRF_MAX_VALIDATION_SEQUENCES of them.
+CRF_VALIDATION_SHARE = 0.1
+CRF_MAX_VALIDATION_SEQUENCES = 20000
+
+# Features of the sequence boundaries, as the models have been trained with them.
+CRF_BOS_VAL = "<TEXTA_EOS>"
+CRF_EOS_VAL = "<TEXTA_BOS>"
+
+# Taggers of the last CRF_TAGGER_CACHE_SIZE models used for tagging are kept open.
+CRF_TAGGER_CACHE_SIZE = 16
+# Batches of at least CRF_INFERENCE_MIN_DOCUMENTS documents are tagged in CRF_INFERENCE_PROCESSES processes,
+# CRF_INFERENCE_CHUNKS_PER_PROCESS chunks per process.
+CRF_INFERENCE_MIN_DOCUMENTS = 1000
+CRF_INFERENCE_CHUNKS_PER_PROCESS = 4
+
+
+def get_crf_features(documents):
+    """
+    Returns the feature sequences of space separated documents, the same as EntityExtractorWorker._sent2features
+    gives. The features of every distinct word in the batch are computed once.
+    """
+    word_features = {}
+    sequences = []
+
+    for document in documents:
+        features = []
+        for word in document.split(' '):
+            if word not in word_features:
+                word_features[word] = (word.lower(), word[-3:], word[-2:],
+                                       '1' if word.isupper() else '0', '1' if word.istitle() else '0', '1' if word.isdigit() else '0')
+            features.append(word_features[word])
+
+        sequence = []
+        for i, (lower, suffix_3, suffix_2, is_upper, is_title, is_digit) in enumerate(features):
+            item = ['b', lower, suffix_3, suffix_2, is_upper, is_title, is_digit]
+            if i > 0:
+                item.extend((features[i - 1][0], features[i - 1][4], features[i - 1][3]))
+            else:
+                item.append(CRF_BOS_VAL)
+            if i < len(features) - 1:
+                item.extend((features[i + 1][0], features[i + 1][4], features[i + 1][3]))
+            else:
+                item.append(CRF_EOS_VAL)
+            sequence.append(item)
+        sequences.append(sequence)
+
+    return sequences
+
+
+class CRFTaggerEntry:
+
+    def __init__(self, tagger, mtime):
+        self.tagger = tagger
+        self.mtime = mtime
+        # A pycrfsuite Tagger holds the sequence it tags, one thread tags with it at a time.
+        self.lock = threading.Lock()
+
+
+class CRFTaggerCache:
+    """
+    Resident pycrfsuite taggers of entity extractor models, keyed by the model file and its modification time.
+    A retrained model is opened again, the least recently used taggers are closed past `size` models.
+    """
+
+    def __init__(self, size=CRF_TAGGER_CACHE_SIZE, processes=CRF_INFERENCE_PROCESSES):
+        self.size = size
+        self.processes = processes
+        self._model_paths = {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def tag(self, task_id, documents):
+        """Returns the predicted labels of every token of the space separated documents."""
+        model_path = self._get_model_path(task_id)
+
+        if self.processes > 1 and len(documents) >= CRF_INFERENCE_MIN_DOCUMENTS:
+            pool = self._get_pool()
+            if pool is not None:
+                chunk_size = -(-len(documents) // (self.processes * CRF_INFERENCE_CHUNKS_PER_PROCESS))
+                chunks = [documents[start:start + chunk_size] for start in range(0, len(documents), chunk_size)]
+                return [labels for chunk_labels in pool.starmap(_tag_in_worker, [(model_path, chunk) for chunk in chunks]) for labels in chunk_labels]
+
+        return self.tag_with_model(model_path, documents)
+
+    def tag_with_model(self, model_path, documents):
+        entry = self._get_entry(model_path)
+        sequences = get_crf_features(documents)
+        with entry.lock:
+            return [entry.tagger.tag(sequence) for sequence in sequences]
+
+    def _get_model_path(self, task_id):
+        # Model files of a task keep their path, retraining replaces the file.
+        if task_id not in self._model_paths:
+            task = Task.objects.get(pk=task_id)
+            self._model_paths[task_id] = os.path.join(MODELS_DIR, task.task_type, 'model_{}'.format(task.unique_id))
+        return self._model_paths[task_id]
+
+    def _get_entry(self, model_path):
+        mtime = os.path.getmtime(model_path)
+        with self._lock:
+            entry = self._entries.get(model_path)
+            if entry is None or entry.mtime != mtime:
+                tagger = Tagger()
+                tagger.open(model_path)
+                entry = self._entries[model_path] = CRFTaggerEntry(tagger, mtime)
+
+            self._entries.move_to_end(model_path)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            return entry
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                try:
+                    self._pool = Pool(self.processes)
+                except AssertionError:
+                    # Daemonic processes can't have children, tag in place.
+                    logging.getLogger(ERROR_LOGGER).exception('CRF inference pool could not be started', extra={'processes': self.processes})
+                    self.processes = 1
+            return self._pool
+
+
+crf_tagger_cache = CRFTaggerCache()
+# Taggers of the inference pool processes.
+_worker_tagger_cache = CRFTaggerCache(processes=1)
+
+
+def _tag_in_worker(model_path, documents):
+    return _worker_tagger_cache.tag_with_model(model_path, documents)
+
+
+def get_lexicon_memberships(lexicon_ids):
+    """Returns {word: set of lexicon ids} of the words in the lexicons and {lexicon id: lexicon name}, in a single query."""
+    memberships = {}
+    lexicon_names = {}
+    for word, lexicon_id, lexicon_name in Word.objects.filter(lexicon_id__in=lexicon_ids).values_list('wrd', 'lexicon_id', 'lexicon__name'):
+        memberships.setdefault(word, set()).add(lexicon_id)
+        lexicon_names[lexicon_id] = lexicon_name
+    return memberships, lexicon_names
+
+
+class ORMQueryCounter:
+    """Database execute wrapper that counts the queries issued and the time spent on them."""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start_time = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.time() - start_time
+
+    def get_stats(self):
+        return {'queries': self.queries, 'seconds': round(self.seconds, 3)}
+
 
 class EntityExtractorWorker(BaseWorker):
 
@@ -49,8 +219,8 @@ class EntityExtractorWorker(BaseWorker):
         self.keywords = None
         self.oob_val = "<TEXTA_O>"
         self.fact_keyword_val = "<TEXTA_FACT>"
-        self.eos_val = "<TEXTA_BOS>"
-        self.bos_val = "<TEXTA_EOS>"
+        self.eos_val = CRF_EOS_VAL
+        self.bos_val = CRF_BOS_VAL
         self.train_summary = {}
         # If there is less than this amount of memory in Mb left in the machine, stop appending training data
         self.min_mb_available_memory = 1500
@@ -100,25 +270,31 @@ class EntityExtractorWorker(BaseWorker):
         if not self._set_up_task(task_id):
             return False
         try:
-
-            self.show_progress.update(0)
-            # Fill keywords for labeling
-            keywords = {}
-            if self.facts:
-                keywords.update(self._get_fact_values())
-            if self.lexicons:
-                keywords.update(self._get_lexicons_values())
-
-            param_query = self._parse_query(self.task_params)
-            hits = self._scroll_query_response(param_query)
-            # Prepare data
-            X_train, y_train, X_val, y_val = self._prepare_data(hits, keywords)
-            # Training the model.
-            self.show_progress.update(1)
-            # Train and report validation
-            model, report, confusion, plot_url = self._train_and_validate(X_train, y_train, X_val, y_val)
-
-            self.train_summary['samples'] = len(hits)
+            query_counter = ORMQueryCounter()
+            with connection.execute_wrapper(query_counter):
+                self.show_progress.update(0)
+                # Fill keywords for labeling
+                keywords = {}
+                if self.facts:
+                    keywords.update(self._get_fact_values())
+                if self.lexicons:
+                    keywords.update(self._get_lexicons_values())
+
+                param_query = self._parse_query(self.task_params)
+                if self.task_params.get('training_mode', 'streaming') == 'streaming':
+                    model, report, confusion, plot_url = self._stream_train_and_validate(param_query, keywords)
+                else:
+                    hits = self._scroll_query_response(param_query)
+                    # Prepare data
+                    X_train, y_train, X_val, y_val = self._prepare_data(hits, keywords)
+                    # Training the model.
+                    self.show_progress.update(1)
+                    # Train and report validation
+                    model, report, confusion, plot_url = self._train_and_validate(X_train, y_train, X_val, y_val)
+                    self.train_summary['samples'] = len(hits)
+
+            # Queries of the progress updates and keyword lookups up to here
+            self.train_summary['orm_queries'] = query_counter.get_stats()
             self.train_summary['model_type'] = 'CRF'
             report_table = self._convert_dict_to_html_table(report)
             self.train_summary['report'] = report_table
@@ -132,7 +308,7 @@ class EntityExtractorWorker(BaseWorker):
             log_dict = {
                 'task': 'CREATE CRF MODEL',
                 'event': 'crf_training_completed',
-                'arguments': {'task_id': self.task_id}
+                'arguments': {'task_id': self.task_id, 'orm_queries': self.train_summary['orm_queries']}
             }
             self.info_logger.info("CRF training completed", extra=log_dict)
 
@@ -154,16 +330,9 @@ class EntityExtractorWorker(BaseWorker):
         print('Done with crf task')
 
     def convert_and_predict(self, data, task_id):
+        # Labels of the keywords are not features, tagging only needs the words.
         self.task_id = task_id
-        self.task_obj = Task.objects.get(pk=self.task_id)
-        self.task_type = self.task_obj.task_type
-        # Recover features from model to check map
-        self._load_tagger()
-        self._load_keywords()
-        data = self._transform(data, self.keywords)
-        processed_data = (self._sent2features(s) for s in data)
-        preds = [self.tagger.tag(x) for x in processed_data]
-        return preds
+        return crf_tagger_cache.tag(task_id, data)
 
     def _prepare_data(self, hits, keywords):
         X_train = []
@@ -256,6 +425,60 @@ class EntityExtractorWorker(BaseWorker):
         report, confusion, plot_url = self._validate(self.tagger, X_val, y_val)
         return model, report, confusion, plot_url
 
+    def _stream_train_and_validate(self, query, keywords):
+        """
+        Trains the model on the search in a single pass over the scroll: every batch of documents is converted to
+        feature sequences and appended into the trainer before the next batch is scrolled. A random share of the
+        sequences is held out for validation instead.
+        """
+        self._save_as_pkl(keywords, "meta")
+        trainer = Trainer(verbose=False)
+        rng = random.Random(42)
+        val_sequences = []
+        stats = {'documents': 0, 'sequences': 0, 'tokens': 0, 'scroll_seconds': 0.0, 'feature_seconds': 0.0}
+
+        scroll_start = time.time()
+        for batch_idx, (documents, texts) in enumerate(self._iter_hit_batches(query)):
+            feature_start = time.time()
+            stats['scroll_seconds'] += feature_start - scroll_start
+
+            for sequence in self._transform(texts, keywords):
+                if len(val_sequences) < CRF_MAX_VALIDATION_SEQUENCES and rng.random() < CRF_VALIDATION_SHARE:
+                    val_sequences.append(sequence)
+                else:
+                    trainer.append(self._sent2features(sequence), self._sent2labels(sequence))
+                    stats['sequences'] += 1
+                    stats['tokens'] += len(sequence)
+            stats['documents'] += documents
+
+            scroll_start = time.time()
+            stats['feature_seconds'] += scroll_start - feature_start
+            self.info_logger.info("CRF training data streamed", extra={
+                'task': 'CREATE CRF MODEL',
+                'event': 'crf_training_batch',
+                'data': dict(stats, task_id=self.task_id, batch=batch_idx)})
+
+            # The trainer keeps the appended sequences in memory in a compact form.
+            if self._is_memory_low():
+                self._warn_low_memory(stats['documents'])
+                break
+
+        self.show_progress.update(1)
+        train_start = time.time()
+        self._fit_and_save(trainer)
+        stats['train_seconds'] = time.time() - train_start
+        stats['validation_sequences'] = len(val_sequences)
+        stats['sequences_per_second'] = stats['sequences'] / max(stats['scroll_seconds'] + stats['feature_seconds'], 1e-6)
+
+        self._load_tagger()
+        X_val = [self._sent2features(s) for s in val_sequences]
+        y_val = [self._sent2labels(s) for s in val_sequences]
+        report, confusion, plot_url = self._validate(self.tagger, X_val, y_val)
+
+        self.train_summary['samples'] = stats['sequences'] + len(val_sequences)
+        self.train_summary['streaming'] = {key: round(value, 3) if isinstance(value, float) else value for key, value in stats.items()}
+        return trainer, report, confusion, plot_url
+
     def _load_keywords(self):
         file_path = os.path.join(MODELS_DIR, self.task_type, "{}_meta".format(self.model_name))
         with open(file_path, "rb") as f:
@@ -282,19 +505,29 @@ class EntityExtractorWorker(BaseWorker):
         for i, (xseq, yseq) in enumerate(zip(X_train, y_train)):
             # Check how much memory left, stop adding more data if too little
             if i % 2500 == 0:
-                if (psutil.virtual_memory().available / 1000000) < self.min_mb_available_memory:
-                    print('EntityExtractorWorker:_get_memory_safe_features - Less than {} Mb of memory remaining, breaking adding more data.'.format(self.min_mb_available_memory))
-                    self.train_summary["warning"] = "Trained on {} documents, because more documents don't fit into memory".format(i)
-
-                    log_dict = {
-                        'task': 'EntityExtractorWorker:_train_and_save',
-                        'event': 'Less than {}Mb of memory available, stopping adding more training data. Iteration {}.'.format(self.min_mb_available_memory, i),
-                        'data': {'task_id': self.task_id}
-                    }
-                    self.info_logger.info("Memory", extra=log_dict)
+                if self._is_memory_low():
+                    self._warn_low_memory(i)
                     break
             trainer.append(xseq, yseq)
 
+        self._fit_and_save(trainer)
+        return trainer
+
+    def _is_memory_low(self):
+        return (psutil.virtual_memory().available / 1000000) < self.min_mb_available_memory
+
+    def _warn_low_memory(self, documents):
+        print('EntityExtractorWorker:_get_memory_safe_features - Less than {} Mb of memory remaining, breaking adding more data.'.format(self.min_mb_available_memory))
+        self.train_summary["warning"] = "Trained on {} documents, because more documents don't fit into memory".format(documents)
+
+        log_dict = {
+            'task': 'EntityExtractorWorker:_train_and_save',
+            'event': 'Less than {}Mb of memory available, stopping adding more training data. Iteration {}.'.format(self.min_mb_available_memory, documents),
+            'data': {'task_id': self.task_id}
+        }
+        self.info_logger.info("Memory", extra=log_dict)
+
+    def _fit_and_save(self, trainer):
         trainer.set_params({
             'c1': 0.5,  # coefficient for L1 penalty
             'c2': 1e-4,  # coefficient for L2 penalty
@@ -305,7 +538,6 @@ class EntityExtractorWorker(BaseWorker):
         output_model_path = create_file_path(self.model_name, MODELS_DIR, self.task_type)
         # Train and save
         trainer.train(output_model_path)
-        return trainer
 
     def _classification_reports(self, y_true, y_pred):
         """
@@ -353,23 +585,30 @@ class EntityExtractorWorker(BaseWorker):
     def _scroll_query_response(self, query):
         # Scroll the search, extract hits
         hits = []
+        for documents, batch_hits in self._iter_hit_batches(query):
+            hits += batch_hits
+        return hits
+
+    def _iter_hit_batches(self, query, size=CRF_STREAM_BATCH_SIZE):
+        """Scrolls the search, yields the number of documents in every scroll batch and the texts of their fact and lexicon fields."""
         self.es_m.load_combined_query(query)
-        response = self.es_m.scroll()
+        response = self.es_m.scroll(size=size)
         scroll_id = response['_scroll_id']
-        total_docs = response['hits']['total']
-        while total_docs > 0:
-            for hit in response['hits']['hits']:
-                source = hit['_source']
-                # Check if any of the selected facts are present in the hit fields
-                fact_fields = self._get_facts_in_document(source)
-                # Get the hit data of the fields where facts are present
-                batch_hits = self._get_data_from_fields(source, list(set(fact_fields + self.lexicon_fields)))
-                # Add batch hits to hits
-                hits += batch_hits
-            response = self.es_m.scroll(scroll_id=scroll_id)
-            total_docs = len(response['hits']['hits'])
-            scroll_id = response['_scroll_id']
-        return hits
+        try:
+            while response['hits']['hits']:
+                batch_hits = []
+                for hit in response['hits']['hits']:
+                    source = hit['_source']
+                    # Check if any of the selected facts are present in the hit fields
+                    fact_fields = self._get_facts_in_document(source)
+                    # Get the hit data of the fields where facts are present
+                    batch_hits += self._get_data_from_fields(source, list(set(fact_fields + self.lexicon_fields)))
+                yield len(response['hits']['hits']), batch_hits
+
+                response = self.es_m.scroll(scroll_id=scroll_id)
+                scroll_id = response['_scroll_id']
+        finally:
+            self.es_m.clear_scroll(scroll_id)
 
     def _get_facts_in_document(self, source):
         fact_fields = []
@@ -432,12 +671,10 @@ class EntityExtractorWorker(BaseWorker):
         return fact_data
 
     def _get_lexicons_values(self):
-        lex_keywords = {}
-        for id in self.lexicons:
-            for lex in Lexicon.objects.filter(id=id):
-                for word in Word.objects.filter(lexicon=lex):
-                    lex_keywords[word.wrd] = lex.name
-        return lex_keywords
+        # Words in several lexicons are labeled with the lexicon given last
+        lexicon_positions = {int(lexicon_id): position for position, lexicon_id in enumerate(self.lexicons)}
+        memberships, lexicon_names = get_lexicon_memberships(list(lexicon_positions))
+        return {word: lexicon_names[max(lexicon_ids, key=lexicon_positions.get)] for word, lexicon_ids in memberships.items()}
 
     def _bad_params_result(self, msg: str):
         self.task_obj.result = json.dumps({"error": msg})
@@ -10,6 +10,7 @@ from task_manager.tools import EsIterator
 from task_manager.tools import ShowProgress
 from task_manager.tools import TaskCanceledException
 from texta.settings import MODELS_DIR, ERROR_LOGGER, INFO_LOGGER
+from utils.gensim_wrapper.ann_index import build_ann_index
 from utils.word_cluster import WordCluster
 from utils.phraser import Phraser
 import graypy
@@ -148,6 +149,12 @@ class LanguageModelWorker(BaseWorker):
             output_xml_file = create_file_path(xml_name, MODELS_DIR, self.task_type)
 
             self.model.save(output_model_file)
+
+            # Approximate nearest neighbour index for lexicon mining suggestions, None for small vocabularies.
+            self.model.init_sims()
+            ann_index = build_ann_index(self.model.wv.syn0norm)
+            if ann_index is not None:
+                ann_index.save(output_model_file)
             self.phraser.save(output_phraser_file)
             self.word_cluster.save(output_cluster_file)
 
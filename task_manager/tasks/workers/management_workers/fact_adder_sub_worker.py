@@ -2,6 +2,7 @@ import logging
 import json
 import re
 from task_manager.tasks.workers.base_worker import BaseWorker
+from task_manager.tasks.workers.management_workers.scripted_fact_update import FACT_ADDER_SCRIPT, count_facts, run_update_by_query
 from task_manager.tools import ShowProgress
 from texta.settings import ERROR_LOGGER, FACT_PROPERTIES, FACT_FIELD, INFO_LOGGER
 
@@ -23,6 +24,7 @@ class FactAdderSubWorker(BaseWorker):
         self.match_type = None
         self.case_sens = None
         self.nested_field = None
+        self.update_mode = None
 
         self._reload_env()
         self.info_logger, self.error_logger = self._generate_loggers()
@@ -66,6 +68,7 @@ class FactAdderSubWorker(BaseWorker):
         self.method = self.params['method']
         self.match_type = self.params['match_type']
         self.case_sens = self.params['case_sens']
+        self.update_mode = self.params.get('update_mode', 'scripted')
         self.nested_field = None
 
         if len(self.fact_field.split('.')) > 1:
@@ -76,10 +79,16 @@ class FactAdderSubWorker(BaseWorker):
             result = self.fact_to_doc()
         elif self.method == 'all_in_doc':
             result = self.doc_matches_to_facts()
+        elif self.method == 'all_in_dataset' and self._is_scriptable():
+            result = self.matches_to_facts_by_script()
         elif self.method == 'all_in_dataset':
             result = self.matches_to_facts()
         return result
 
+    def _is_scriptable(self):
+        """Values without regex syntax can be matched inside Elasticsearch by FACT_ADDER_SCRIPT."""
+        return self.update_mode != 'scroll' and self.match_type in ('phrase', 'phrase_prefix', 'string') and not re.search(r'[.^$*+?{}\[\]\\|()]', self.fact_value)
+
     def fact_to_doc(self):
         """Add a fact to a certain document with given fact, span, and the document _id"""
         query = {"query": {"terms": {"_id": [self.doc_id]}}}
@@ -122,13 +131,7 @@ class FactAdderSubWorker(BaseWorker):
 
     def matches_to_facts(self):
         """Add all matches in dataset as a fact"""
-
-        if self.match_type == 'string':
-            # Match the word everywhere in text
-            query = {"main": {'query': {'query_string': {'query': '*{}*'.format(self.fact_value), 'fields': [self.fact_field]}}}}
-        else:
-            # Match prefix, or separate word
-            query = {"main": {"query": {"multi_match": {"query": self.fact_value, "fields": [self.fact_field], "type": self.match_type}}}}
+        query = {"main": {"query": self._matches_query()}}
 
         # response = self.es_m.perform_query(query)
         self.es_m.load_combined_query(query)
@@ -171,6 +174,36 @@ class FactAdderSubWorker(BaseWorker):
         self.es_m.clear_scroll(scroll_id)
         return {'fact_count': fact_count, 'status': 'success'}
 
+    def matches_to_facts_by_script(self):
+        """Add all matches in dataset as a fact inside Elasticsearch, with a scripted update by query"""
+        query = self._matches_query()
+        if not self.es_m.perform_query({'size': 0, 'query': query})['hits']['total']:
+            return {'fact_count': 0, 'status': 'no_hits'}
+
+        show_progress = ShowProgress(self.task_id)
+        show_progress.update_view(0)
+        self.es_m.update_mapping_structure(FACT_FIELD, FACT_PROPERTIES)
+
+        fact_query = {"bool": {"must": [{"term": {FACT_FIELD + ".fact": self.fact_name}}, {"term": {FACT_FIELD + ".doc_path": self.fact_field}}]}}
+        facts_before = count_facts(self.es_m, query, fact_query)
+        params = {'fact_name': self.fact_name, 'value': self.fact_value, 'doc_path': self.fact_field, 'path': self.fact_field.split('.'),
+                  'match_type': self.match_type, 'case_sens': bool(self.case_sens)}
+        response = run_update_by_query(self.es_m, query, FACT_ADDER_SCRIPT, params, show_progress=show_progress)
+        fact_count = count_facts(self.es_m, query, fact_query) - facts_before
+
+        show_progress.update_view(100.0)
+        if response['failures']:
+            logging.getLogger(ERROR_LOGGER).error('Scripted fact adding failed for some documents.', extra={'failures': response['failures'][:10]})
+            return {'fact_count': fact_count, 'status': 'update_error'}
+        return {'fact_count': fact_count, 'status': 'success'}
+
+    def _matches_query(self):
+        if self.match_type == 'string':
+            # Match the word everywhere in text
+            return {'query_string': {'query': '*{}*'.format(self.fact_value), 'fields': [self.fact_field]}}
+        # Match prefix, or separate word
+        return {"multi_match": {"query": self.fact_value, "fields": [self.fact_field], "type": self.match_type}}
+
     def _derive_match_spans(self, hits, fact_count):
         if self.match_type == 'phrase':
             pattern = r"\b{}\b"
@@ -1,6 +1,7 @@
 import logging
 import json
 from task_manager.tasks.workers.base_worker import BaseWorker
+from task_manager.tasks.workers.management_workers.scripted_fact_update import FACT_DELETER_SCRIPT, count_facts, run_update_by_query
 from task_manager.tools import ShowProgress
 from texta.settings import ERROR_LOGGER, FACT_FIELD, INFO_LOGGER
 
@@ -39,9 +40,10 @@ class FactDeleterSubWorker(BaseWorker):
         try:
             rm_facts_dict, doc_id = self.parse_params()
             query = self._fact_deletion_query(rm_facts_dict, doc_id)
-            self.es_m.load_combined_query(query)
-            result = self.remove_facts_from_document(rm_facts_dict, doc_id)
-            return result
+            if self.params.get('update_mode', 'scripted') == 'scroll':
+                self.es_m.load_combined_query(query)
+                return self.remove_facts_from_document(rm_facts_dict, doc_id)
+            return self.remove_facts_by_script(rm_facts_dict, query['main']['query'])
         except:
             self.error_logger.error('A problem occurred when attempted to run fact_deleter_worker.', exc_info=True, extra={
                 'params': self.params,
@@ -129,6 +131,29 @@ class FactDeleterSubWorker(BaseWorker):
             })
 
 
+    def remove_facts_by_script(self, rm_facts_dict, query):
+        """Remove facts from the documents matching the query inside Elasticsearch, with a scripted update by query.
+
+        Arguments:
+            rm_facts_dict {Dict[str: List[str]]} -- Dict of fact values to remove, as in remove_facts_from_document
+            query {Dict} -- Query of the documents to update
+        """
+        show_progress = ShowProgress(self.task_id)
+        show_progress.update_view(0)
+
+        fact_query = self._fact_values_query(rm_facts_dict)
+        facts_before = count_facts(self.es_m, query, fact_query)
+        response = run_update_by_query(self.es_m, query, FACT_DELETER_SCRIPT, {'facts': rm_facts_dict}, show_progress=show_progress)
+        total_facts_removed = facts_before - count_facts(self.es_m, query, fact_query)
+
+        show_progress.update_view(100.0)
+        return json.dumps({"Documents modified": response['updated'], "Facts removed": total_facts_removed, "Failed documents": len(response['failures'])})
+
+    def _fact_values_query(self, rm_facts_dict):
+        '''Creates the query of the facts in the dict of facts {name: [val]}, to be used inside a nested query'''
+        return {"bool": {"should": [{"bool": {"must": [{"term": {FACT_FIELD+".fact": key}}, {"term": {FACT_FIELD+".str_val": val}}]}}
+                                    for key in rm_facts_dict for val in rm_facts_dict[key]]}}
+
     def _fact_deletion_query(self, rm_facts_dict, doc_id):
         '''Creates the query for fact deletion based on dict of facts {nampe: val}'''
         fact_queries = []
@@ -0,0 +1,125 @@
+import time
+
+from task_manager.tools import TaskCanceledException
+from texta.settings import FACT_FIELD, UPDATE_BY_QUERY_REQUESTS_PER_SECOND
+
+# Seconds between the status checks of a running update by query task.
+TASK_POLL_SECONDS = 5
+
+# Removes the facts whose value is listed under their name in params.facts.
+FACT_DELETER_SCRIPT = """
+def facts = ctx._source[params.fact_field];
+if (facts == null) {
+    ctx.op = 'noop';
+    return;
+}
+int size = facts.size();
+facts.removeIf(fact -> params.facts.containsKey(fact.fact) && params.facts[fact.fact].contains(fact.str_val));
+if (facts.size() == size) {
+    ctx.op = 'noop';
+}
+"""
+
+# Adds a fact for every case-insensitive match of params.value in the field params.doc_path, found at params.path in
+# the source. Matches the value the way FactAdderSubWorker._derive_match_spans matches a value without regex syntax:
+# 'phrase' as \bvalue\b, 'phrase_prefix' as \bvalue\w* and 'string' as \w*value\w*. Painless regexes are disabled
+# by default, so the matching is done by hand.
+FACT_ADDER_SCRIPT = """
+boolean isWord(String text, int i) {
+    if (i < 0 || i >= text.length()) {
+        return false;
+    }
+    char c = text.charAt(i);
+    return Character.isLetterOrDigit(c) || c == (char) '_';
+}
+
+def content = ctx._source;
+for (def key : params.path) {
+    if (!(content instanceof Map) || !content.containsKey(key)) {
+        ctx.op = 'noop';
+        return;
+    }
+    content = content[key];
+}
+if (!(content instanceof String) || params.value.isEmpty()) {
+    ctx.op = 'noop';
+    return;
+}
+
+String text = (String) content;
+String lowerText = text.toLowerCase();
+String value = params.value.toLowerCase();
+List newFacts = new ArrayList();
+int from = 0;
+while (true) {
+    int start = lowerText.indexOf(value, from);
+    if (start < 0) {
+        break;
+    }
+    int end = start + value.length();
+    if (params.match_type == 'string') {
+        while (isWord(text, start - 1)) {
+            start--;
+        }
+    } else if (isWord(text, start - 1) == isWord(text, start)) {
+        from = start + 1;
+        continue;
+    }
+    if (params.match_type == 'phrase') {
+        if (isWord(text, end - 1) == isWord(text, end)) {
+            from = start + 1;
+            continue;
+        }
+    } else {
+        while (isWord(text, end)) {
+            end++;
+        }
+    }
+
+    String match = text.substring(start, end);
+    newFacts.add(['fact': params.fact_name, 'str_val': params.case_sens ? match : match.toLowerCase(), 'doc_path': params.doc_path,
+                  'spans': '[[' + text.codePointCount(0, start) + ', ' + text.codePointCount(0, end) + ']]']);
+    from = end;
+}
+
+if (newFacts.isEmpty()) {
+    ctx.op = 'noop';
+} else if (ctx._source[params.fact_field] == null) {
+    ctx._source[params.fact_field] = newFacts;
+} else {
+    ctx._source[params.fact_field].addAll(newFacts);
+}
+"""
+
+
+def run_update_by_query(es_m, query, script, params, show_progress=None, requests_per_second=UPDATE_BY_QUERY_REQUESTS_PER_SECOND):
+    """
+    Runs the painless script on the documents of the active datasets matching the query with _update_by_query, as an
+    Elasticsearch task. The documents never leave the cluster. Reports the progress of the task to show_progress
+    until it completes and cancels it if the TEXTA task is canceled. Returns the update by query response.
+    """
+    body = {'query': query, 'script': {'source': script, 'lang': 'painless', 'params': dict(params, fact_field=FACT_FIELD)}}
+    task_id = es_m.start_update_by_query_task(body, requests_per_second)
+
+    try:
+        while True:
+            response = es_m.get_task(task_id)
+            if response.get('completed'):
+                if 'error' in response:
+                    raise RuntimeError('Update by query failed: {}'.format(response['error']))
+                return response['response']
+
+            status = response['task']['status']
+            if show_progress and status['total']:
+                show_progress.update_view(100.0 * (status['updated'] + status['noops'] + status['version_conflicts']) / status['total'])
+            time.sleep(TASK_POLL_SECONDS)
+
+    except TaskCanceledException:
+        es_m.cancel_task(task_id)
+        raise
+
+
+def count_facts(es_m, query, fact_query):
+    """Returns the number of facts matching the nested fact_query in the documents matching the query."""
+    q = {'size': 0, 'query': query, 'aggs': {'facts': {'nested': {'path': FACT_FIELD}, 'aggs': {'matched': {'filter': fact_query}}}}}
+    return es_m.perform_query(q)['aggregations']['facts']['matched']['doc_count']
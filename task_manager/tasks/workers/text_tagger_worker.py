@@ -1,10 +1,14 @@
 import os
+import copy
 import json
 import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
 import numpy as np
-import pandas as pd
 
-from task_manager.models import Task
+from task_manager.models import Task, TagFeedback
 from task_manager.tools import EsDataSample
 from searcher.models import Search
 from utils.es_manager import ES_Manager
@@ -24,16 +28,26 @@ from sklearn.externals import joblib
 from sklearn.metrics import confusion_matrix
 from sklearn.metrics import precision_score
 from sklearn.metrics import recall_score
-from sklearn.model_selection import GridSearchCV
 from task_manager.tools import ShowSteps
 from task_manager.tools import TaskCanceledException
 from task_manager.tools import get_pipeline_builder
+from task_manager.tools import get_field_records
+from task_manager.tools import fit_grid_search
+from task_manager.tools import is_online_pipeline
+from task_manager.tools import partial_fit_pipeline
 from utils.helper_functions import plot_confusion_matrix, create_file_path, write_task_xml
 from utils.stop_words import StopWords
 from utils.phraser import Phraser
 
 from .base_worker import BaseWorker
 
+# Online updates sample at most TAGGER_ONLINE_SAMPLE_SIZE positive documents of the search, next to the feedback.
+TAGGER_ONLINE_SAMPLE_SIZE = 1000
+# Online updates use at most TAGGER_ONLINE_FEEDBACK_RATIO times as many of the latest confirmed feedback rows as sampled documents.
+TAGGER_ONLINE_FEEDBACK_RATIO = 1.0
+# Models of the last TAGGER_CACHE_SIZE taggers used through tagger_cache stay loaded.
+TAGGER_CACHE_SIZE = 32
+
 
 class TagModelWorker(BaseWorker):
 
@@ -103,6 +117,11 @@ class TagModelWorker(BaseWorker):
         self.task_type = self.task_obj.task_type
 
         self.task_params = json.loads(self.task_obj.parameters)
+        # The training mode only applies to the run the task was requeued for, later runs train anew
+        training_mode = self.task_params.pop('training_mode', None)
+        if training_mode is not None:
+            self.task_obj.parameters = json.dumps(self.task_params)
+            self.task_obj.save()
         steps = ["preparing data", "training", "saving", "done"]
         show_progress = ShowSteps(self.task_id, steps)
         show_progress.update_view()
@@ -142,6 +161,11 @@ class TagModelWorker(BaseWorker):
             ds = Datasets().activate_datasets_by_id(self.task_params['dataset'])
             es_m = ds.build_manager(ES_Manager)
             self.model_name = 'model_{0}'.format(self.task_obj.unique_id)
+            # Online updates continue from the saved model if it supports them, otherwise the model is trained anew
+            is_online = training_mode == 'online' and self._load_online_model()
+            if is_online:
+                max_sample_size_opt = min(max_sample_size_opt, TAGGER_ONLINE_SAMPLE_SIZE)
+
             es_data = EsDataSample(fields=fields,
                                    query=param_query,
                                    es_m=es_m,
@@ -154,12 +178,16 @@ class TagModelWorker(BaseWorker):
 
             # Training the model.
             show_progress.update(1)
-            self.model, train_summary, plot_url = self._train_model_with_cv(c_pipe, c_params, data_sample_x_map, data_sample_y)
+            if is_online:
+                train_summary, plot_url = self._update_model_online(fields, data_sample_x_map, data_sample_y)
+            else:
+                self.model, train_summary, plot_url = self._train_model_with_cv(c_pipe, c_params, data_sample_x_map, data_sample_y)
             train_summary['samples'] = statistics
             train_summary['confusion_matrix'] = '<img src="{}" style="max-width: 80%">'.format(plot_url)
-            # Saving the model.
+            # Saving the model. A rejected online update keeps the saved model, and its feedback for the next update.
             show_progress.update(2)
-            self.save()
+            if train_summary.get('model_updated', True):
+                self.save()
 
             train_summary['model_type'] = 'sklearn'
             show_progress.update(3)
@@ -192,19 +220,19 @@ class TagModelWorker(BaseWorker):
 
         print('done')
 
-    def tag(self, text_map, check_map_consistency=True):
-        # Recover features from model to check map
+    def get_fields(self):
+        # Recover features from model
         union_features = [x[0] for x in self.model.named_steps['union'].transformer_list if x[0].startswith('pipe_')]
-        field_features = [x[5:] for x in union_features]
-        df_text = pd.DataFrame(text_map)
-        for field in field_features:
-            if field not in text_map:
-                if check_map_consistency:
+        return [x[5:] for x in union_features]
+
+    def tag(self, text_map, check_map_consistency=True):
+        field_features = self.get_fields()
+        if check_map_consistency:
+            for field in field_features:
+                if field not in text_map:
                     raise RuntimeError("Mapped field not present: {}".format(field))
-                else:
-                    df_text[field] = ""
-        # Predict        
-        return self.model.predict(df_text)
+        # Predict
+        return self.model.predict(get_field_records(text_map, field_features))
 
     def delete(self):
         pass
@@ -256,22 +284,81 @@ class TagModelWorker(BaseWorker):
     def _training_process(self):
         pass
 
-    def _train_model_with_cv(self, model, params, X_map, y):
-        fields = list(X_map.keys())
-        X_train = {}
-        X_test = {}
-        for field in fields:
-            X_train[field], X_test[field], y_train, y_test = train_test_split(X_map[field], y, test_size=0.20, random_state=42)
+    def _get_model_path(self):
+        return os.path.join(MODELS_DIR, self.task_type, self.model_name)
+
+    def _load_online_model(self):
+        """Loads the saved model of the task if it can be updated online."""
+        file_path = self._get_model_path()
+        if not os.path.exists(file_path):
+            return False
+
+        model = joblib.load(file_path)
+        if not is_online_pipeline(model):
+            return False
+        self.model = model
+        return True
+
+    def _get_feedback_samples(self, fields, max_samples):
+        """
+        Returns the field texts and labels of the latest max_samples predictions that users have confirmed or corrected
+        since the model was saved.
+        """
+        model_time = datetime.fromtimestamp(os.path.getmtime(self._get_model_path()))
+        feedback_x_map = {field: [] for field in fields}
+        feedback_y = []
+
+        feedback_rows = TagFeedback.objects.filter(tagger_id=self.task_id, user_confirmed=True, time_updated__gt=model_time)
+        for document, prediction in feedback_rows.order_by('-time_updated').values_list('document', 'prediction')[:max_samples]:
+            document = json.loads(document)
+            for field in fields:
+                text = document
+                for sub_field in field.split('.'):
+                    text = text.get(sub_field, '') if isinstance(text, dict) else ''
+                feedback_x_map[field].append(text or '')
+            feedback_y.append(int(prediction > 0))
+
+        return feedback_x_map, feedback_y
+
+    def _update_model_online(self, fields, X_map, y):
+        """
+        Updates the model with the new sample and feedback, holding out a part of them to evaluate the updated model.
+        The update is kept only if it scores at least as well as the saved model on the held out examples.
+        """
+        feedback_x_map, feedback_y = self._get_feedback_samples(fields, int(TAGGER_ONLINE_FEEDBACK_RATIO * len(y)))
+        self._handle_language_model(feedback_x_map)
+
+        X = get_field_records({field: list(X_map[field]) + feedback_x_map[field] for field in fields}, fields)
+        X_train, X_test, y_train, y_test = train_test_split(X, list(y) + feedback_y, test_size=0.20, random_state=42)
+
+        previous_pred = self.model.predict(X_test)
+        updated_model = partial_fit_pipeline(copy.deepcopy(self.model), X_train, y_train)
+        updated_pred = updated_model.predict(X_test)
+
+        previous_f1 = f1_score(y_test, previous_pred, average='micro')
+        model_updated = f1_score(y_test, updated_pred, average='micro') >= previous_f1
+        if model_updated:
+            self.model = updated_model
 
-        df_train = pd.DataFrame(X_train)
-        df_test = pd.DataFrame(X_test)
+        _statistics, plot_url = self._evaluate(y_test, updated_pred if model_updated else previous_pred)
+        _statistics.update({'training_mode': 'online', 'feedback_samples': len(feedback_y), 'model_updated': model_updated,
+                            'previous_f1_score': round(previous_f1, 3)})
+        return _statistics, plot_url
+
+    def _train_model_with_cv(self, model, params, X_map, y):
+        X = get_field_records(X_map, list(X_map.keys()))
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.20, random_state=42)
 
         # Use Train data to parameter selection in a Grid Search
-        gs_clf = GridSearchCV(model, params, n_jobs=self.n_jobs, cv=5, verbose=1)
-        gs_clf = gs_clf.fit(df_train, y_train)
-        model = gs_clf.best_estimator_
+        model, grid_fit_times = fit_grid_search(model, params, X_train, y_train, n_jobs=self.n_jobs, cv=5)
         # Use best model and test data for final evaluation
-        y_pred = model.predict(df_test)
+        y_pred = model.predict(X_test)
+        _statistics, plot_url = self._evaluate(y_test, y_pred)
+        _statistics['grid_fit_times'] = grid_fit_times
+
+        return model, _statistics, plot_url
+
+    def _evaluate(self, y_test, y_pred):
         # Report
         _f1 = f1_score(y_test, y_pred, average='micro')
         _confusion = confusion_matrix(y_test, y_pred)
@@ -292,4 +379,51 @@ class TagModelWorker(BaseWorker):
             'recall': round(_recall, 3)
         }
 
-        return model, _statistics, plot_url
+        return _statistics, plot_url
+
+
+class TaggerCache:
+    """
+    Loaded TagModelWorkers of text taggers, so that the models aren't read from disk for every request.
+    A model is loaded again once its file changes, the least recently used models are dropped past `size` taggers.
+    """
+
+    def __init__(self, size=TAGGER_CACHE_SIZE):
+        self.size = size
+        self._model_paths = {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tagger_id):
+        """Returns the TagModelWorker with the loaded model of the tagger, None if the model can't be loaded."""
+        model_path = self._get_model_path(tagger_id)
+        mtime = os.path.getmtime(model_path) if os.path.exists(model_path) else None
+
+        with self._lock:
+            entry = self._entries.get(tagger_id)
+            if entry is not None and entry[1] == mtime:
+                self._entries.move_to_end(tagger_id)
+                return entry[0]
+
+        # Models are loaded outside the lock, so that a slow load doesn't hold up requests to other taggers.
+        tagger = TagModelWorker()
+        loaded_entry = (tagger if tagger.load(tagger_id) is not None else None, mtime)
+
+        with self._lock:
+            entry = self._entries.get(tagger_id)
+            # A concurrent request may have published the same model meanwhile, the first one published is kept.
+            if entry is None or entry[1] != mtime:
+                entry = self._entries[tagger_id] = loaded_entry
+            self._entries.move_to_end(tagger_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            return entry[0]
+
+    def _get_model_path(self, tagger_id):
+        if tagger_id not in self._model_paths:
+            task = Task.objects.get(pk=tagger_id)
+            self._model_paths[tagger_id] = os.path.join(MODELS_DIR, task.task_type, 'model_{}'.format(task.unique_id))
+        return self._model_paths[tagger_id]
+
+
+tagger_cache = TaggerCache()
@@ -1,3 +1,619 @@
-from django.test import TestCase
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import types
+import zlib
+from datetime import datetime
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from pycrfsuite import Tagger, Trainer
+from sklearn.model_selection import GridSearchCV
+
+from task_manager.tasks.workers import entity_extractor_worker
+from lexicon_miner.models import Lexicon, Word
+from task_manager import api_v1
+from task_manager.models import TagFeedback, Task
+from task_manager.tasks.workers import text_tagger_worker
+from task_manager.tasks.workers.management_workers import fact_adder_sub_worker, fact_deleter_sub_worker, scripted_fact_update
+from task_manager.tasks.workers.management_workers.fact_adder_sub_worker import FactAdderSubWorker
+from task_manager.tasks.workers.management_workers.fact_deleter_sub_worker import FactDeleterSubWorker
+from task_manager.tasks.workers.entity_extractor_worker import CRFTaggerCache, EntityExtractorWorker, ORMQueryCounter, get_crf_features
+from task_manager.tasks.workers.text_tagger_worker import TaggerCache
+from task_manager.tools import TaskCanceledException, mass_helper
+from task_manager.tools.mass_helper import MassHelper
+from task_manager.tools.pipeline_builder import fit_grid_search, get_field_records, get_pipeline_builder, is_online_pipeline, partial_fit_pipeline
+from utils import word_cluster
+from utils.word_cluster import WordCluster
+
+
+class _FakeEmbedding:
+    """Word2Vec stand-in with the attributes WordCluster uses."""
+
+    def __init__(self, vectors):
+        index2word = ['word_{0}'.format(idx) for idx in range(len(vectors))]
+        self.wv = types.SimpleNamespace(vocab={word: types.SimpleNamespace(index=idx) for idx, word in enumerate(index2word)},
+                                        index2word=index2word, syn0norm=None, init_sims=self._init_sims)
+        self.vectors = vectors
+
+    def _init_sims(self):
+        self.wv.syn0norm = (self.vectors / np.linalg.norm(self.vectors, axis=1)[:, np.newaxis]).astype(np.float32)
+
+    def __getitem__(self, word):
+        return self.vectors[self.wv.vocab[word].index]
+
+
+class WordClusterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.embedding = _FakeEmbedding(np.random.RandomState(0).randn(3000, 20).astype(np.float32))
+        self.models_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.models_dir)
+
+    def test_etalons_are_most_similar_words_to_centers(self):
+        centers = np.random.RandomState(1).randn(50, 20)
+        with mock.patch.object(word_cluster, 'ETALON_BATCH_SIZE', 700):
+            etalons = WordCluster._get_etalons(self.embedding, centers)
+
+        unit_centers = centers / np.linalg.norm(centers, axis=1)[:, np.newaxis]
+        self.assertEqual(list(np.argmax(np.dot(unit_centers, self.embedding.wv.syn0norm.T), axis=1)), list(etalons))
+
+    def test_save_and_load(self):
+        wc = WordCluster()
+        wc.cluster(self.embedding, n_clusters=30)
+
+        os.makedirs(os.path.join(self.models_dir, 'train_model'))
+        self.assertTrue(wc.save(os.path.join(self.models_dir, 'train_model', 'cluster_test')))
+
+        loaded = WordCluster()
+        with mock.patch.object(word_cluster, 'MODELS_DIR', self.models_dir):
+            self.assertTrue(loaded.load('test', task_type='train_model'))
+        self.assertEqual(wc.word_to_cluster_dict, loaded.word_to_cluster_dict)
+        self.assertEqual(wc.cluster_dict, loaded.cluster_dict)
+
+
+class _FakeScrollManager:
+    """ES_Manager stand-in that scrolls the given documents."""
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.cleared_scroll_ids = []
+
+    def load_combined_query(self, query):
+        pass
+
+    def scroll(self, scroll_id=None, size=100):
+        if scroll_id is None:
+            self.size, self.position = size, 0
+        hits = [{'_source': source} for source in self.sources[self.position:self.position + self.size]]
+        self.position += self.size
+        return {'_scroll_id': 'scroll_id', 'hits': {'total': len(self.sources), 'hits': hits}}
+
+    def clear_scroll(self, scroll_id):
+        self.cleared_scroll_ids.append(scroll_id)
+
+
+class EntityExtractorStreamingTest(SimpleTestCase):
+
+    def setUp(self):
+        self.models_dir = tempfile.mkdtemp()
+        with mock.patch.object(EntityExtractorWorker, '_reload_env'), mock.patch.object(EntityExtractorWorker, '_generate_loggers', return_value=(mock.Mock(), mock.Mock())):
+            self.worker = EntityExtractorWorker()
+        self.worker.task_id = 1
+        self.worker.task_type = 'train_entity_extractor'
+        self.worker.task_obj = types.SimpleNamespace(unique_id='streaming_test')
+        self.worker.model_name = 'model_streaming_test'
+        self.worker.show_progress = mock.Mock()
+        self.worker.lexicon_fields = ['text']
+        self.worker.min_mb_available_memory = 0
+
+        rng = np.random.RandomState(0)
+        words = ['Tallinn', 'Tartu', 'linn', 'on', 'ilus', 'suur', 'ja']
+        self.sources = [{'text': ' '.join(rng.choice(words, rng.randint(2, 8)))} for _ in range(1200)]
+        self.keywords = {'Tallinn': 'LOC', 'Tartu': 'LOC'}
+
+    def tearDown(self):
+        shutil.rmtree(self.models_dir)
+
+    def test_stream_training(self):
+        es_m = self.worker.es_m = _FakeScrollManager(self.sources)
+        with mock.patch.object(entity_extractor_worker, 'MODELS_DIR', self.models_dir), \
+             mock.patch.object(entity_extractor_worker, 'CRF_STREAM_BATCH_SIZE', 100), \
+             mock.patch.object(EntityExtractorWorker, '_validate', return_value=({}, None, '')) as validate:
+            self.worker._stream_train_and_validate({}, self.keywords)
+
+            tagger = self.worker._load_tagger()
+            self.assertEqual(['LOC', '<TEXTA_O>'], tagger.tag(self.worker._sent2features(self.worker._transform(['Tartu linn'], self.keywords)[0])))
+
+        stats = self.worker.train_summary['streaming']
+        X_val, y_val = validate.call_args[0][1:]
+        self.assertEqual(len(self.sources), stats['documents'])
+        self.assertEqual(len(self.sources), stats['sequences'] + len(y_val))
+        self.assertEqual(len(self.sources), self.worker.train_summary['samples'])
+        self.assertTrue(0 < len(y_val) < len(self.sources) / 5)
+        self.assertEqual(['scroll_id'], es_m.cleared_scroll_ids)
+
+    def test_validation_sequences_are_bounded(self):
+        self.worker.es_m = _FakeScrollManager(self.sources)
+        with mock.patch.object(entity_extractor_worker, 'MODELS_DIR', self.models_dir), \
+             mock.patch.object(entity_extractor_worker, 'CRF_MAX_VALIDATION_SEQUENCES', 5), \
+             mock.patch.object(EntityExtractorWorker, '_validate', return_value=({}, None, '')) as validate:
+            self.worker._stream_train_and_validate({}, self.keywords)
+
+        self.assertEqual(5, len(validate.call_args[0][2]))
+        self.assertEqual(len(self.sources) - 5, self.worker.train_summary['streaming']['sequences'])
+
+
+class CRFTaggerCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.models_dir = tempfile.mkdtemp()
+        with mock.patch.object(EntityExtractorWorker, '_reload_env'), mock.patch.object(EntityExtractorWorker, '_generate_loggers', return_value=(mock.Mock(), mock.Mock())):
+            self.worker = EntityExtractorWorker()
+
+        rng = random.Random(0)
+        words = ['Tallinn', 'TARTU', 'linn', 'on', 'ilus', '2019', 'ja', '']
+        self.documents = [' '.join(rng.choice(words) for _ in range(rng.randint(1, 8))) for _ in range(200)]
+        self.keywords = {'Tallinn': 'LOC', 'TARTU': 'LOC'}
+
+        self.model_path = os.path.join(self.models_dir, 'model_cache_test')
+        trainer = Trainer(verbose=False)
+        for sent in self.worker._transform(self.documents, self.keywords):
+            trainer.append(list(self.worker._sent2features(sent)), self.worker._sent2labels(sent))
+        trainer.train(self.model_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.models_dir)
+
+    def test_features_equal_sent2features(self):
+        expected = [list(self.worker._sent2features(sent)) for sent in self.worker._transform(self.documents, self.keywords)]
+        self.assertEqual(expected, get_crf_features(self.documents))
+
+    def test_taggers_are_reused_until_model_changes(self):
+        tagger = Tagger()
+        tagger.open(self.model_path)
+        expected = [tagger.tag(list(self.worker._sent2features(sent))) for sent in self.worker._transform(self.documents, self.keywords)]
+
+        cache = CRFTaggerCache(size=1)
+        with mock.patch.object(CRFTaggerCache, '_get_model_path', return_value=self.model_path), \
+             mock.patch.object(entity_extractor_worker, 'Tagger', wraps=Tagger) as tagger_class:
+            self.assertEqual(expected, cache.tag(1, self.documents))
+            self.assertEqual(expected, cache.tag(1, self.documents))
+            self.assertEqual(1, tagger_class.call_count)
+
+            mtime = os.path.getmtime(self.model_path)
+            os.utime(self.model_path, (mtime + 10, mtime + 10))
+            self.assertEqual(expected, cache.tag(1, self.documents))
+            self.assertEqual(2, tagger_class.call_count)
+
+    def test_pool_tagging_equals_in_place(self):
+        cache = CRFTaggerCache()
+        pool_cache = CRFTaggerCache(processes=2)
+        with mock.patch.object(CRFTaggerCache, '_get_model_path', return_value=self.model_path), \
+             mock.patch.object(entity_extractor_worker, 'CRF_INFERENCE_MIN_DOCUMENTS', 10):
+            try:
+                self.assertEqual(cache.tag(1, self.documents), pool_cache.tag(1, self.documents))
+            finally:
+                if pool_cache._pool is not None:
+                    pool_cache._pool.terminate()
+
+
+class LexiconKeywordsTest(TestCase):
+
+    def setUp(self):
+        author = User.objects.create(username='lexicon_author')
+        self.lexicons = [Lexicon.objects.create(name=name, description='', author=author) for name in ['LOC', 'ORG', 'PER']]
+        rng = random.Random(0)
+        for lexicon in self.lexicons:
+            Word.objects.bulk_create([Word(lexicon=lexicon, wrd='word_{0}'.format(rng.randint(0, 100))) for _ in range(50)])
+
+        with mock.patch.object(EntityExtractorWorker, '_reload_env'), mock.patch.object(EntityExtractorWorker, '_generate_loggers', return_value=(mock.Mock(), mock.Mock())):
+            self.worker = EntityExtractorWorker()
+
+    def test_keywords_equal_per_lexicon_lookup(self):
+        lexicon_ids = [str(self.lexicons[2].id), str(self.lexicons[0].id), str(self.lexicons[1].id)]
+        expected = {}
+        for lexicon_id in lexicon_ids:
+            lexicon = Lexicon.objects.get(id=lexicon_id)
+            for word in Word.objects.filter(lexicon=lexicon):
+                expected[word.wrd] = lexicon.name
+
+        self.worker.lexicons = lexicon_ids
+        query_counter = ORMQueryCounter()
+        with connection.execute_wrapper(query_counter):
+            self.assertEqual(expected, self.worker._get_lexicons_values())
+        self.assertEqual(1, query_counter.queries)
+
+
+def _get_tagger_sample():
+    """Returns the text map of the title and comment.text fields of 300 documents, and their labels."""
+    rng = random.Random(0)
+    words = ['tallinn', 'tartu', 'linn', 'on', 'ilus', 'suur', 'ja', 'maja', 'puu', 'meri']
+    text_map = {'title': [], 'comment.text': []}
+    y = []
+    for _ in range(300):
+        label = rng.randint(0, 1)
+        text_map['title'].append(' '.join(rng.choice(words[:6] if label else words[4:]) for _ in range(rng.randint(1, 5))))
+        text_map['comment.text'].append(' '.join(rng.choice(words) for _ in range(rng.randint(0, 8))))
+        y.append(label)
+    return text_map, y
+
+
+def _build_tagger_pipeline(extractor_opt, reductor_opt, normalizer_opt, classifier_opt=0):
+    pipe_builder = get_pipeline_builder()
+    pipe_builder.set_pipeline_options(extractor_opt, reductor_opt, normalizer_opt, classifier_opt)
+    model, params = pipe_builder.build(fields=['title', 'comment.text'])
+    if extractor_opt == 0:
+        model.set_params(union__pipe_title__HashingVectorizer__n_features=2 ** 10, **{'union__pipe_comment.text__HashingVectorizer__n_features': 2 ** 10})
+    return model, params
+
+
+class GridSearchTest(SimpleTestCase):
+
+    def setUp(self):
+        self.text_map, self.y = _get_tagger_sample()
+        self.X = get_field_records(self.text_map, ['title', 'comment.text'])
+
+    def test_field_records(self):
+        records = get_field_records({'title': ['a', 'b']}, ['title', 'comment.text'])
+        self.assertEqual(['a', 'b'], list(records['title']))
+        self.assertEqual(['', ''], list(records['comment.text']))
+        self.assertEqual(['b'], list(records[[1]]['title']))
+
+    def test_stateless_pipeline_equals_grid_search(self):
+        for normalizer_opt in [0, 1]:
+            model, params = _build_tagger_pipeline(0, 0, normalizer_opt)
+            params['LogisticRegressionClassifier__C'] = [0.1, 1.0]
+            expected = GridSearchCV(model, params, cv=5).fit(self.X, self.y).best_estimator_
+
+            model, params = _build_tagger_pipeline(0, 0, normalizer_opt)
+            params['LogisticRegressionClassifier__C'] = [0.1, 1.0]
+            result, fit_times = fit_grid_search(model, params, self.X, self.y)
+
+            self.assertEqual(expected.get_params()['LogisticRegressionClassifier__C'], result.get_params()['LogisticRegressionClassifier__C'])
+            self.assertEqual(list(expected.predict(self.X)), list(result.predict(self.X)))
+            self.assertEqual([{'LogisticRegressionClassifier__C': 0.1}, {'LogisticRegressionClassifier__C': 1.0}],
+                             [fit_time['params'] for fit_time in fit_times])
+
+    def test_cached_pipeline_equals_grid_search(self):
+        model, params = _build_tagger_pipeline(1, 0, 1)
+        expected = GridSearchCV(model, params, cv=5).fit(self.X, self.y).best_estimator_
+
+        model, params = _build_tagger_pipeline(1, 0, 1)
+        result, fit_times = fit_grid_search(model, params, self.X, self.y)
+
+        self.assertIsNone(result.memory)
+        self.assertEqual(list(expected.predict(self.X)), list(result.predict(self.X)))
+        self.assertEqual(4, len(fit_times))
+
+    def test_online_pipeline_learns_new_examples(self):
+        online_opt = [option['label'] for option in get_pipeline_builder().get_classifier_options()].index('SGD Classifier (online)')
+        model, params = _build_tagger_pipeline(0, 0, 1, online_opt)
+        model, _ = fit_grid_search(model, params, self.X, self.y)
+        self.assertTrue(is_online_pipeline(model))
+        self.assertFalse(is_online_pipeline(fit_grid_search(*_build_tagger_pipeline(0, 0, 1), self.X, self.y)[0]))
+        self.assertFalse(is_online_pipeline(fit_grid_search(*_build_tagger_pipeline(1, 0, 1, online_opt), self.X, self.y)[0]))
+
+        new_examples = get_field_records({'title': ['kass koer'] * 100 + ['hiir'] * 100, 'comment.text': [''] * 200}, ['title', 'comment.text'])
+        partial_fit_pipeline(model, new_examples, [1] * 100 + [0] * 100)
+        self.assertEqual([1, 0], list(model.predict(get_field_records({'title': ['kass koer', 'hiir']}, ['title', 'comment.text']))))
+
+    def test_online_update_is_validated(self):
+        online_opt = [option['label'] for option in get_pipeline_builder().get_classifier_options()].index('SGD Classifier (online)')
+        flipped_y = [1 - label for label in self.y]
+
+        media_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_dir)
+        with mock.patch.object(text_tagger_worker.TagModelWorker, '_reload_env'), \
+             mock.patch.object(text_tagger_worker.TagModelWorker, '_generate_loggers', return_value=(mock.Mock(), mock.Mock())):
+            worker = text_tagger_worker.TagModelWorker()
+        worker.model_name, worker.task_type, worker.task_params = 'model_online_test', 'train_tagger', {}
+
+        with mock.patch.object(text_tagger_worker, 'plot_confusion_matrix'), mock.patch.object(text_tagger_worker, 'PROTECTED_MEDIA', media_dir), \
+             mock.patch.object(text_tagger_worker.TagModelWorker, '_get_feedback_samples', return_value=({'title': [], 'comment.text': []}, [])):
+            # A model trained on the wrong labels improves with the right ones.
+            worker.model = model = fit_grid_search(*_build_tagger_pipeline(0, 0, 1, online_opt), self.X, flipped_y)[0]
+            summary, _ = worker._update_model_online(['title', 'comment.text'], self.text_map, self.y)
+            self.assertTrue(summary['model_updated'])
+            self.assertIsNot(model, worker.model)
+            self.assertGreater(summary['f1_score'], summary['previous_f1_score'])
+            self.assertTrue({'precision', 'recall', 'confusion_matrix', 'feedback_samples'} <= set(summary))
+
+            # An update that scores worse on the held out examples is rejected.
+            worker.model = model = fit_grid_search(*_build_tagger_pipeline(0, 0, 1, online_opt), self.X, self.y)[0]
+            worse_model = mock.Mock(**{'predict.side_effect': lambda X: np.zeros(len(X), dtype=int)})
+            with mock.patch.object(text_tagger_worker, 'partial_fit_pipeline', return_value=worse_model):
+                summary, _ = worker._update_model_online(['title', 'comment.text'], self.text_map, self.y)
+            self.assertFalse(summary['model_updated'])
+            self.assertIs(model, worker.model)
+            self.assertEqual(summary['previous_f1_score'], summary['f1_score'])
+
+
+class TagTextBatchTest(TestCase):
+
+    def setUp(self):
+        self.models_dir = tempfile.mkdtemp()
+        self.user = User.objects.create(username='integrator')
+        self.user.profile.auth_token = 'batch_token'
+        self.user.profile.save()
+
+        text_map, y = _get_tagger_sample()
+        self.model, _ = fit_grid_search(*_build_tagger_pipeline(0, 0, 0), get_field_records(text_map, ['title', 'comment.text']), y)
+        self.texts = [{'title': title, 'comment': {'text': text}} for title, text in zip(text_map['title'], text_map['comment.text'])]
+
+        self.task = Task.objects.create(user=self.user, description='linn', task_type='train_tagger', parameters='{}', result='{}',
+                                        status=Task.STATUS_COMPLETED, time_started=datetime.now())
+        os.makedirs(os.path.join(self.models_dir, 'train_tagger'))
+        text_tagger_worker.joblib.dump(self.model, os.path.join(self.models_dir, 'train_tagger', 'model_{}'.format(self.task.unique_id)))
+
+        self.patchers = [mock.patch.object(text_tagger_worker, 'MODELS_DIR', self.models_dir),
+                         mock.patch.object(api_v1, 'tagger_cache', TaggerCache()),
+                         mock.patch.object(text_tagger_worker.TagModelWorker, '_reload_env'),
+                         mock.patch.object(text_tagger_worker.TagModelWorker, '_generate_loggers', return_value=(mock.Mock(), mock.Mock()))]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in reversed(self.patchers):
+            patcher.stop()
+        shutil.rmtree(self.models_dir)
+
+    def _post(self, **params):
+        request = RequestFactory().post('/task_manager/api/v1/tag_text_batch', json.dumps(dict(params, auth_token='batch_token')), content_type='application/json')
+        return api_v1.api_tag_text_batch(request)
+
+    def test_batch_equals_model_predictions(self):
+        response = self._post(texts=self.texts)
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.content.decode())
+
+        records = get_field_records({'title': [text['title'] for text in self.texts], 'comment.text': [text['comment']['text'] for text in self.texts]},
+                                    ['title', 'comment.text'])
+        expected = self.model.predict(records)
+        self.assertEqual([['linn'] if p == 1 else [] for p in expected], [text_data['tags'] for text_data in data])
+        self.assertEqual([float(c) for c in self.model.decision_function(records)], [text_data['explain'][0]['confidence'] for text_data in data])
+        self.assertEqual(len(self.texts), TagFeedback.objects.filter(tagger=self.task).count())
+
+    def test_models_stay_loaded(self):
+        with mock.patch.object(text_tagger_worker.joblib, 'load', wraps=text_tagger_worker.joblib.load) as load:
+            self._post(texts=self.texts[:10], feedback=False)
+            self._post(texts=self.texts[10:20], feedback=False)
+        self.assertEqual(1, load.call_count)
+        self.assertEqual(0, TagFeedback.objects.count())
+
+    def test_slow_load_does_not_block_other_taggers(self):
+        load_started, release_load = threading.Event(), threading.Event()
+
+        class _SlowWorker:
+            def load(self, tagger_id):
+                if tagger_id == 'slow':
+                    load_started.set()
+                    release_load.wait(5)
+                return True
+
+        cache = TaggerCache()
+        with mock.patch.object(text_tagger_worker, 'TagModelWorker', _SlowWorker), \
+             mock.patch.object(TaggerCache, '_get_model_path', side_effect=lambda tagger_id: os.path.join(self.models_dir, tagger_id)):
+            fast_tagger = cache.get('fast')
+            slow_thread = threading.Thread(target=cache.get, args=('slow',))
+            slow_thread.start()
+            load_started.wait(5)
+            fast_results = []
+            fast_thread = threading.Thread(target=lambda: fast_results.append(cache.get('fast')))
+            fast_thread.start()
+            fast_thread.join(1)
+            release_load.set()
+            self.assertEqual([fast_tagger], fast_results)
+            slow_thread.join(5)
+        self.assertEqual(['fast', 'slow'], list(cache._entries))
+
+    def test_invalid_texts(self):
+        self.assertEqual(400, self._post(texts=[]).status_code)
+        self.assertEqual(400, self._post(texts='text').status_code)
+
+    def test_online_update_uses_confirmed_feedback(self):
+        model_path = os.path.join(self.models_dir, 'train_tagger', 'model_{}'.format(self.task.unique_id))
+        os.utime(model_path, (0, 0))
+        self._post(texts=self.texts[:10])
+        feedback_ids = list(TagFeedback.objects.order_by('id').values_list('id', flat=True))
+        for feedback_id, prediction in zip(feedback_ids[:3], [1, -1, 1]):
+            TagFeedback.update(self.user, feedback_id, prediction)
+
+        worker = text_tagger_worker.TagModelWorker()
+        worker.task_id, worker.task_type, worker.model_name = self.task.pk, 'train_tagger', 'model_{}'.format(self.task.unique_id)
+        feedback_x_map, feedback_y = worker._get_feedback_samples(['title', 'comment.text'], 2)
+        self.assertEqual([1, 0], feedback_y)
+        self.assertEqual([self.texts[2]['title'], self.texts[1]['title']], feedback_x_map['title'])
+        self.assertEqual(3, len(worker._get_feedback_samples(['title', 'comment.text'], 100)[1]))
+
+    def test_training_mode_applies_to_one_run(self):
+        parameters = {'extractor_opt': 0, 'reductor_opt': 0, 'normalizer_opt': 0, 'classifier_opt': 0, 'negative_multiplier_opt': 1.0,
+                      'max_sample_size_opt': 100, 'score_threshold_opt': 0.0, 'fields': ['title'], 'search_tag': {}, 'dataset': 1,
+                      'training_mode': 'online'}
+        self.task.parameters = json.dumps(parameters)
+        self.task.save()
+
+        with mock.patch.object(text_tagger_worker, 'Datasets', side_effect=RuntimeError('no datasets')):
+            text_tagger_worker.TagModelWorker().run(self.task.pk)
+
+        self.task.refresh_from_db()
+        self.assertNotIn('training_mode', json.loads(self.task.parameters))
+        self.assertEqual(Task.STATUS_FAILED, self.task.status)
+
+
+class _FakeAggregationElastic:
+    """ES_Manager stand-in answering the fact value aggregations of MassHelper, partitions by a CRC32 of the value."""
+
+    def __init__(self, documents, cardinality_error=0):
+        self.es_url = 'http://localhost:9200'
+        self.requests = self
+        self.documents = documents
+        self.cardinality_error = cardinality_error
+        self.num_requests = 0
+
+    def stringify_datasets(self):
+        return 'index'
+
+    def get(self, url, json):
+        self.num_requests += 1
+        facts_agg = json['aggs']['texta_facts']['aggs']['facts']
+        fact_filter = facts_agg['filter']
+        values = {}
+        for doc_idx, document in enumerate(self.documents):
+            for fact in document['texta_facts']:
+                if 'term' not in fact_filter or fact['fact'] == fact_filter['term']['texta_facts.fact']:
+                    values.setdefault(fact['str_val'], set()).add(doc_idx)
+
+        if 'cardinality' in facts_agg['aggs']:
+            result = {'cardinality': {'value': max(0, len(values) - self.cardinality_error)}}
+        else:
+            terms = facts_agg['aggs']['values']['terms']
+            include = terms.get('include')
+            if isinstance(include, list):
+                values = {value: doc_ids for value, doc_ids in values.items() if value in include}
+            elif include is not None:
+                values = {value: doc_ids for value, doc_ids in values.items()
+                          if zlib.crc32(value.encode('utf8')) % include['num_partitions'] == include['partition']}
+            ordered = sorted(values.items(), key=lambda item: (-len(item[1]), item[0]))
+            buckets = [{'key': value, 'documents': {'doc_count': len(doc_ids)}} for value, doc_ids in ordered[:terms['size']]]
+            result = {'values': {'buckets': buckets, 'sum_other_doc_count': sum(len(doc_ids) for _, doc_ids in ordered[terms['size']:])}}
+        return types.SimpleNamespace(json=lambda: {'aggregations': {'texta_facts': {'facts': result}}})
+
+
+class MassHelperTest(SimpleTestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.documents = []
+        for _ in range(500):
+            facts = [{'fact': rng.choice(['TEXTA_TAG', 'TEXTA_TAG', 'PER']), 'str_val': 'tag_{0}'.format(rng.randint(0, 60))}
+                     for _ in range(rng.randint(0, 4))]
+            self.documents.append({'texta_facts': facts})
+
+    def test_tag_frequencies_equal_document_counts(self):
+        unique_tags = {fact['str_val'] for document in self.documents for fact in document['texta_facts'] if fact['fact'] == 'TEXTA_TAG'}
+        expected = {tag: sum(1 for document in self.documents if any(fact['str_val'] == tag for fact in document['texta_facts']))
+                    for tag in unique_tags | {'missing_tag'}}
+
+        for cardinality_error in [0, 40]:
+            es_m = _FakeAggregationElastic(self.documents, cardinality_error)
+            with mock.patch.object(mass_helper, 'TAG_PARTITION_SIZE', 7):
+                helper = MassHelper(es_m)
+                self.assertEqual(unique_tags, helper.get_unique_tags())
+                self.assertEqual(expected, helper.get_tag_frequency(sorted(unique_tags | {'missing_tag'})))
+            self.assertLess(es_m.num_requests, 100)
+
+
+class _FakeTaskElastic:
+    """ES_Manager stand-in running an update by query task that completes after the given task statuses."""
+
+    def __init__(self, statuses, fact_counts=(0, 0), total_hits=1, failures=()):
+        self.statuses = list(statuses)
+        self.fact_counts = list(fact_counts)
+        self.total_hits = total_hits
+        self.failures = list(failures)
+        self.body = None
+        self.canceled = []
+        self.scrolled = False
+
+    def start_update_by_query_task(self, body, requests_per_second=-1):
+        self.body = body
+        return 'node:1'
+
+    def get_task(self, task_id):
+        if self.statuses:
+            return {'completed': False, 'task': {'status': self.statuses.pop(0)}}
+        return {'completed': True, 'response': {'updated': 3, 'failures': self.failures}}
+
+    def cancel_task(self, task_id):
+        self.canceled.append(task_id)
+
+    def perform_query(self, query):
+        if 'aggs' in query:
+            return {'aggregations': {'facts': {'matched': {'doc_count': self.fact_counts.pop(0)}}}}
+        return {'hits': {'total': self.total_hits}}
+
+    def update_mapping_structure(self, field, properties):
+        pass
+
+    def load_combined_query(self, query):
+        pass
+
+    def scroll(self, *args, **kwargs):
+        self.scrolled = True
+        return {'_scroll_id': 'scroll', 'hits': {'total': 0, 'hits': []}}
+
+
+def _task_status(total, updated, noops=0):
+    return {'total': total, 'updated': updated, 'noops': noops, 'version_conflicts': 0}
+
+
+@mock.patch.object(scripted_fact_update, 'TASK_POLL_SECONDS', 0)
+class ScriptedFactUpdateTest(SimpleTestCase):
+
+    def _adder(self, es_m, fact_value, match_type='phrase', **params):
+        params = dict({'fact_name': 'CITY', 'fact_value': fact_value, 'fact_field': 'comment.text', 'doc_id': None,
+                       'method': 'all_in_dataset', 'match_type': match_type, 'case_sens': False}, **params)
+        worker = FactAdderSubWorker(es_m, 1, params)
+        with mock.patch.object(fact_adder_sub_worker, 'ShowProgress'):
+            return json.loads(worker.run())
+
+    def test_task_progress_is_reported_until_completion(self):
+        es_m = _FakeTaskElastic([_task_status(0, 0), _task_status(10, 2, noops=3), _task_status(10, 8, noops=2)])
+        show_progress = mock.Mock()
+
+        response = scripted_fact_update.run_update_by_query(es_m, {'match_all': {}}, 'ctx.op = "noop";', {'a': 1}, show_progress=show_progress)
+        self.assertEqual(3, response['updated'])
+        self.assertEqual([mock.call(50.0), mock.call(100.0)], show_progress.update_view.call_args_list)
+        self.assertEqual({'source': 'ctx.op = "noop";', 'lang': 'painless', 'params': {'a': 1, 'fact_field': 'texta_facts'}}, es_m.body['script'])
+
+    def test_canceled_task_cancels_elastic_task(self):
+        es_m = _FakeTaskElastic([_task_status(10, 1)])
+        show_progress = mock.Mock(**{'update_view.side_effect': TaskCanceledException()})
+
+        with self.assertRaises(TaskCanceledException):
+            scripted_fact_update.run_update_by_query(es_m, {'match_all': {}}, '', {}, show_progress=show_progress)
+        self.assertEqual(['node:1'], es_m.canceled)
+
+    def test_adder_scripts_literal_values(self):
+        es_m = _FakeTaskElastic([], fact_counts=[4, 9])
+        self.assertEqual({'fact_count': 5, 'status': 'success'}, self._adder(es_m, 'tallinn'))
+        self.assertFalse(es_m.scrolled)
+        self.assertEqual({'multi_match': {'query': 'tallinn', 'fields': ['comment.text'], 'type': 'phrase'}}, es_m.body['query'])
+        self.assertEqual({'fact_name': 'CITY', 'value': 'tallinn', 'doc_path': 'comment.text', 'path': ['comment', 'text'], 'match_type': 'phrase',
+                          'case_sens': False, 'fact_field': 'texta_facts'}, es_m.body['script']['params'])
+
+        es_m = _FakeTaskElastic([], fact_counts=[0, 2])
+        self.assertEqual({'fact_count': 2, 'status': 'success'}, self._adder(es_m, 'tallinna linn-riik'))
+        self.assertFalse(es_m.scrolled)
+        self.assertEqual('tallinna linn-riik', es_m.body['script']['params']['value'])
+
+        es_m = _FakeTaskElastic([], total_hits=0)
+        self.assertEqual({'fact_count': 0, 'status': 'no_hits'}, self._adder(es_m, 'tallinn', match_type='string'))
+        self.assertIsNone(es_m.body)
+
+    def test_adder_scrolls_regex_values(self):
+        for fact_value, params in [('tall.*', {}), ('(tallinn|tartu)', {}), ('tallinn', {'update_mode': 'scroll'})]:
+            es_m = _FakeTaskElastic([])
+            self.assertEqual({'fact_count': 0, 'status': 'no_hits'}, self._adder(es_m, fact_value, **params))
+            self.assertTrue(es_m.scrolled)
+            self.assertIsNone(es_m.body)
+
+    def test_deleter_removes_facts_by_script(self):
+        es_m = _FakeTaskElastic([], fact_counts=[7, 0], failures=[{'id': 'doc'}])
+        rm_facts_dict = {'CITY': ['tallinn', 'tartu']}
+        worker = FactDeleterSubWorker(es_m, 1, {'fact_deleter_fact_values': rm_facts_dict})
+        with mock.patch.object(fact_deleter_sub_worker, 'ShowProgress'):
+            result = json.loads(worker.run())
+
+        self.assertEqual({'Documents modified': 3, 'Facts removed': 7, 'Failed documents': 1}, result)
+        self.assertEqual(worker._fact_deletion_query(rm_facts_dict, None)['main']['query'], es_m.body['query'])
+        self.assertEqual(rm_facts_dict, es_m.body['script']['params']['facts'])
@@ -4,6 +4,10 @@ from .data_manager import EsDataSample
 from .data_manager import EsIterator
 from .data_manager import TaskCanceledException
 from .pipeline_builder import get_pipeline_builder
+from .pipeline_builder import get_field_records
+from .pipeline_builder import fit_grid_search
+from .pipeline_builder import is_online_pipeline
+from .pipeline_builder import partial_fit_pipeline
 from .mass_helper import MassHelper
 
 
@@ -13,4 +17,8 @@ __all__ = ["ShowSteps",
            "EsIterator",
            "TaskCanceledException",
            "get_pipeline_builder",
+           "get_field_records",
+           "fit_grid_search",
+           "is_online_pipeline",
+           "partial_fit_pipeline",
            "MassHelper"]
@@ -6,10 +6,11 @@ from task_manager.models import Task
 from task_manager.tasks.task_types import TaskTypes
 # from task_manager.task_manager import create_task
 
-# Data scroll
-MAX_DOCS_PAGE = 5000
 # Mass Train Tagger
 MIN_DOCS_TAGGED = 100
+# Tags are aggregated in partitions of about TAG_PARTITION_SIZE tags. Every tag bucket has a reverse_nested
+# sub-bucket, so a partition stays under the search.max_buckets limit of 10000 buckets.
+TAG_PARTITION_SIZE = 4000
 
 
 class MassHelper:
@@ -29,70 +30,68 @@ class MassHelper:
         data = resp.json()
         return data
 
-    def _iterate_docs(self, q):
-        """ Iterage over all docs for a given query q
-        """
-        # scroll
-        resp = self.es_m.requests.get('{}/{}/_search?scroll=1m'.format(self.es_url, self.index), json=q)
-        data = resp.json()
-        
-        if '_scroll_id' in data:
-            scroll_id = data['_scroll_id']
-            docs = data['hits']['hits']
-            while docs:
-                # Consume all page docs
-                for d in docs:
-                    yield d
-                # Next page
-                resp = self.es_m.requests.get('{}/_search/scroll'.format(self.es_url),
-                                            json={'scroll': '1m', 'scroll_id': scroll_id})
-                data = resp.json()
-                scroll_id = data['_scroll_id']
-                docs = data['hits']['hits']
-
-    def _get_total(self, q):
-        """ Total of documents for a given query q
-        """
-        resp = self.es_m.requests.get('{}/{}/_count'.format(self.es_url, self.index), json=q)
-        data = resp.json()
-        total = data['count']
-        return total
+    def _aggregate(self, q):
+        resp = self.es_m.requests.get('{}/{}/_search'.format(self.es_url, self.index), json=q)
+        return resp.json()['aggregations']['texta_facts']['facts']
 
-    def _dict_query_tag_filter(self, tag):
+    def _dict_query_fact_values(self, fact_filter, terms, query=None):
+        """ Query counting the documents of every value of the facts that match fact_filter
+        """
+        values_agg = {'terms': dict(terms, field="texta_facts.str_val"),
+                      'aggs': {'documents': {'reverse_nested': {}}}}
         q = {}
-        q['query'] = {}
-        q['query']['nested'] = {}
-        q['query']['nested']['path'] = "texta_facts"
-        q['query']['nested']['query'] = {'term': {"texta_facts.str_val": tag}}
+        q['size'] = 0
+        if query:
+            q['query'] = query
+        q['aggs'] = {}
+        q['aggs']['texta_facts'] = {'nested': {'path': "texta_facts"}}
+        q['aggs']['texta_facts']['aggs'] = {'facts': {'filter': fact_filter, 'aggs': {'values': values_agg}}}
         return q
 
+    def get_tag_frequencies(self, query=None):
+        """ Get the number of documents of every tag with a nested terms aggregation
+
+        The tags are aggregated in partitions of about TAG_PARTITION_SIZE tags, based on the
+        cardinality estimate of the tags. If a partition turns out bigger, the number of partitions is doubled.
+        """
+        tag_filter = {'term': {"texta_facts.fact": "TEXTA_TAG"}}
+        q = self._dict_query_fact_values(tag_filter, {}, query)
+        q['aggs']['texta_facts']['aggs']['facts']['aggs'] = {'cardinality': {'cardinality': {'field': "texta_facts.str_val"}}}
+        num_tags = self._aggregate(q)['cardinality']['value']
+        num_partitions = max(1, -(-num_tags // TAG_PARTITION_SIZE))
+
+        while True:
+            tag_freq = {}
+            for partition in range(num_partitions):
+                terms = {'size': TAG_PARTITION_SIZE, 'include': {'partition': partition, 'num_partitions': num_partitions}}
+                values = self._aggregate(self._dict_query_fact_values(tag_filter, terms, query))['values']
+                if values['sum_other_doc_count'] > 0:
+                    break
+                for bucket in values['buckets']:
+                    tag_freq[bucket['key']] = bucket['documents']['doc_count']
+            else:
+                return tag_freq
+            num_partitions *= 2
+
     def get_unique_tags(self, query=None):
         """ Get Unique Tags
         """
-        q = {}
-        q['query'] = query if query else {}
-        q['query']['nested'] = {}
-        q['query']['nested']['path'] = "texta_facts"
-        q['query']['nested']['query'] = {'term': {"texta_facts.fact": "TEXTA_TAG"}}
-        q['_source'] = "texta_facts"
-        q['size'] = MAX_DOCS_PAGE
-        # Get unique tags
-        unique_tags = set()
-        for doc in self._iterate_docs(q):
-            for f in doc['_source']['texta_facts']:
-                if f['fact'] == 'TEXTA_TAG':
-                    tag = f['str_val']
-                    unique_tags.add(tag)
-        return unique_tags
+        return set(self.get_tag_frequencies(query))
 
     def get_tag_frequency(self, tags):
-        """ Get Tags frequency
+        """ Get Tags frequency, the number of documents with any fact value equal to the tag
         """
-        tag_freq = {}
-        for tag in tags:
-            q = self._dict_query_tag_filter(tag)
-            c = self._get_total(q)
-            tag_freq[tag] = c
+        tags = list(tags)
+        tag_freq = {tag: 0 for tag in tags}
+        if not tags:
+            return tag_freq
+
+        for start in range(0, len(tags), TAG_PARTITION_SIZE):
+            partition_tags = tags[start:start + TAG_PARTITION_SIZE]
+            terms = {'size': len(partition_tags), 'include': partition_tags}
+            values = self._aggregate(self._dict_query_fact_values({'match_all': {}}, terms))['values']
+            for bucket in values['buckets']:
+                tag_freq[bucket['key']] = bucket['documents']['doc_count']
         return tag_freq
 
     def schedule_tasks(self, selected_tags, normalizer_opt, classifier_opt, reductor_opt, extractor_opt, field, dataset_id, user):
@@ -124,6 +123,8 @@ class MassHelper:
             # Update query parameter from task
             tag_parameters = json.loads(task_tagger.parameters)
             self._add_search_tag_query(tag_parameters, tag_label)
+            # Taggers that support it are updated with the new examples instead of trained anew, in this run only
+            tag_parameters['training_mode'] = 'online'
             task_tagger.parameters = json.dumps(tag_parameters)
             task_tagger.requeue_task()
 
@@ -1,5 +1,9 @@
 
 # Uses scikit-learn 0.18.1
+import shutil
+import tempfile
+
+import numpy as np
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.feature_extraction.text import HashingVectorizer
@@ -11,8 +15,16 @@ from sklearn.naive_bayes import BernoulliNB
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.neighbors import RadiusNeighborsClassifier
 from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model import SGDClassifier
 from sklearn.pipeline import Pipeline
 from sklearn.pipeline import FeatureUnion
+from sklearn.model_selection import GridSearchCV
+
+try:
+    from sklearn.externals.joblib import Memory
+except ImportError:
+    # scikit-learn >= 0.23 doesn't vendor joblib
+    from joblib import Memory
 
 
 class ModelNull(BaseEstimator):
@@ -236,4 +248,96 @@ def get_pipeline_builder():
     params = {}
     pipe_builder.add_classifier('RadiusNeighborsClassifier', RadiusNeighborsClassifier, 'Radius Neighbors', params)
 
+    # Together with the Hashing Vectorizer, can be updated with new examples (see partial_fit_pipeline)
+    params = {}
+    pipe_builder.add_classifier('SGDClassifier', SGDClassifier, 'SGD Classifier (online)', params)
+
     return pipe_builder
+
+
+# Steps that learn nothing from the training data. Field pipelines made only of them transform the documents the
+# same way whichever documents they were fitted on, so their features can be computed once for all folds.
+STATELESS_STEPS = (ItemSelector, HashingVectorizer, ModelNull, Normalizer)
+# Online updates go through the examples in shuffled batches of ONLINE_BATCH_SIZE.
+ONLINE_BATCH_SIZE = 1000
+
+
+def get_field_records(text_map, fields):
+    """
+    Packs the texts of every field into a numpy structured array, one record per document. ItemSelector selects
+    the field columns of the records and grid search folds index the rows without going through a DataFrame.
+    Fields missing from text_map are empty strings.
+    """
+    num_documents = max([len(texts) for texts in text_map.values()] or [0])
+    records = np.empty(num_documents, dtype=[(field, object) for field in fields])
+    for field in fields:
+        records[field] = text_map[field] if field in text_map else ''
+    return records
+
+
+def fit_grid_search(model, params, X, y, n_jobs=1, cv=5):
+    """
+    Selects the parameters of a PipelineBuilder pipeline with a grid search on the field records X and refits the
+    best pipeline on all of X.
+
+    If every field pipeline is stateless, the field features are computed once into a sparse matrix and only the
+    classifier is searched on it. Otherwise the pipeline caches the field features with a joblib Memory, so that the
+    grid points that only differ in classifier parameters share them within a fold.
+
+    Returns the fitted pipeline and the mean fit time of every grid point in seconds.
+    """
+    union = model.named_steps['union']
+    classifier_name, classifier = model.steps[-1]
+    union_params = [param for param in params if param.startswith('union__')]
+
+    if not union_params and _has_stateless_union(model):
+        X_features = union.fit_transform(X)
+        classifier_params = {param[len(classifier_name) + 2:]: value for param, value in params.items()}
+        gs_clf = GridSearchCV(classifier, classifier_params, n_jobs=n_jobs, cv=cv, verbose=1)
+        gs_clf.fit(X_features, y)
+        model.steps[-1] = (classifier_name, gs_clf.best_estimator_)
+        best_model = model
+        grid_params = [{'{0}__{1}'.format(classifier_name, param): value for param, value in grid_point.items()}
+                       for grid_point in gs_clf.cv_results_['params']]
+    else:
+        cache_dir = tempfile.mkdtemp()
+        try:
+            model.set_params(memory=Memory(cache_dir, verbose=0))
+            gs_clf = GridSearchCV(model, params, n_jobs=n_jobs, cv=cv, verbose=1)
+            gs_clf.fit(X, y)
+            best_model = gs_clf.best_estimator_
+            # The saved model must not refer to the removed cache
+            best_model.set_params(memory=None)
+            grid_params = gs_clf.cv_results_['params']
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    fit_times = [{'params': grid_point, 'mean_fit_time': round(float(fit_time), 3)}
+                 for grid_point, fit_time in zip(grid_params, gs_clf.cv_results_['mean_fit_time'])]
+    return best_model, fit_times
+
+
+def is_online_pipeline(model):
+    """Whether a fitted PipelineBuilder pipeline can be updated with partial_fit_pipeline."""
+    return _has_stateless_union(model) and hasattr(model.steps[-1][1], 'partial_fit')
+
+
+def partial_fit_pipeline(model, X, y, batch_size=ONLINE_BATCH_SIZE, classes=(0, 1), random_state=0):
+    """
+    Updates the classifier of an online pipeline with the examples in the field records X. The field features
+    don't depend on the training data, so the rest of the pipeline stays as it is.
+    """
+    union = model.named_steps['union']
+    classifier = model.steps[-1][1]
+    y = np.asarray(y)
+
+    order = np.random.RandomState(random_state).permutation(len(X))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        classifier.partial_fit(union.transform(X[batch]), y[batch], classes=list(classes))
+    return model
+
+
+def _has_stateless_union(model):
+    return all(isinstance(step, STATELESS_STEPS)
+               for _, field_pipe in model.named_steps['union'].transformer_list for _, step in field_pipe.steps)
@@ -142,6 +142,22 @@ USER_MODELS = os.path.join(BASE_DIR, 'data', 'usermodels')
 #
 MODELS_DIR = os.path.join(BASE_DIR, 'data', 'models')
 
+# Load language models as read-only memory-mapped arrays, shared by all worker processes.
+#
+MODELS_MMAP = os.getenv('TEXTA_MODELS_MMAP', 'true').lower() == 'true'
+
+# Number of processes entity extractors tag large preprocessing batches in, 1 tags in the preprocessing process.
+#
+CRF_INFERENCE_PROCESSES = int(os.getenv('TEXTA_CRF_INFERENCE_PROCESSES', 1))
+
+# Number of processes grammar searches match large batches of documents in, 1 matches them in the request process.
+#
+GRAMMAR_MATCH_PROCESSES = int(os.getenv('TEXTA_GRAMMAR_MATCH_PROCESSES', 1))
+
+# Throttling of the update by query tasks of the fact adder and deleter, -1 disables throttling.
+#
+UPDATE_BY_QUERY_REQUESTS_PER_SECOND = int(os.getenv('TEXTA_UPDATE_BY_QUERY_REQUESTS_PER_SECOND', -1))
+
 # Path to Sven's projects
 #
 SCRIPT_MANAGER_DIR = os.path.join(MEDIA_ROOT, 'script_manager')
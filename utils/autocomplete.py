@@ -1,8 +1,30 @@
-from conceptualiser.models import Term, TermConcept
+import heapq
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.db import connections
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from conceptualiser.models import Concept, Term, TermConcept
 from lexicon_miner.models import Lexicon
 from utils.datasets import Datasets
 from utils.es_manager import ES_Manager
 
+# Prefix indices older than this are rebuilt in the background, the old index keeps serving meanwhile.
+AUTOCOMPLETE_REFRESH_SECONDS = 300
+# Fact name and value pairs fetched per composite aggregation request.
+AUTOCOMPLETE_COMPOSITE_SIZE = 10000
+AUTOCOMPLETE_MAX_FACT_NAMES = 10000
+AUTOCOMPLETE_MAX_FACT_VALUES = 1000000
+# Number of fact names whose values are suggested when no fact name is given, like the terms aggregation default.
+AUTOCOMPLETE_FACT_NAME_BUCKETS = 10
+
+
 class Autocomplete:
 
     def __init__(self):
@@ -41,23 +63,20 @@ class Autocomplete:
         return suggestions
 
     def _get_facts(self, agg_subfield, lookup_type, key_constraint=None):
-        agg_query = {agg_subfield: {"nested": {"path": "texta_facts"}, "aggs": {agg_subfield: {"terms": {"field": "texta_facts.fact"}, "aggs": {"fact_values": {"terms": {"field": "texta_facts.str_val", "size": self.limit, "include": "{0}.*".format(self.content)}}}}}}}
+        fact_index = fact_indices.get(self.es_m.stringify_datasets(), self.es_m)
 
-        self.es_m.build('')
-        self.es_m.set_query_parameter("aggs", agg_query)
+        if lookup_type == 'FACT_VAL':
+            if key_constraint:
+                fact_names = [key_constraint]
+            else:
+                fact_names = [fact_name for fact_name, _, _ in fact_index.names.search('', AUTOCOMPLETE_FACT_NAME_BUCKETS)]
 
-        if lookup_type == 'FACT_VAL' and key_constraint:
             facts = []
-            for bucket in self.es_m.search()["aggregations"][agg_subfield][agg_subfield]["buckets"]:
-                if bucket["key"] == key_constraint:
-                    facts += [self._format_suggestion(sub_bucket["key"], sub_bucket["key"]) for sub_bucket in bucket["fact_values"]["buckets"]]
-
-        elif lookup_type == 'FACT_VAL' and not key_constraint:
-            facts = []
-            for bucket in self.es_m.search()["aggregations"][agg_subfield][agg_subfield]["buckets"]:
-                facts += [self._format_suggestion(sub_bucket["key"], sub_bucket["key"]) for sub_bucket in bucket["fact_values"]["buckets"]]
+            for fact_name in fact_names:
+                if fact_name in fact_index.values:
+                    facts += [self._format_suggestion(value, value) for value, _, _ in fact_index.values[fact_name].search(self.content, self.limit)]
         else:
-            facts = [self._format_suggestion(a["key"],a["key"]) for a in self.es_m.search()["aggregations"][agg_subfield][agg_subfield]["buckets"]]
+            facts = [self._format_suggestion(fact_name, fact_name) for fact_name, _, _ in fact_index.names.search(self.content, self.limit)]
 
         return facts
 
@@ -65,20 +84,19 @@ class Autocomplete:
         concepts = []
 
         if len(self.content) > 0:
-            terms = Term.objects.filter(term__startswith=self.content).filter(author=self.user)
+            concept_index = concept_indices.get(self.user.pk, self.user)
             seen = {}
-            for term in terms[:self.limit]:
-                for term_concept in TermConcept.objects.filter(term=term.pk):
-                    concept = term_concept.concept
-                    concept_term = (concept.pk,term.term)
+            for term, _, term_concepts in concept_index.search(self.content, self.limit):
+                for concept_pk, descriptive_term in term_concepts:
+                    concept_term = (concept_pk,term)
 
                     if concept_term not in seen:
                         seen[concept_term] = True
 
-                        display_term = term.term.replace(self.content,'<font color="red">'+self.content+'</font>')
-                        display_text = '<b>{0}</b>@C{1}-{2}'.format(display_term,concept.pk,concept.descriptive_term.term)
+                        display_term = term.replace(self.content,'<font color="red">'+self.content+'</font>')
+                        display_text = '<b>{0}</b>@C{1}-{2}'.format(display_term,concept_pk,descriptive_term)
 
-                        suggestion = self._format_suggestion(concept.descriptive_term.term,display_text,resource_id=concept.pk)
+                        suggestion = self._format_suggestion(descriptive_term,display_text,resource_id=concept_pk)
                         concepts.append(suggestion)
 
         return concepts
@@ -87,16 +105,225 @@ class Autocomplete:
         suggested_lexicons = []
 
         if len(self.content) > 0:
-            lexicons = Lexicon.objects.filter(name__startswith=self.content).filter(author=self.user)
-            for lexicon in lexicons:
-                display_term = lexicon.name.replace(self.content,'<font color="red">'+self.content+'</font>')
-                display_text = '<b>{0}</b>@L{1}-{2}'.format(display_term,lexicon.pk,lexicon.name)
+            lexicon_index = lexicon_indices.get(self.user.pk, self.user)
+            for name, _, lexicon_pks in lexicon_index.search(self.content, self.limit):
+                for lexicon_pk in lexicon_pks:
+                    display_term = name.replace(self.content,'<font color="red">'+self.content+'</font>')
+                    display_text = '<b>{0}</b>@L{1}-{2}'.format(display_term,lexicon_pk,name)
 
-                suggestion = self._format_suggestion(lexicon.name,display_text,resource_id=lexicon.pk)
-                suggested_lexicons.append(suggestion)
+                    suggestion = self._format_suggestion(name,display_text,resource_id=lexicon_pk)
+                    suggested_lexicons.append(suggestion)
 
         return suggested_lexicons
 
     @staticmethod
     def _format_suggestion(entry_text,display_text,resource_id=''):
-        return {'entry_text':entry_text,'display_text':display_text,'resource_id':resource_id}
\ No newline at end of file
+        return {'entry_text':entry_text,'display_text':display_text,'resource_id':resource_id}
+
+
+class PrefixIndex:
+    """
+    Sorted array of (key, weight, value) entries, looked up by key prefix with bisect.
+
+    Matches are returned by descending weight, ties in key order. Short prefixes match a large part
+    of the index, so their results are memoized up to CACHED_RESULT_SIZE entries.
+    """
+    CACHED_PREFIX_LENGTH = 2
+    CACHED_RESULT_SIZE = 50
+
+    def __init__(self, entries):
+        self.entries = sorted(entries, key=lambda entry: entry[0])
+        self.keys = [entry[0] for entry in self.entries]
+        self._cached_results = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def search(self, prefix, limit):
+        if len(prefix) > self.CACHED_PREFIX_LENGTH or limit > self.CACHED_RESULT_SIZE:
+            return self._search(prefix, limit)
+
+        if prefix not in self._cached_results:
+            self._cached_results[prefix] = self._search(prefix, self.CACHED_RESULT_SIZE)
+        return self._cached_results[prefix][:limit]
+
+    def _search(self, prefix, limit):
+        start = bisect_left(self.keys, prefix)
+        if prefix:
+            # Every key starting with the prefix sorts before the prefix with its last character incremented.
+            end = bisect_left(self.keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        else:
+            end = len(self.keys)
+
+        best = heapq.nsmallest(limit, range(start, end), key=lambda idx: (-self.entries[idx][1], idx))
+        return [self.entries[idx] for idx in best]
+
+
+class FactIndex:
+    """Prefix indices of the fact names and of the string values of every fact name, weighted by fact count."""
+
+    def __init__(self, name_counts, value_counts):
+        self.names = PrefixIndex((name, count, None) for name, count in name_counts.items())
+        self.values = {name: PrefixIndex((value, count, None) for value, count in counts.items()) for name, counts in value_counts.items()}
+
+
+class PrefixIndexCache:
+    """
+    Keeps one prefix index per scope, built with build_index(*args) on first use.
+    Concurrent first lookups of a scope wait for a single build. Stale indices are rebuilt in a background thread,
+    invalidated indices on the next lookup. Builds that started before an invalidation are not stored.
+
+    Invalidation only reaches the current process. If get_version(*args) is given, it is called on every lookup with a
+    cheap query of the indexed data, and the index is rebuilt once the returned version changes.
+    """
+
+    def __init__(self, build_index, refresh_seconds=AUTOCOMPLETE_REFRESH_SECONDS, get_version=None):
+        self.build_index = build_index
+        self.get_version = get_version
+        self.refresh_seconds = refresh_seconds
+        self.indices = {}
+        self.refreshing = set()
+        self.build_locks = {}
+        # Invalidating every scope bumps generation, invalidating one scope its entry in scope_generations.
+        self.generation = 0
+        self.scope_generations = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def get(self, scope, *args):
+        version = self.get_version(*args) if self.get_version else None
+        cached = self.indices.get(scope)
+        if cached is None or cached[1] != version:
+            return self._build(scope, version, *args)
+
+        built_at, _, index = cached
+        if time.time() - built_at > self.refresh_seconds:
+            with self.lock:
+                start_refresh = scope not in self.refreshing
+                self.refreshing.add(scope)
+            if start_refresh:
+                threading.Thread(target=self._refresh, args=(scope,) + args, daemon=True).start()
+        return index
+
+    def invalidate(self, scope=None):
+        with self.lock:
+            if scope is None:
+                self.generation += 1
+                self.indices.clear()
+            else:
+                self.scope_generations[scope] += 1
+                self.indices.pop(scope, None)
+
+    def _build(self, scope, version, *args):
+        with self.lock:
+            build_lock = self.build_locks.setdefault(scope, threading.Lock())
+        with build_lock:
+            # Another lookup may have built the index while this one waited.
+            cached = self.indices.get(scope)
+            if cached is not None and cached[1] == version:
+                return cached[2]
+            generation = self._get_generation(scope)
+            index = self.build_index(*args)
+            self._store(scope, generation, version, index)
+            return index
+
+    def _refresh(self, scope, *args):
+        try:
+            generation = self._get_generation(scope)
+            version = self.get_version(*args) if self.get_version else None
+            self._store(scope, generation, version, self.build_index(*args))
+        finally:
+            with self.lock:
+                self.refreshing.discard(scope)
+            # Database connections are per thread, close the one the refresh opened.
+            connections.close_all()
+
+    def _get_generation(self, scope):
+        with self.lock:
+            return self.generation, self.scope_generations[scope]
+
+    def _store(self, scope, generation, version, index):
+        with self.lock:
+            if (self.generation, self.scope_generations[scope]) == generation:
+                self.indices[scope] = (time.time(), version, index)
+
+
+def build_fact_index(es_m):
+    """Collects the fact names and values of the active datasets with a nested composite aggregation."""
+    search_url = '{0}/{1}/_search'.format(es_m.es_url, es_m.stringify_datasets())
+    name_counts = {}
+    value_counts = defaultdict(dict)
+    value_count = 0
+    after_key = None
+
+    while value_count < AUTOCOMPLETE_MAX_FACT_VALUES:
+        composite = {'size': AUTOCOMPLETE_COMPOSITE_SIZE, 'sources': [{'fact': {'terms': {'field': 'texta_facts.fact'}}},
+                                                                      {'str_val': {'terms': {'field': 'texta_facts.str_val'}}}]}
+        aggs = {'fact_values': {'composite': composite}}
+        if after_key:
+            composite['after'] = after_key
+        else:
+            # Facts with only numeric values have no str_val, their names are counted separately.
+            aggs['fact_names'] = {'terms': {'field': 'texta_facts.fact', 'size': AUTOCOMPLETE_MAX_FACT_NAMES}}
+
+        response = es_m.plain_post(search_url, json.dumps({'size': 0, 'aggs': {'texta_facts': {'nested': {'path': 'texta_facts'}, 'aggs': aggs}}}))
+        aggregations = response['aggregations']['texta_facts']
+
+        if 'fact_names' in aggregations:
+            name_counts = {bucket['key']: bucket['doc_count'] for bucket in aggregations['fact_names']['buckets']}
+
+        buckets = aggregations['fact_values']['buckets']
+        for bucket in buckets:
+            value_counts[bucket['key']['fact']][bucket['key']['str_val']] = bucket['doc_count']
+        value_count += len(buckets)
+
+        after_key = aggregations['fact_values'].get('after_key')
+        if len(buckets) < AUTOCOMPLETE_COMPOSITE_SIZE or not after_key:
+            break
+
+    return FactIndex(name_counts, value_counts)
+
+
+def build_concept_index(user):
+    """Indexes the terms of the user with the (concept id, descriptive term) pairs of every term."""
+    term_concepts = defaultdict(list)
+    for term, concept_pk, descriptive_term in TermConcept.objects.filter(term__author=user).order_by('term_id', 'pk').values_list('term__term', 'concept_id', 'concept__descriptive_term__term'):
+        term_concepts[term].append((concept_pk, descriptive_term))
+
+    return PrefixIndex((term, 0, concepts) for term, concepts in term_concepts.items())
+
+
+def build_lexicon_index(user):
+    """Indexes the lexicon names of the user with the ids of the lexicons of every name."""
+    lexicon_pks = defaultdict(list)
+    for lexicon_pk, name in Lexicon.objects.filter(author=user).order_by('pk').values_list('pk', 'name'):
+        lexicon_pks[name].append(lexicon_pk)
+
+    return PrefixIndex((name, 0, pks) for name, pks in lexicon_pks.items())
+
+
+def get_concept_version(user):
+    """Changes when term concepts of the user are added or removed, also in other processes."""
+    return tuple(TermConcept.objects.filter(term__author=user).aggregate(count=Count('pk'), max_pk=Max('pk')).values())
+
+
+def get_lexicon_version(user):
+    """Changes when lexicons of the user are added or removed, also in other processes."""
+    return tuple(Lexicon.objects.filter(author=user).aggregate(count=Count('pk'), max_pk=Max('pk')).values())
+
+
+# Fact indices are scoped by the active datasets, concept and lexicon indices by the user id.
+fact_indices = PrefixIndexCache(build_fact_index)
+concept_indices = PrefixIndexCache(build_concept_index, get_version=get_concept_version)
+lexicon_indices = PrefixIndexCache(build_lexicon_index, get_version=get_lexicon_version)
+
+
+@receiver([post_save, post_delete], sender=Lexicon)
+def invalidate_lexicon_index(sender, instance, **kwargs):
+    lexicon_indices.invalidate(instance.author_id)
+
+
+@receiver([post_save, post_delete], sender=Term)
+@receiver([post_save, post_delete], sender=Concept)
+@receiver([post_save, post_delete], sender=TermConcept)
+def invalidate_concept_index(sender, instance, **kwargs):
+    concept_indices.invalidate()
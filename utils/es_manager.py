@@ -128,6 +128,23 @@ class ES_Manager:
             '{0}/{1}/_update_by_query?conflicts=proceed'.format(self.es_url, self.stringify_datasets()), data=query)
         return response
 
+    def start_update_by_query_task(self, body, requests_per_second=-1):
+        """Starts a sliced, throttled _update_by_query over the active datasets as an Elasticsearch task, returns the task id.
+        requests_per_second -1 disables throttling.
+        """
+        url = '{0}/{1}/_update_by_query?conflicts=proceed&refresh&slices=auto&wait_for_completion=false&requests_per_second={2}'.format(
+            self.es_url, self.stringify_datasets(), requests_per_second)
+        response = self.plain_post(url, json.dumps(body))
+        if 'task' not in response:
+            raise ElasticsearchException('Update by query could not be started: {}'.format(response.get('error', response)))
+        return response['task']
+
+    def get_task(self, task_id):
+        return self.plain_get('{0}/_tasks/{1}'.format(self.es_url, task_id))
+
+    def cancel_task(self, task_id):
+        return self.plain_post('{0}/_tasks/{1}/_cancel'.format(self.es_url, task_id))
+
     def _decode_mapping_structure(self, structure, root_path=list(), nested_layers=list()):
         """ Decode mapping structure (nested dictionary) to a flat structure
         """
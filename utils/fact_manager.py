@@ -54,6 +54,9 @@ class FactManager:
 
 
 class FactGraph(FactManager):
+    # Elasticsearch index.max_adjacency_matrix_filters defaults to 100
+    ADJACENCY_MATRIX_CHUNK_SIZE = 50
+
     def __init__(self, request, es_params, search_size):
         super().__init__(request)
         self.es_params = es_params
@@ -63,9 +66,10 @@ class FactGraph(FactManager):
 
 
     def fact_graph(self):
-        facts, fact_combinations, unique_fact_names = self.facts_via_aggregation(size=self.search_size)
-        # Get cooccurrences and remove values with 0
-        fact_combinations = {k:v for k,v in dict(zip(fact_combinations, self.count_cooccurrences(fact_combinations))).items() if v != 0}
+        facts, _, unique_fact_names = self.facts_via_aggregation(size=self.search_size, with_combinations=False)
+        # Get cooccurrences, pairs that never cooccur are left out
+        fact_values = [(fact['name'], fact['value']) for fact in sorted(facts.values(), key=lambda fact: fact['id'])]
+        fact_combinations = self.count_cooccurrences_via_adjacency_matrix(fact_values)
         types = dict(zip(unique_fact_names, itertools.cycle(self.shapes)))
 
         nodes = []
@@ -90,10 +94,11 @@ class FactGraph(FactManager):
         graph_data = json.dumps({"nodes": nodes, "links": links})
         return (graph_data, unique_fact_names, max_node_size, max_link_size, min_node_size)
 
-    def facts_via_aggregation(self, size=15):
+    def facts_via_aggregation(self, size=15, with_combinations=True):
         """Finds all facts from current search.
         Parameters:
             size - [int=15] -- Amount of fact values per fact name to search in query
+            with_combinations - [bool=True] -- If False, fact_combinations is left empty
         Returns:
             facts - [dict] -- Details for each fact, ex: {'PER - kostja': {'id': 0, 'name': 'PER', 'value': 'kostja', 'doc_count': 44}}
             fact_combinations - [list of tuples] -- All possible combinations of all facts: [(('FIRST_FACTNAME', 'FIRST_FACTVAL'), ('SECOND_FACTNAME', 'SECOND_FACTVAL'))]
@@ -117,7 +122,7 @@ class FactGraph(FactManager):
                 facts[bucket['key'] + " - " + fact['key']] = {'id': fact_count, 'name': bucket['key'], 'value': fact['key'], 'doc_count': fact['doc_count']}
                 fact_combinations.append((bucket['key'], fact['key']))
                 fact_count += 1
-        fact_combinations = [x for x in itertools.combinations(fact_combinations, 2)]
+        fact_combinations = [x for x in itertools.combinations(fact_combinations, 2)] if with_combinations else []
         return (facts, fact_combinations, unique_fact_names)
 
 
@@ -147,6 +152,57 @@ class FactGraph(FactManager):
         counts = [response["hits"]["total"] for response in responses]
         return counts
 
+    def count_cooccurrences_via_adjacency_matrix(self, fact_values):
+        """Finds the counts of cooccurring facts with adjacency_matrix aggregations
+
+        The facts are split into chunks and every pair of chunks is counted by one adjacency_matrix aggregation,
+        all of them sent in a single multi-search. A request holds at most 2 * ADJACENCY_MATRIX_CHUNK_SIZE filters,
+        which has to stay within the index.max_adjacency_matrix_filters setting of Elasticsearch.
+
+        Arguments:
+            fact_values {list of tuples} -- Example: [('ORG', 'Riigikohus'), ('PER', 'Jaan'), ('PER', 'Peeter')]
+
+        Returns:
+            [dict] -- Occurrences of the cooccurring fact pairs, pairs with no cooccurrences are left out.
+                      Example: {(('ORG', 'Riigikohus'), ('PER', 'Jaan')): 4}
+        """
+        dataset_str = self.es_m.stringify_datasets()
+        chunk_size = self.ADJACENCY_MATRIX_CHUNK_SIZE
+        chunks = [list(range(start, min(start + chunk_size, len(fact_values)))) for start in range(0, len(fact_values), chunk_size)]
+
+        # Every pair of chunks also covers the pairs inside both of the chunks.
+        if len(chunks) > 1:
+            fact_id_groups = [first_chunk + second_chunk for first_chunk, second_chunk in itertools.combinations(chunks, 2)]
+        else:
+            fact_id_groups = chunks
+
+        queries = []
+        for fact_ids in fact_id_groups:
+            filters = {}
+            for fact_id in fact_ids:
+                fact_name, fact_value = fact_values[fact_id]
+                filters['f{0}'.format(fact_id)] = {"nested": {"path": "texta_facts", "query": {"bool": {"must": [{"term": {"texta_facts.fact": fact_name}}, {"term": {"texta_facts.str_val": fact_value}}]}}}}
+            query = {"size": 0, "aggs": {"cooccurrences": {"adjacency_matrix": {"filters": filters}}}}
+            queries.append(json.dumps({"index": dataset_str}))
+            queries.append(json.dumps(query))
+
+        cooccurrences = {}
+        if not queries:
+            return cooccurrences
+
+        for response in self.es_m.perform_queries(queries):
+            if 'aggregations' not in response:
+                logging.getLogger(ERROR_LOGGER).error("Fact cooccurrence query failed: {0}".format(response.get('error', response)))
+                continue
+
+            for bucket in response['aggregations']['cooccurrences']['buckets']:
+                # Intersection buckets are keyed as "f1&f5"
+                if '&' in bucket['key'] and bucket['doc_count']:
+                    first_id, second_id = sorted(int(filter_name[1:]) for filter_name in bucket['key'].split('&'))
+                    cooccurrences[(fact_values[first_id], fact_values[second_id])] = bucket['doc_count']
+
+        return cooccurrences
+
 
 class FactAdder(FactManager):
     def __init__(self, request):
@@ -0,0 +1,136 @@
+import os
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# Approximate indices are stored next to the model file, model_<id> + suffix.
+HNSW_INDEX_SUFFIX = '.hnsw'
+IVF_INDEX_SUFFIX = '.ivf.npz'
+
+# Smaller vocabularies are searched exactly, a full dot product over them is already fast.
+ANN_MIN_VOCABULARY = 50000
+
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF = 100
+
+# The vocabulary is split into sqrt(vocabulary size) lists, so that IVF_PROBES lists
+# hold O(sqrt(vocabulary size)) candidates.
+IVF_PROBES = 16
+IVF_TRAIN_SAMPLE = 100000
+IVF_TRAIN_ITERATIONS = 10
+IVF_BATCH_SIZE = 100000
+
+
+class HnswIndex:
+    """Hierarchical navigable small world graph over the normalized vectors, requires the hnswlib package."""
+
+    def __init__(self, index):
+        self.index = index
+
+    @classmethod
+    def build(cls, vectors):
+        index = hnswlib.Index(space='ip', dim=vectors.shape[1])
+        index.init_index(max_elements=len(vectors), ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+        index.add_items(vectors, np.arange(len(vectors)))
+        index.set_ef(HNSW_EF)
+        return cls(index)
+
+    @classmethod
+    def load(cls, path, dim):
+        index = hnswlib.Index(space='ip', dim=dim)
+        index.load_index(path)
+        index.set_ef(HNSW_EF)
+        return cls(index)
+
+    def save(self, model_path):
+        self.index.save_index(model_path + HNSW_INDEX_SUFFIX)
+
+    def candidates(self, query_vectors, k):
+        """Returns the indices of the k nearest vectors of every query vector."""
+        k = min(k, self.index.get_current_count())
+        self.index.set_ef(max(HNSW_EF, k))
+        labels, _ = self.index.knn_query(np.asarray(query_vectors, dtype=np.float32), k=k)
+        return np.unique(labels)
+
+
+class IvfIndex:
+    """
+    Inverted file index, a pure numpy fallback when hnswlib is not installed.
+
+    The vectors are clustered with spherical k-means and stored by cluster, a query scores the vectors of
+    the IVF_PROBES clusters whose centroids are nearest to it.
+    """
+
+    def __init__(self, centroids, order, offsets):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, vectors, seed=0):
+        rng = np.random.RandomState(seed)
+        n_lists = max(1, int(np.sqrt(len(vectors))))
+
+        sample = vectors[rng.choice(len(vectors), min(len(vectors), IVF_TRAIN_SAMPLE), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].astype(np.float32)
+        for _ in range(IVF_TRAIN_ITERATIONS):
+            labels = np.argmax(np.dot(sample, centroids.T), axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis=1)
+            # Empty clusters keep their previous centroid.
+            filled = norms > 0
+            centroids[filled] = sums[filled] / norms[filled, np.newaxis]
+
+        labels = np.concatenate([np.argmax(np.dot(vectors[start:start + IVF_BATCH_SIZE], centroids.T), axis=1)
+                                 for start in range(0, len(vectors), IVF_BATCH_SIZE)])
+        order = np.argsort(labels, kind='stable').astype(np.int32)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))]).astype(np.int64)
+        return cls(centroids, order, offsets)
+
+    @classmethod
+    def load(cls, path, dim=None):
+        with np.load(path) as data:
+            return cls(data['centroids'], data['order'], data['offsets'])
+
+    def save(self, model_path):
+        with open(model_path + IVF_INDEX_SUFFIX, 'wb') as fout:
+            np.savez(fout, centroids=self.centroids, order=self.order, offsets=self.offsets)
+
+    def candidates(self, query_vectors, k):
+        """Returns the indices of the vectors in the lists nearest to the query vectors, at least k if the index has as many."""
+        centroid_dists = np.dot(np.asarray(query_vectors, dtype=np.float32), self.centroids.T)
+        probes = min(IVF_PROBES, len(self.centroids))
+        lists = np.argsort(-centroid_dists, axis=1)
+
+        while True:
+            probed = np.unique(lists[:, :probes])
+            candidates = np.concatenate([self.order[self.offsets[list_idx]:self.offsets[list_idx + 1]] for list_idx in probed])
+            if len(candidates) >= k or probes == len(self.centroids):
+                return candidates
+            probes = min(2 * probes, len(self.centroids))
+
+
+def build_ann_index(vectors):
+    """Builds an HNSW index, or an IVF index without hnswlib. Returns None for small vocabularies."""
+    if len(vectors) < ANN_MIN_VOCABULARY:
+        return None
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if hnswlib is not None:
+        return HnswIndex.build(vectors)
+    return IvfIndex.build(vectors)
+
+
+def load_ann_index(model_path, dim):
+    """Loads the index saved next to the model, None if the model has none."""
+    if hnswlib is not None and os.path.exists(model_path + HNSW_INDEX_SUFFIX):
+        return HnswIndex.load(model_path + HNSW_INDEX_SUFFIX, dim)
+    if os.path.exists(model_path + IVF_INDEX_SUFFIX):
+        return IvfIndex.load(model_path + IVF_INDEX_SUFFIX)
+    return None
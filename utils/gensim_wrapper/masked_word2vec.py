@@ -4,11 +4,25 @@ import numpy as np
 from six import string_types
 import gensim
 
+# Nearest neighbours fetched from the approximate index per requested result, before masking.
+ANN_CANDIDATE_FACTOR = 4
+# Queries scored by one matrix product in the batch methods, a batch needs
+# BATCH_QUERY_SIZE float32 distances per vocabulary word.
+BATCH_QUERY_SIZE = 16
+
+def top_k(dists, k):
+    """Returns the indices of the k largest dists in descending order, without sorting all of dists."""
+    if k >= len(dists):
+        return np.argsort(dists)[::-1]
+    best = np.argpartition(dists, -k)[-k:]
+    return best[np.argsort(dists[best])[::-1]]
+
 class MaskedWord2Vec(object):
 
-    def __init__(self,word2vec_model):
+    def __init__(self,word2vec_model,ann_index=None):
         self.model = word2vec_model
         self.vocab = word2vec_model.wv.vocab
+        self.ann_index = ann_index
     
     def most_similar(self, positive=[], negative=[], topn=10, ignored_idxes=[], ignored_dist = -999999):
         """
@@ -27,33 +41,17 @@ class MaskedWord2Vec(object):
             # allow calls like most_similar('dog'), as a shorthand for most_similar(['dog'])
             positive = [positive]
 
-        # add weights for each word, if not already present; default to 1.0 for positive and -1.0 for negative words
-        positive = [(word, 1.0) if isinstance(word, string_types + (np.ndarray,))
-                                else word for word in positive]
-        negative = [(word, -1.0) if isinstance(word, string_types + (np.ndarray,))
-                                 else word for word in negative]
+        mean, all_words = self._mean_vector(positive, negative)
+
+        if topn and self.ann_index is not None:
+            result = self._ann_most_similar(lambda idxes: np.dot(self.model.wv.syn0norm[idxes], mean), [mean], topn, all_words, ignored_idxes)
+            if result is not None:
+                return result
 
-        # compute the weighted average of all words
-        all_words, mean = set(), []
-        for word, weight in positive + negative:
-            if isinstance(word, np.ndarray):
-                mean.append(weight * word)
-            elif word in self.model.wv.vocab:
-                mean.append(weight * self.model.wv.syn0norm[self.model.wv.vocab[word].index])
-                all_words.add(self.model.wv.vocab[word].index)
-            else:
-                raise KeyError("word '%s' not in vocabulary" % word)
-        if not mean:
-            raise ValueError("cannot compute similarity with no input")
-        mean = gensim.matutils.unitvec(np.array(mean).mean(axis=0)).astype(np.float32)
         dists = np.dot(self.model.wv.syn0norm, mean)
         if not topn:
             return dists
-        dists[ignored_idxes] = ignored_dist
-        best = np.argsort(dists)[::-1][:topn + len(all_words)]
-        # ignore (don't return) words from the input
-        result = [(self.model.wv.index2word[sim], float(dists[sim])) for sim in best if sim not in all_words]
-        return result[:topn]
+        return self._top_words(dists, topn, all_words, ignored_idxes, ignored_dist)
 
     def most_similar_cosmul(self, positive=[], negative=[], topn=10, ignored_idxes=[], ignored_dist = -999999):
         """
@@ -83,6 +81,109 @@ class MaskedWord2Vec(object):
             # allow calls like most_similar_cosmul('dog'), as a shorthand for most_similar_cosmul(['dog'])
             positive = [positive]
 
+        positive, negative, all_words = self._cosmul_terms(positive, negative)
+
+        if topn and self.ann_index is not None:
+            def cosmul(idxes):
+                vectors = self.model.wv.syn0norm[idxes]
+                pos_dists = [((1 + np.dot(vectors, term)) / 2) for term in positive]
+                neg_dists = [((1 + np.dot(vectors, term)) / 2) for term in negative]
+                return np.prod(pos_dists, axis=0) / (np.prod(neg_dists, axis=0) + 0.000001)
+
+            result = self._ann_most_similar(cosmul, positive, topn, all_words, ignored_idxes)
+            if result is not None:
+                return result
+
+        # equation (4) of Levy & Goldberg "Linguistic Regularities...",
+        # with distances shifted to [0,1] per footnote (7)
+        pos_dists = [((1 + np.dot(self.model.wv.syn0norm, term)) / 2) for term in positive]
+        neg_dists = [((1 + np.dot(self.model.wv.syn0norm, term)) / 2) for term in negative]
+        dists = np.prod(pos_dists, axis=0) / (np.prod(neg_dists, axis=0) + 0.000001)
+
+        if not topn:
+            return dists
+        return self._top_words(dists, topn, all_words, ignored_idxes, ignored_dist)
+
+    def most_similar_batch(self, positives, negatives=None, topn=10, ignored_idxes=[], ignored_dist = -999999):
+        """
+        most_similar for many queries at once, positives and negatives hold the word lists of every query.
+        The similarities of BATCH_QUERY_SIZE queries are computed with one matrix product.
+        Returns the results of every query in the order of positives.
+        """
+        self.model.init_sims()
+        negatives = negatives if negatives is not None else [[] for _ in positives]
+
+        if self.ann_index is not None:
+            return [self.most_similar(positive=positive, negative=negative, topn=topn, ignored_idxes=ignored_idxes, ignored_dist=ignored_dist)
+                    for positive, negative in zip(positives, negatives)]
+
+        queries = [self._mean_vector([positive] if isinstance(positive, string_types) else positive, negative)
+                   for positive, negative in zip(positives, negatives)]
+
+        results = []
+        for start in range(0, len(queries), BATCH_QUERY_SIZE):
+            batch = queries[start:start + BATCH_QUERY_SIZE]
+            batch_dists = np.dot(np.array([mean for mean, _ in batch]), self.model.wv.syn0norm.T)
+            for dists, (_, all_words) in zip(batch_dists, batch):
+                results.append(self._top_words(dists, topn, all_words, ignored_idxes, ignored_dist))
+        return results
+
+    def most_similar_cosmul_batch(self, positives, negatives=None, topn=10, ignored_idxes=[], ignored_dist = -999999):
+        """
+        most_similar_cosmul for many queries at once, positives and negatives hold the word lists of every query.
+        The similarities to the terms of BATCH_QUERY_SIZE queries are computed with one matrix product.
+        Returns the results of every query in the order of positives.
+        """
+        self.model.init_sims()
+        negatives = negatives if negatives is not None else [[] for _ in positives]
+
+        if self.ann_index is not None:
+            return [self.most_similar_cosmul(positive=positive, negative=negative, topn=topn, ignored_idxes=ignored_idxes, ignored_dist=ignored_dist)
+                    for positive, negative in zip(positives, negatives)]
+
+        queries = [self._cosmul_terms([positive] if isinstance(positive, string_types) else positive, negative)
+                   for positive, negative in zip(positives, negatives)]
+
+        results = []
+        for start in range(0, len(queries), BATCH_QUERY_SIZE):
+            batch = queries[start:start + BATCH_QUERY_SIZE]
+            terms = np.array([term for positive, negative, _ in batch for term in positive + negative], dtype=np.float32)
+            term_dists = (1 + np.dot(self.model.wv.syn0norm, terms.T)) / 2
+
+            column = 0
+            for positive, negative, all_words in batch:
+                pos_dists = term_dists[:, column:column + len(positive)]
+                neg_dists = term_dists[:, column + len(positive):column + len(positive) + len(negative)]
+                column += len(positive) + len(negative)
+
+                dists = np.prod(pos_dists, axis=1) / (np.prod(neg_dists, axis=1) + 0.000001)
+                results.append(self._top_words(dists, topn, all_words, ignored_idxes, ignored_dist))
+        return results
+
+    def _mean_vector(self, positive, negative):
+        """Returns the unit length weighted mean of the query words and the indices of the words."""
+        # add weights for each word, if not already present; default to 1.0 for positive and -1.0 for negative words
+        positive = [(word, 1.0) if isinstance(word, string_types + (np.ndarray,))
+                                else word for word in positive]
+        negative = [(word, -1.0) if isinstance(word, string_types + (np.ndarray,))
+                                 else word for word in negative]
+
+        # compute the weighted average of all words
+        all_words, mean = set(), []
+        for word, weight in positive + negative:
+            if isinstance(word, np.ndarray):
+                mean.append(weight * word)
+            elif word in self.model.wv.vocab:
+                mean.append(weight * self.model.wv.syn0norm[self.model.wv.vocab[word].index])
+                all_words.add(self.model.wv.vocab[word].index)
+            else:
+                raise KeyError("word '%s' not in vocabulary" % word)
+        if not mean:
+            raise ValueError("cannot compute similarity with no input")
+        return gensim.matutils.unitvec(np.array(mean).mean(axis=0)).astype(np.float32), all_words
+
+    def _cosmul_terms(self, positive, negative):
+        """Returns the vectors of the positive and negative query words and the indices of the words."""
         all_words = set()
 
         def word_vec(word):
@@ -98,17 +199,27 @@ class MaskedWord2Vec(object):
         negative = [word_vec(word) for word in negative]
         if not positive:
             raise ValueError("cannot compute similarity with no input")
+        return positive, negative, all_words
 
-        # equation (4) of Levy & Goldberg "Linguistic Regularities...",
-        # with distances shifted to [0,1] per footnote (7)
-        pos_dists = [((1 + np.dot(self.model.wv.syn0norm, term)) / 2) for term in positive]
-        neg_dists = [((1 + np.dot(self.model.wv.syn0norm, term)) / 2) for term in negative]
-        dists = np.prod(pos_dists, axis=0) / (np.prod(neg_dists, axis=0) + 0.000001)
-
-        if not topn:
-            return dists
+    def _top_words(self, dists, topn, all_words, ignored_idxes, ignored_dist):
         dists[ignored_idxes] = ignored_dist
-        best = np.argsort(dists)[::-1][:topn + len(all_words)]
+        best = top_k(dists, topn + len(all_words))
         # ignore (don't return) words from the input
         result = [(self.model.wv.index2word[sim], float(dists[sim])) for sim in best if sim not in all_words]
         return result[:topn]
+
+    def _ann_most_similar(self, score, query_vectors, topn, all_words, ignored_idxes):
+        """
+        Scores the nearest neighbours of query_vectors in the approximate index with score(idxes).
+        Input words and ignored_idxes are never returned. Returns None if fewer than topn candidates
+        are left after masking, the caller then falls back to exact search.
+        """
+        excluded = np.union1d(np.array(list(all_words), dtype=np.int64), np.array(ignored_idxes, dtype=np.int64))
+        candidates = self.ann_index.candidates(query_vectors, ANN_CANDIDATE_FACTOR * topn + len(excluded))
+        candidates = candidates[~np.isin(candidates, excluded)]
+        if len(candidates) < topn:
+            return None
+
+        dists = score(candidates)
+        best = top_k(dists, topn)
+        return [(self.model.wv.index2word[candidates[idx]], float(dists[idx])) for idx in best]
@@ -1,4 +1,5 @@
 from __future__ import print_function
+from bisect import bisect_right
 from collections import Counter, defaultdict
 import re
 import math
@@ -268,6 +269,132 @@ class Highlighter(object):
             return Counter(color_code_list).most_common(1)[0][0]
 
 
+class IntervalHighlighter(Highlighter):
+    """
+    Produces the same output as Highlighter, but never materialises per-character data.
+    Highlight spans are mapped onto runs of aligned characters and the span boundaries are
+    swept once in sorted order, so the cost depends on the number of spans and tags
+    instead of the length of the document.
+
+    Highlight spans are expected to be non-negative [start, end] pairs.
+    """
+
+    _tag_pattern = re.compile(r'<[^>]*>')
+
+    def highlight(self, original_text, highlight_data, tagged_text=None):
+        if tagged_text:
+            if self._derive_spans:
+                runs = [(0, len(original_text), 0)]
+                highlight_data.extend(self._derive_highlight_data(tagged_text))
+                tagged_text = original_text
+            else:
+                runs = self._get_alignment_runs(original_text, tagged_text)
+        else:
+            runs = [(0, len(original_text), 0)]
+            tagged_text = original_text
+
+        spans_to_tags = self._get_tags_for_runs(tagged_text, runs, highlight_data)
+        split_text = self._split_text_at_indices(tagged_text, [index for span, tag in spans_to_tags for index in span])
+
+        return self._merge_text_and_tags(split_text, [tag for span, tag in spans_to_tags])
+
+    def _get_alignment_runs(self, original_text, tagged_text):
+        """Returns the alignment as (original_start, original_end, tagged_start) runs of consecutive characters."""
+        runs = []
+        original_idx = 0
+        tagged_idx = 0
+        stripped_parts = []
+
+        for tag_match in self._tag_pattern.finditer(tagged_text):
+            stripped_parts.append(tagged_text[tagged_idx:tag_match.start()])
+            runs.append((original_idx, original_idx + tag_match.start() - tagged_idx, tagged_idx))
+            original_idx += tag_match.start() - tagged_idx
+            tagged_idx = tag_match.end()
+
+        stripped_parts.append(tagged_text[tagged_idx:])
+        runs.append((original_idx, original_idx + len(tagged_text) - tagged_idx, tagged_idx))
+
+        # The fast path only holds when the tagged text is the original text with markup added.
+        # Anything else (unterminated tags, altered characters) goes through the per-character alignment.
+        if not ''.join(stripped_parts).startswith(original_text):
+            return self._alignment_to_runs(self._align_texts(original_text, tagged_text))
+
+        clipped_runs = []
+        for original_start, original_end, tagged_start in runs:
+            original_end = min(original_end, len(original_text))
+            if original_start < original_end:
+                clipped_runs.append((original_start, original_end, tagged_start))
+
+        return clipped_runs
+
+    def _alignment_to_runs(self, alignment):
+        runs = []
+        run_start = 0
+
+        for original_idx in range(1, len(alignment) + 1):
+            if original_idx == len(alignment) or alignment[original_idx] != alignment[original_idx - 1] + 1:
+                runs.append((run_start, original_idx, alignment[run_start]))
+                run_start = original_idx
+
+        return runs
+
+    def _get_tags_for_runs(self, text, runs, highlight_data):
+        if not text:
+            return []
+
+        run_starts = [run[0] for run in runs]
+        aligned_length = runs[-1][1] if runs else 0
+
+        # Boundary position -> list of (data_index, +1/-1) changes.
+        boundaries = defaultdict(list)
+        for data_index, datum in enumerate(highlight_data):
+            for span in datum['spans']:
+                span_start, span_end = max(span[0], 0), min(span[1], aligned_length)
+                if span_start >= span_end:
+                    continue
+
+                run_idx = bisect_right(run_starts, span_start) - 1
+                while run_idx < len(runs) and runs[run_idx][0] < span_end:
+                    original_start, original_end, tagged_start = runs[run_idx]
+                    start = max(span_start, original_start)
+                    end = min(span_end, original_end)
+                    if start < end:
+                        boundaries[tagged_start + start - original_start].append((data_index, 1))
+                        boundaries[tagged_start + end - original_start].append((data_index, -1))
+                    run_idx += 1
+
+        spans_to_tags = []
+        tag_cache = {}
+        active_counts = Counter()
+        segment_start = 0
+        previous_data_indices = frozenset()
+
+        for position in sorted(boundaries):
+            for data_index, change in boundaries[position]:
+                active_counts[data_index] += change
+                if not active_counts[data_index]:
+                    del active_counts[data_index]
+
+            data_indices = frozenset(sorted(active_counts))
+            if data_indices == previous_data_indices:
+                continue
+
+            if position > segment_start:
+                spans_to_tags.append(([segment_start, position], self._get_cached_tag(tag_cache, previous_data_indices, highlight_data)))
+                segment_start = position
+            previous_data_indices = data_indices
+
+        if segment_start < len(text):
+            spans_to_tags.append(([segment_start, len(text)], self._get_cached_tag(tag_cache, previous_data_indices, highlight_data)))
+
+        return spans_to_tags
+
+    def _get_cached_tag(self, tag_cache, data_indices, highlight_data):
+        if data_indices not in tag_cache:
+            tag_cache[data_indices] = self._get_tag_from_highlight_data([highlight_data[data_index] for data_index in data_indices])
+        return tag_cache[data_indices]
+
+
 class ColorPicker(object):
 
     colors = ["#E69F00", "#56B4E9", "#009E73", "#F0E442", "#0072B2", "#D55E00", "#CC79A7", "#999999"]
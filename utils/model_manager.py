@@ -1,17 +1,21 @@
 import os, errno
 import shutil
+import tempfile
 import threading
 from collections import defaultdict
 from time import sleep,time
 import json
 import gensim
+import numpy as np
+import psutil
 import traceback
 
+from .gensim_wrapper.ann_index import load_ann_index
 from .gensim_wrapper.masked_word2vec import MaskedWord2Vec
 
-from texta.settings import USER_MODELS, MODELS_DIR
+from texta.settings import USER_MODELS, MODELS_DIR, MODELS_MMAP
 import logging
-from texta.settings import ERROR_LOGGER
+from texta.settings import ERROR_LOGGER, INFO_LOGGER
 from task_manager.tasks.task_types import TaskTypes
 
 try:
@@ -19,6 +23,12 @@ try:
 except ImportError as e:
    import pickle
 
+# Normalized vectors of memory-mapped models are stored next to the model file, so that
+# init_sims does not allocate a private copy of them in every process.
+NORMALIZED_VECTORS_SUFFIX = '.vectors_norm.npy'
+# Rows normalized at once when the normalized vectors file is written.
+NORMALIZE_BATCH_SIZE = 100000
+
 class NegativesEntry:
 
     def __init__(self,negatives):
@@ -27,19 +37,21 @@ class NegativesEntry:
 
 class ModelEntry:
 
-    def __init__(self,model):
+    def __init__(self,model,model_path=None):
         self.model = model
+        self.model_path = model_path
         self.access_time = time()
 
 class ModelManager(threading.Thread):
 
-    def __init__(self,expiration_time,refresh_time,models=None):
+    def __init__(self,expiration_time,refresh_time,models=None,mmap_vectors=MODELS_MMAP):
         threading.Thread.__init__(self)
         self.daemon = True
         self._model_negatives = defaultdict(lambda: defaultdict(dict))
         self._models = {}
         self.expiration_time = expiration_time
         self.refresh_time = refresh_time
+        self.mmap_vectors = mmap_vectors
         self.to_be_deleted_negatives = []
         self.to_be_deleted_models = []
         self._negatives_lock = threading.Lock()
@@ -110,7 +122,10 @@ class ModelManager(threading.Thread):
             if model_uuid not in self._models:
                 model_path = os.path.join(MODELS_DIR,TaskTypes.TRAIN_MODEL, "model_%s"%model_uuid)
                 if os.path.exists(model_path):
-                    self._models[model_uuid] = ModelEntry(MaskedWord2Vec(gensim.models.Word2Vec.load(model_path)))
+                    model = self._load_word2vec(model_path)
+                    self._models[model_uuid] = ModelEntry(MaskedWord2Vec(model,load_ann_index(model_path,model.vector_size)),model_path)
+                    log_dict = {'task': 'get_model', 'event': 'model_loaded', 'data': {'model_uuid': model_uuid, 'memory_usage': self.get_memory_usage(model_uuid)[model_uuid]}}
+                    logging.getLogger(INFO_LOGGER).info("Model loaded", extra=log_dict)
                 else:
                     log_dict = {'task': 'get_model', 'event': 'model_path does not exist!', 'arguments': {'model_uuid': model_uuid, 'model_path': model_path}}
                     logging.getLogger(ERROR_LOGGER).error("Model path does not exist", extra=log_dict)
@@ -118,6 +133,80 @@ class ModelManager(threading.Thread):
             self._models[model_uuid].access_time = time()
             return self._models[model_uuid].model
 
+    def _load_word2vec(self,model_path):
+        if not self.mmap_vectors:
+            return gensim.models.Word2Vec.load(model_path)
+
+        # Arrays saved in separate .npy files are mapped read-only, their pages are shared by all processes.
+        model = gensim.models.Word2Vec.load(model_path, mmap='r')
+        model.wv.syn0norm = self._load_normalized_vectors(model_path, model.wv.syn0)
+        return model
+
+    @staticmethod
+    def _load_normalized_vectors(model_path,vectors):
+        normalized_path = model_path + NORMALIZED_VECTORS_SUFFIX
+
+        if not ModelManager._is_file_current(normalized_path, model_path):
+            # Every process writes its own temporary file, other processes loading the same model only ever see a complete file.
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(normalized_path) + '.', dir=os.path.dirname(normalized_path))
+            os.close(fd)
+            try:
+                normalized = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=vectors.shape)
+                for start in range(0, len(vectors), NORMALIZE_BATCH_SIZE):
+                    batch = np.asarray(vectors[start:start + NORMALIZE_BATCH_SIZE], dtype=np.float32)
+                    normalized[start:start + NORMALIZE_BATCH_SIZE] = batch / np.sqrt((batch ** 2).sum(-1))[..., np.newaxis]
+                normalized.flush()
+                del normalized
+                os.replace(tmp_path, normalized_path)
+            except OSError:
+                # Another process may have written the file in the meantime.
+                if not ModelManager._is_file_current(normalized_path, model_path):
+                    raise
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        return np.load(normalized_path, mmap_mode='r')
+
+    @staticmethod
+    def _is_file_current(path, model_path):
+        return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(model_path)
+
+    def get_memory_usage(self,model_uuid=None):
+        """
+        Returns the memory used by every loaded model in this process, or only by the given model, in bytes.
+
+        resident - pages of the model held in this process' memory
+        shared - resident pages of memory-mapped model files, also counted in other processes that map them
+        private - resident pages that belong only to this process, including arrays that are not memory-mapped
+        """
+        # Not under _models_lock, get_model holds it while it logs the usage of a model it loaded.
+        models = dict(self._models)
+        if model_uuid is not None:
+            models = {model_uuid: models[model_uuid]}
+
+        memory_maps = psutil.Process().memory_maps(grouped=True)
+        usage = {}
+        for model_uuid, entry in models.items():
+            model_usage = {'mmap': self.mmap_vectors, 'resident': 0, 'shared': 0, 'private': 0}
+            arrays = _get_model_arrays(entry.model.model)
+            mapped_paths = {os.path.realpath(array.filename) for array in arrays if isinstance(array, np.memmap) and array.filename}
+
+            for memory_map in memory_maps:
+                if os.path.realpath(memory_map.path) in mapped_paths:
+                    model_usage['resident'] += memory_map.rss
+                    model_usage['shared'] += memory_map.shared_clean + memory_map.shared_dirty
+                    model_usage['private'] += memory_map.private_clean + memory_map.private_dirty
+
+            for array in arrays:
+                if not isinstance(array, np.memmap):
+                    model_usage['resident'] += array.nbytes
+                    model_usage['private'] += array.nbytes
+
+            usage[model_uuid] = model_usage
+
+        return usage
+
 
 
     def get_negatives(self,model_name,username,lexicon_id):
@@ -181,8 +270,13 @@ class ModelManager(threading.Thread):
 
 
 
-def get_model_manager(expiration_time=300,refresh_time=60,models=None):
-    model_manager = ModelManager(expiration_time,refresh_time,models)
+def _get_model_arrays(model):
+    arrays = [model.wv.syn0, model.wv.syn0norm, getattr(model, 'syn1neg', None), getattr(model, 'syn1', None)]
+    return [array for array in arrays if isinstance(array, np.ndarray)]
+
+
+def get_model_manager(expiration_time=300,refresh_time=60,models=None,mmap_vectors=MODELS_MMAP):
+    model_manager = ModelManager(expiration_time,refresh_time,models,mmap_vectors)
     model_manager.start()
     return model_manager
 
@@ -3,13 +3,25 @@ import scipy.spatial.distance as scidist
 import scipy.cluster.hierarchy as hier
 import numpy as np
 import heapq
+import logging
+import time
 from sklearn.metrics import silhouette_score
 
+from texta.settings import INFO_LOGGER
+
+# Silhouette scores of larger word sets are estimated on a random sample of this many words.
+SILHOUETTE_SAMPLE_SIZE = 2000
+
 class DataPoint:
 
-    def __init__(self,label,vector):
+    def __init__(self,label,vector,idx=None):
         self.label = label
         self.vector = vector
+        self.idx = idx
+
+    def __lt__(self,other):
+        # heapq compares nodes of equal distance, their order does not matter.
+        return False
 
     def is_cluster(self):
         return False
@@ -21,17 +33,30 @@ class Cluster:
         self.right = right
         self.distance = distance
 
+    def __lt__(self,other):
+        # heapq compares nodes of equal distance, their order does not matter.
+        return False
+
     def is_cluster(self):
         return True
 
 class PreclusterMaker:
 
-    def __init__(self,words, vectors, number_of_steps = 21,metric="cosine",linkage="complete"):
+    def __init__(self,words, vectors, number_of_steps = 21,metric="cosine",linkage="complete",reuse_distances=True,sample_size=SILHOUETTE_SAMPLE_SIZE):
+        """
+        With reuse_distances, the float32 distance matrix computed for the linkage is also used for the
+        silhouette score of every threshold step, on a fixed sample of sample_size words for larger word sets.
+        Otherwise sklearn's silhouette_score recomputes the distances from the vectors at every step.
+        Durations of the steps are kept in timings.
+        """
         self.words = words
         self.vectors = vectors
         self.number_of_steps = number_of_steps
         self.metric = metric
         self.linkage = linkage
+        self.reuse_distances = reuse_distances
+        self.sample_size = sample_size
+        self.timings = {}
 
     def __call__(self):
         if len(self.words) == 0 or len(self.vectors) == 0:
@@ -40,12 +65,34 @@ class PreclusterMaker:
             self.words.append(self.words[0])
             self.vectors.append(self.vectors[0])
 
-        distance_matrix = scidist.pdist(np.array(self.vectors),self.metric)
+        start_time = time.time()
+        if self.reuse_distances:
+            distance_matrix = scidist.pdist(np.array(self.vectors,dtype=np.float32),self.metric).astype(np.float32)
+            # Every silhouette score is computed on the same sample of words.
+            if self.sample_size and len(self.words) > self.sample_size:
+                self._sample_idxes = np.sort(np.random.RandomState(0).choice(len(self.words),self.sample_size,replace=False))
+            else:
+                self._sample_idxes = np.arange(len(self.words))
+            self._sample_distances = scidist.squareform(distance_matrix)[np.ix_(self._sample_idxes,self._sample_idxes)]
+        else:
+            distance_matrix = scidist.pdist(np.array(self.vectors),self.metric)
+        self.timings['distances'] = time.time() - start_time
+
+        start_time = time.time()
         linkage_matrix = hier.linkage(distance_matrix,self.linkage)
+        self.timings['linkage'] = time.time() - start_time
 
         dendrogram = self._linkage_matrix_to_dendrogram(linkage_matrix,self.words,self.vectors)
         clusterings = self._create_clusterings(dendrogram)
-        return [[(node.label,node.vector) for node in _get_cluster_nodes(cluster)] for cluster in self._find_optimal_clustering(clusterings)]
+
+        start_time = time.time()
+        optimal_clustering = self._find_optimal_clustering(clusterings)
+        self.timings['silhouette'] = time.time() - start_time
+
+        log_dict = {'task': 'PRECLUSTER', 'event': 'preclustering_finished', 'data': {'words': len(self.words), 'reuse_distances': self.reuse_distances, 'timings': self.timings}}
+        logging.getLogger(INFO_LOGGER).info("Preclustering finished", extra=log_dict)
+
+        return [[(node.label,node.vector) for node in _get_cluster_nodes(cluster)] for cluster in optimal_clustering]
 
     def _linkage_matrix_to_dendrogram(self,linkage_matrix,labels,vectors):
 
@@ -55,7 +102,7 @@ class PreclusterMaker:
 
         cluster_map = {}
         for i in range(N):
-            cluster_map[i] = DataPoint(labels[i],vectors[i])
+            cluster_map[i] = DataPoint(labels[i],vectors[i],i)
 
         next_cluster_idx = N
 
@@ -103,18 +150,57 @@ class PreclusterMaker:
         max_clustering = None
 
         for clustering in clusterings:
-            labeled_vectors = [(node.vector,cluster_idx) for cluster_idx in range(len(clustering)) for node in _get_cluster_nodes(clustering[cluster_idx][1]) ]
-            vectors,labels = [np.array(x) for x in zip(*labeled_vectors)]
-            if np.in1d([1],labels)[0]:
-                score = silhouette_score(vectors,labels,metric='cosine')
+            if self.reuse_distances:
+                labels = np.zeros(len(self.words),dtype=np.int32)
+                for cluster_idx in range(len(clustering)):
+                    labels[[node.idx for node in _get_cluster_nodes(clustering[cluster_idx][1])]] = cluster_idx
+                if labels.max() > 0:
+                    score = _silhouette_score(self._sample_distances,labels[self._sample_idxes])
+                    if score is None:
+                        continue # the sample holds a single cluster
+                else:
+                    continue # silhouette doesn't work with just one cluster
             else:
-                continue # silhouette doesn't work with just one cluster
+                labeled_vectors = [(node.vector,cluster_idx) for cluster_idx in range(len(clustering)) for node in _get_cluster_nodes(clustering[cluster_idx][1]) ]
+                vectors,labels = [np.array(x) for x in zip(*labeled_vectors)]
+                if np.in1d([1],labels)[0]:
+                    score = silhouette_score(vectors,labels,metric='cosine')
+                else:
+                    continue # silhouette doesn't work with just one cluster
             if score > max_score:
                 max_score = score
                 max_clustering = clustering
 
         return list(zip(*max_clustering))[1] if max_clustering else list(zip(*clusterings[0]))[1]
 
+def _silhouette_score(distances,labels):
+    """
+    Mean silhouette coefficient from a square distance matrix, like sklearn's silhouette_score with
+    metric='precomputed'. The distances to every cluster are summed with one matrix product.
+    Returns None for a single cluster or only singleton clusters.
+    """
+    _, labels = np.unique(labels,return_inverse=True)
+    n_clusters = labels.max() + 1
+    if not 1 < n_clusters < len(labels):
+        return None
+
+    rows = np.arange(len(labels))
+    membership = np.zeros((len(labels),n_clusters),dtype=distances.dtype)
+    membership[rows,labels] = 1
+    cluster_sizes = membership.sum(axis=0)
+    cluster_distances = np.dot(distances,membership)
+
+    own_sizes = cluster_sizes[labels]
+    intra = cluster_distances[rows,labels] / np.maximum(own_sizes - 1,1)
+    mean_distances = cluster_distances / cluster_sizes
+    mean_distances[rows,labels] = np.inf
+    inter = mean_distances.min(axis=1)
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        scores = np.nan_to_num((inter - intra) / np.maximum(intra,inter))
+    scores[own_sizes == 1] = 0
+    return float(scores.mean())
+
 def _get_cluster_nodes(node):
 
     if not node.is_cluster():
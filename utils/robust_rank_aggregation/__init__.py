@@ -18,25 +18,30 @@ def rhoscores(r):
     return rho
 
 
-def rank_matrix(glist):
-    unique_elements = set()
-    for l in glist:
-        unique_elements.update(l)
+def rhoscores_matrix(rmat):
+    """Vectorised rhoscores of every row of the rank matrix."""
+    x = np.sort(np.asarray(rmat, np.float64), axis=1)
+    n = x.shape[1]
+    p = beta.cdf(x=x, a=np.arange(1, n + 1)[np.newaxis, :], b=np.arange(n, 0, -1)[np.newaxis, :])
+    return np.minimum(p.min(axis=1) * n, 1)
+
 
-    names = list(unique_elements)
-    names.sort()
+def rank_matrix(glist):
+    """
+    Returns the matrix of normalised ranks, a row per unique element and a column per list,
+    with the sorted unique elements. Elements missing from a list get rank 1.
+    """
+    names = sorted(set(element for l in glist for element in l))
+    name_idxes = {name: idx for idx, name in enumerate(names)}
     ncol = len(glist)
-    nrow = len(unique_elements)
+    nrow = len(names)
 
     N = nrow
-    rmat = np.ones(dtype=np.float, shape=(nrow, ncol))
+    rmat = np.ones(dtype=np.float64, shape=(nrow, ncol))
 
-    # This is the most obvious candidate for optimizing.
-    # For loops should be rewritten to numpy array indexing operations
-    for col in range(ncol):
-        rows = [names.index(i) for i in glist[col]]
-        for ind, row in enumerate(rows):
-            rmat[row, col] = (1.0 + ind) / N
+    for col, l in enumerate(glist):
+        rows = np.fromiter((name_idxes[i] for i in l), dtype=np.int64, count=len(l))
+        rmat[rows, col] = np.arange(1, len(l) + 1) / N
 
     return rmat, names
 
@@ -50,5 +55,6 @@ def aggregate_ranks(glist):
         lower score is better.
     """
     rmat, names = rank_matrix(glist)
-    return sorted(zip(names, (rhoscores(row) for row in rmat)), key=lambda x: x[1])
-
+    if not names:
+        return []
+    return sorted(zip(names, rhoscores_matrix(rmat)), key=lambda x: x[1])
@@ -5,6 +5,9 @@ import os
 
 from texta.settings import MODELS_DIR
 
+# Vocabulary vectors compared to all cluster centers at once when picking etalons.
+ETALON_BATCH_SIZE = 50000
+
 class WordCluster(object):
     """
     WordCluster object to cluster Word2Vec vectors using MiniBatchKMeans.
@@ -27,19 +30,48 @@ class WordCluster(object):
                 n_clusters = 1000
 
         clustering = MiniBatchKMeans(n_clusters=n_clusters).fit(vocab_vectors)
-        cluster_labels = clustering.labels_
-        
-        for i,cluster_label in enumerate(cluster_labels):
-            word = vocab[i]
-            etalon = embedding.wv.most_similar(positive=[clustering.cluster_centers_[cluster_label]])[0][0]
-            
+        etalons = self._get_etalons(embedding, clustering.cluster_centers_)
+
+        self._set_clusters(vocab, clustering.labels_, [embedding.wv.index2word[etalon] for etalon in etalons])
+        return True
+
+    @staticmethod
+    def _get_etalons(embedding, cluster_centers):
+        """
+        Returns the vocabulary index of the word most similar to every cluster center, the same word
+        embedding.wv.most_similar(positive=[center]) would return first.
+        """
+        embedding.wv.init_sims()
+        vectors = embedding.wv.syn0norm
+        centers = cluster_centers.astype(np.float32)
+        norms = np.linalg.norm(centers, axis=1)
+        centers[norms > 0] /= norms[norms > 0, np.newaxis]
+
+        best_dists = np.full(len(centers), -np.inf, dtype=np.float32)
+        etalons = np.zeros(len(centers), dtype=np.int64)
+        for start in range(0, len(vectors), ETALON_BATCH_SIZE):
+            dists = np.dot(centers, vectors[start:start + ETALON_BATCH_SIZE].T)
+            batch_best = np.argmax(dists, axis=1)
+            batch_dists = dists[np.arange(len(centers)), batch_best]
+
+            improved = batch_dists > best_dists
+            best_dists[improved] = batch_dists[improved]
+            etalons[improved] = batch_best[improved] + start
+
+        return etalons
+
+    def _set_clusters(self, vocab, labels, cluster_etalons):
+        self.word_to_cluster_dict = {}
+        self.cluster_dict = {}
+
+        for word, cluster_label in zip(vocab, labels):
+            etalon = cluster_etalons[cluster_label]
+
             if etalon not in self.cluster_dict:
                 self.cluster_dict[etalon] = []
-                
+
             self.cluster_dict[etalon].append(word)
             self.word_to_cluster_dict[word] = etalon
-        
-        return True
     
     def query(self, word):
         try:
@@ -52,10 +84,23 @@ class WordCluster(object):
         return ' '.join(text)
 
     def save(self, file_path):
+        """
+        Saves the cluster map as a numpy archive: the UTF-8 encoded words with their offsets,
+        the cluster label of every word and the etalon word index of every cluster.
+        """
         try:
-            data = {"word_to_cluster_dict": self.word_to_cluster_dict, "cluster_dict": self.cluster_dict}
-            with open(file_path, 'w') as fh:
-                fh.write(json.dumps(data))
+            words = list(self.word_to_cluster_dict.keys())
+            word_idxes = {word: idx for idx, word in enumerate(words)}
+            etalons = list(self.cluster_dict.keys())
+            etalon_labels = {etalon: label for label, etalon in enumerate(etalons)}
+
+            encoded_words = [word.encode('utf8') for word in words]
+            with open(file_path, 'wb') as fh:
+                np.savez(fh,
+                         word_bytes=np.frombuffer(b''.join(encoded_words), dtype=np.uint8),
+                         word_offsets=np.cumsum([0] + [len(word) for word in encoded_words]).astype(np.int64),
+                         labels=np.array([etalon_labels[self.word_to_cluster_dict[word]] for word in words], dtype=np.int32),
+                         etalons=np.array([word_idxes[etalon] for etalon in etalons], dtype=np.int32))
             return True
         except:
             return False
@@ -63,9 +108,21 @@ class WordCluster(object):
     def load(self, unique_id, task_type='train_tagger'):
         file_path = os.path.join(MODELS_DIR, task_type, 'cluster_{}'.format(unique_id))
         try:
-            with open(file_path) as fh:
-                data = json.loads(fh.read())
-            self.cluster_dict = data["cluster_dict"]
-            self.word_to_cluster_dict = data["word_to_cluster_dict"]
+            with open(file_path, 'rb') as fh:
+                is_archive = fh.read(2) == b'PK'
+
+            if is_archive:
+                with np.load(file_path) as data:
+                    word_bytes = data['word_bytes'].tobytes()
+                    word_offsets = data['word_offsets']
+                    words = [word_bytes[start:end].decode('utf8') for start, end in zip(word_offsets[:-1], word_offsets[1:])]
+                    self._set_clusters(words, data['labels'], [words[etalon] for etalon in data['etalons']])
+            else:
+                # Cluster maps saved before the binary format.
+                with open(file_path) as fh:
+                    data = json.loads(fh.read())
+                self.cluster_dict = data["cluster_dict"]
+                self.word_to_cluster_dict = data["word_to_cluster_dict"]
+            return True
         except:
             return False